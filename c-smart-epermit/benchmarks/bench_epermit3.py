@@ -0,0 +1,367 @@
+"""
+e_permit3 热点路径基准：insert_one_record、/records/update_by_condition、/records/today、/delete_fastgpt_records。
+
+先向 e_permit3 灌入 BENCH_ROWS 行（默认 10 万，分布在最近 BENCH_DAYS 天，其中“今天”BENCH_TODAY_ROWS 行），
+再逐个路径重复调用 BENCH_REPEAT 次，输出 p50 / p99 / 平均耗时（ms）。handler 的调试 print 在计时期间被丢弃。
+
+数据库：
+- 默认使用内存 SQLite 作为 MySQL 替身：把 %s 占位符、BINARY 比较转换为 SQLite 写法，并注册 REGEXP_REPLACE、
+  JSON_ARRAY_APPEND 两个函数，handler 的 SQL 原样执行。适合比较改动前后的相对耗时，绝对值不代表线上 MySQL
+- 设置 BENCH_MYSQL=user:password@host:3306/database 时连接真实 MySQL/MariaDB（如本机 mysqld --initialize-insecure
+  起的实例）。库中没有 e_permit3 时自动建表；表中已有数据时拒绝运行，BENCH_RESET=1 时先 TRUNCATE。不要指向生产库
+
+两种模式都会建 bstudio_create_time、(group_id, bstudio_create_time) 两个二级索引，BENCH_NO_INDEX=1 时不建，
+用于观察索引对各路径的影响。
+
+用法：
+    cd c-smart-epermit
+    python benchmarks/bench_epermit3.py
+    BENCH_ROWS=1000000 BENCH_REPEAT=500 python benchmarks/bench_epermit3.py
+    BENCH_MYSQL=bench:bench@127.0.0.1:3306/epermit_bench BENCH_RESET=1 python benchmarks/bench_epermit3.py
+"""
+import contextlib
+import json
+import math
+import os
+import random
+import re
+import sqlite3
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from functools import lru_cache
+from urllib.parse import unquote, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import crud_sql_apiserver as api  # noqa: E402
+from hk_time import hk_day_window  # noqa: E402
+
+ROWS = int(os.getenv("BENCH_ROWS", "100000"))
+DAYS = int(os.getenv("BENCH_DAYS", "180"))
+REPEAT = int(os.getenv("BENCH_REPEAT", "200"))
+WARMUP = int(os.getenv("BENCH_WARMUP", "5"))
+TODAY_ROWS = max(int(os.getenv("BENCH_TODAY_ROWS", "500")), (REPEAT + WARMUP) * 2)  # delete 每次删掉一行，需留足
+MYSQL_DSN = os.getenv("BENCH_MYSQL")
+SEED_BATCH = 5000
+
+GROUPS = [f"1203634{i:08d}@g.us" for i in range(20)]
+PROJECTS = ["啟德體育園", "將軍澳醫院", "沙田污水廠", "東涌新市鎮"]
+LOCATIONS = ["BLK A", "BLK B", "BLK C", "EP7", "EP12", "C座,CP9", "A座", "Block D", "平台", "天台"]
+FLOORS = ["G/F", "1/F", "3/F", "5-7/F", "9/F、10/F", "R/F", "B1/F", "12/F"]
+SUBCONTRACTORS = ["中建", "偉健", "俊和", "新昌", "金門", "安樂", "有利", "協興"]
+
+COLUMNS = [f for f in api.FIELDS.declared if f != "id"]
+
+MYSQL_DDL = f"""
+CREATE TABLE IF NOT EXISTS `{api.TABLE_NAME}` (
+    `id` INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    `group_id` VARCHAR(64),
+    `project` VARCHAR(128),
+    `uuid` VARCHAR(64),
+    `bstudio_create_time` DATETIME,
+    `location` VARCHAR(255),
+    `number` INT,
+    `floor` VARCHAR(128),
+    `morning` INT,
+    `afternoon` INT,
+    `xiaban` INT,
+    `subcontractor` VARCHAR(128),
+    `part_leave_number` INT,
+    `process` VARCHAR(128),
+    `time_range` VARCHAR(64),
+    `building` VARCHAR(64),
+    `update_history` JSON,
+    `update_safety_history` JSON,
+    `update_construct_history` JSON,
+    `safety_flag` INT,
+    `application_id` VARCHAR(64)
+) DEFAULT CHARSET=utf8mb4
+"""
+
+SQLITE_DDL = f"""
+CREATE TABLE `{api.TABLE_NAME}` (
+    `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+    {", ".join(f"`{c}`" for c in COLUMNS)}
+)
+"""
+
+INDEXES = [
+    ("idx_bench_create_time", "`bstudio_create_time`"),
+    ("idx_bench_group_time", "`group_id`, `bstudio_create_time`"),
+]
+
+
+# --- SQLite 替身 ---
+@lru_cache(maxsize=256)
+def _to_sqlite(sql: str) -> str:
+    return re.sub(r"\bBINARY\s+", "", sql).replace("%s", "?")
+
+
+@lru_cache(maxsize=64)
+def _compile(pattern: str):
+    return re.compile(pattern)
+
+
+def _regexp_replace(value, pattern, replacement):
+    if value is None:
+        return None
+    return _compile(pattern).sub(replacement, str(value))
+
+
+def _json_array_append(doc, path, value):
+    items = json.loads(doc) if doc else []
+    items.append(value)
+    return json.dumps(items, ensure_ascii=False)
+
+
+class _SQLiteCursor:
+    """模拟 pymysql DictCursor：支持 with、%s 占位符，fetch 返回 dict"""
+
+    def __init__(self, conn):
+        self._cur = conn.cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cur.close()
+
+    def execute(self, sql, params=()):
+        self._cur.execute(_to_sqlite(sql), tuple(params or ()))
+        return self._cur.rowcount
+
+    def executemany(self, sql, seq):
+        self._cur.executemany(_to_sqlite(sql), [tuple(p) for p in seq])
+        return self._cur.rowcount
+
+    def fetchone(self):
+        row = self._cur.fetchone()
+        return dict(row) if row is not None else None
+
+    def fetchall(self):
+        return [dict(row) for row in self._cur.fetchall()]
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cur.lastrowid
+
+
+class _SQLiteConnection:
+    """整个基准共用一个内存库连接，close() 不真正关闭"""
+
+    def __init__(self):
+        self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.create_function("REGEXP_REPLACE", 3, _regexp_replace, deterministic=True)
+        self._conn.create_function("JSON_ARRAY_APPEND", 3, _json_array_append)
+
+    def cursor(self):
+        return _SQLiteCursor(self._conn)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        pass
+
+
+def _use_sqlite():
+    conn = _SQLiteConnection()
+    api.get_conn = lambda: conn
+    with conn.cursor() as cur:
+        cur.execute(SQLITE_DDL)
+    return "SQLite（内存替身）"
+
+
+def _use_mysql(dsn: str):
+    parts = urlsplit(dsn if "://" in dsn else f"mysql://{dsn}")
+    api.DB_CONFIG.update(
+        host=parts.hostname or "127.0.0.1",
+        port=parts.port or 3306,
+        user=unquote(parts.username or ""),
+        password=unquote(parts.password or ""),
+        database=parts.path.lstrip("/"),
+    )
+    api.execute_query(MYSQL_DDL)
+    existing = api.execute_query(f"SELECT COUNT(*) AS n FROM `{api.TABLE_NAME}`", fetch=True)[0]["n"]
+    if existing:
+        if os.getenv("BENCH_RESET") != "1":
+            raise SystemExit(f"{api.DB_CONFIG['database']}.{api.TABLE_NAME} 已有 {existing} 行，"
+                             f"确认是基准库后设置 BENCH_RESET=1 重跑")
+        api.execute_query(f"TRUNCATE TABLE `{api.TABLE_NAME}`")
+    return f"MySQL {api.DB_CONFIG['host']}:{api.DB_CONFIG['port']}/{api.DB_CONFIG['database']}"
+
+
+def _ensure_indexes(mysql: bool):
+    if os.getenv("BENCH_NO_INDEX") == "1":
+        return
+    for name, columns in INDEXES:
+        if mysql:
+            exists = api.execute_query(
+                "SELECT 1 FROM information_schema.STATISTICS WHERE TABLE_SCHEMA=DATABASE() "
+                "AND TABLE_NAME=%s AND INDEX_NAME=%s LIMIT 1",
+                (api.TABLE_NAME, name),
+                fetch=True,
+            )
+            if not exists:
+                api.execute_query(f"ALTER TABLE `{api.TABLE_NAME}` ADD INDEX `{name}` ({columns})")
+        else:
+            api.execute_query(f"CREATE INDEX `{name}` ON `{api.TABLE_NAME}` ({columns})")
+
+
+# --- 造数 ---
+def _make_row(rng: random.Random, created: datetime, application_id: str) -> dict:
+    location = rng.choice(LOCATIONS)
+    number = rng.randint(1, 20)
+    part = rng.choice([0, 0, 0, rng.randint(0, number)])
+    return {
+        "group_id": rng.choice(GROUPS),
+        "project": rng.choice(PROJECTS),
+        "uuid": str(uuid.UUID(int=rng.getrandbits(128))),
+        "bstudio_create_time": created.strftime("%Y-%m-%d %H:%M:%S"),
+        "location": location,
+        "number": number,
+        "floor": rng.choice(FLOORS),
+        "morning": rng.randint(0, 1),
+        "afternoon": rng.randint(0, 1),
+        "xiaban": 1 if part == number else 0,
+        "subcontractor": rng.choice(SUBCONTRACTORS),
+        "part_leave_number": part,
+        "process": None,
+        "time_range": None,
+        "building": api.extract_building(location),
+        "update_history": None,
+        "update_safety_history": None,
+        "update_construct_history": None,
+        "safety_flag": rng.randint(0, 1),
+        "application_id": application_id,
+    }
+
+
+def _seed(rng: random.Random) -> list:
+    """灌入历史数据和今天的数据，返回今天的行（后续请求从中取过滤条件）"""
+    _, day_start, _ = hk_day_window()
+    today = datetime.strptime(day_start, "%Y-%m-%d %H:%M:%S")
+    history = max(ROWS - TODAY_ROWS, 0)
+    sql = (f"INSERT INTO `{api.TABLE_NAME}` ({', '.join(f'`{c}`' for c in COLUMNS)}) "
+           f"VALUES ({', '.join(['%s'] * len(COLUMNS))})")
+
+    def rows():
+        for i in range(history):
+            created = today - timedelta(seconds=rng.randint(1, DAYS * 86400))
+            yield _make_row(rng, created, f"H{i:07d}")
+
+    batch = []
+    for row in rows():
+        batch.append(tuple(row[c] for c in COLUMNS))
+        if len(batch) >= SEED_BATCH:
+            api.execute_query(sql, batch, many=True)
+            batch = []
+    today_rows = [_make_row(rng, today + timedelta(seconds=rng.randint(0, 86399)), f"T{i:06d}")
+                  for i in range(TODAY_ROWS)]
+    batch.extend(tuple(row[c] for c in COLUMNS) for row in today_rows)
+    for i in range(0, len(batch), SEED_BATCH):
+        api.execute_query(sql, batch[i:i + SEED_BATCH], many=True)
+    return today_rows
+
+
+# --- 计时 ---
+def _percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))]
+
+
+def _measure(fn, args_list) -> list:
+    samples = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i, args in enumerate(args_list):
+            start = time.perf_counter()
+            fn(*args)
+            elapsed = (time.perf_counter() - start) * 1000
+            if i >= WARMUP:
+                samples.append(elapsed)
+    return samples
+
+
+def _check(resp, *ok):
+    if resp.status_code not in ok:
+        raise RuntimeError(f"{resp.request.method} {resp.request.path} 返回 {resp.status_code}: {resp.get_data(as_text=True)[:200]}")
+
+
+def main():
+    backend = _use_mysql(MYSQL_DSN) if MYSQL_DSN else _use_sqlite()
+    rng = random.Random(20251010)
+
+    start = time.perf_counter()
+    today_rows = _seed(rng)
+    seed_s = time.perf_counter() - start
+    start = time.perf_counter()
+    _ensure_indexes(bool(MYSQL_DSN))
+    index_s = time.perf_counter() - start
+    print(f"{backend}：灌入 {max(ROWS, TODAY_ROWS)} 行（今天 {TODAY_ROWS} 行）用时 {seed_s:.1f}s，"
+          f"建索引 {index_s:.1f}s，每个路径 {REPEAT} 次（另预热 {WARMUP} 次）\n")
+
+    client = api.app.test_client()
+    n = REPEAT + WARMUP
+    gmt_today = api.generate_gmt_cst_time()
+
+    def insert(data):
+        res = api.insert_one_record(dict(data))
+        if "error" in res:
+            raise RuntimeError(f"insert_one_record 失败: {res}")
+
+    # 一半命中今天已有的记录（走累加更新），一半是新组合（走插入）
+    insert_args = []
+    for i in range(n):
+        row = rng.choice(today_rows)
+        data = {k: row[k] for k in ("group_id", "project", "location", "subcontractor", "number", "floor")}
+        if i % 2:
+            data["location"] = f"BLK {chr(65 + i % 26)} {uuid.UUID(int=rng.getrandbits(128)).hex[:6]}"
+        insert_args.append((data,))
+
+    def update(row):
+        resp = client.put("/records/update_by_condition", json={
+            "where": {**{k: row[k] for k in ("group_id", "location", "subcontractor", "floor")},
+                      "bstudio_create_time": gmt_today},
+            "set": {"morning": 1, "part_leave_number": 1, "safety_flag": 1},
+        })
+        _check(resp, 200)
+
+    def today(params):
+        _check(client.get("/records/today", query_string=params), 200)
+
+    def delete(row):
+        resp = client.post("/delete_fastgpt_records", json={
+            **{k: row[k] for k in ("group_id", "location", "subcontractor", "floor", "application_id")},
+            "bstudio_create_time": gmt_today,
+        })
+        _check(resp, 200)
+
+    delete_rows = rng.sample(today_rows, n)
+    cases = [
+        ("insert_one_record", insert, insert_args),
+        ("update_by_condition", update, [(rng.choice(today_rows),) for _ in range(n)]),
+        ("/records/today", today, [({},)] * n),
+        ("/records/today?group_id", today, [({"group_id": rng.choice(GROUPS)},) for _ in range(n)]),
+        ("delete_fastgpt_records", delete, [(row,) for row in delete_rows]),
+    ]
+
+    print(f"{'路径':<28}{'次数':>8}{'p50 ms':>12}{'p99 ms':>12}{'平均 ms':>12}")
+    for name, fn, args_list in cases:
+        samples = _measure(fn, args_list)
+        print(f"{name:<28}{len(samples):>8}{_percentile(samples, 50):>12.3f}"
+              f"{_percentile(samples, 99):>12.3f}{sum(samples) / len(samples):>12.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+邮件编码解码基准：对比旧的“逐个编码尝试”解码与当前 _decode_payload_smart。
+
+对每封邮件的所有文本 part（以及 Subject/From）分别用两种实现解码，统计耗时和结果差异。
+旧实现对 UTF-8 中文邮件会先用 gb18030 “解码成功”得到乱码，差异行即为被修正的邮件。
+
+用法：
+    cd c-smart-epermit
+    python benchmarks/bench_mail_decode.py /path/to/eml_corpus   # 目录下的 *.eml，建议用真实的中文邮件导出
+    python benchmarks/bench_mail_decode.py                        # 无语料时使用内置的合成样本
+"""
+import email
+import glob
+import os
+import sys
+import time
+from email.header import decode_header
+from email.utils import parseaddr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crud_sql_apiserver import _decode_mime_header, _decode_payload_smart  # noqa: E402
+
+REPEAT = int(os.getenv("BENCH_REPEAT", "200"))
+
+
+def _legacy_decode_payload(payload, declared_charset=None):
+    """改造前的实现：gb18030 优先，其次声明编码、utf-8、big5、gbk，latin-1 兜底"""
+    if payload is None:
+        return ""
+    encodings = ["gb18030"]
+    if declared_charset:
+        encodings.append(declared_charset.lower())
+    encodings.extend(["utf-8", "big5", "gbk", "latin-1"])
+    seen = set()
+    for enc in encodings:
+        if enc in seen:
+            continue
+        seen.add(enc)
+        try:
+            return payload.decode(enc)
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return payload.decode("utf-8", errors="ignore")
+
+
+def _legacy_decode_header(value):
+    if not value:
+        return ""
+    decoded = []
+    for part, enc in decode_header(value):
+        if isinstance(part, bytes):
+            decoded.append(_legacy_decode_payload(part, enc))
+        else:
+            try:
+                decoded.append(_legacy_decode_payload(str(part).encode("latin1"), None))
+            except Exception:
+                decoded.append(str(part))
+    return "".join(decoded)
+
+
+def _synthetic_corpus():
+    trad = "各位同事：請於本週五前提交安全施工報告，謝謝。本項目現場的棚架工程將於下週開始。\n" * 40
+    simp = "各位同事：请于本周五前提交安全施工报告，谢谢。本项目现场的棚架工程将于下周开始。\n" * 40
+    html = "<html><body>" + "".join(f"<p>{line}</p>" for line in trad.splitlines()) * 25 + "</body></html>"
+
+    def build(body: bytes, charset, subtype="plain", subject="=?utf-8?B?5a6J5YWo6YCa55+l?="):
+        ctype = f"text/{subtype}" + (f"; charset={charset}" if charset else "")
+        head = f"From: =?utf-8?B?5bel56iL6YOo?= <eng@example.com>\r\nSubject: {subject}\r\nContent-Type: {ctype}\r\n\r\n"
+        return head.encode("ascii") + body
+
+    return [
+        ("utf-8 声明正确", build(trad.encode("utf-8"), "utf-8")),
+        ("utf-8 未声明", build(trad.encode("utf-8"), None)),
+        ("gb2312 声明", build(simp.encode("gbk"), "gb2312")),
+        ("gbk 未声明", build(simp.encode("gbk"), None)),
+        ("big5 声明", build(trad.encode("big5"), "big5")),
+        ("big5 未声明", build(trad.encode("big5"), None)),
+        ("gbk 误标 latin-1", build(simp.encode("gbk"), "iso-8859-1")),
+        ("大 HTML utf-8", build(html.encode("utf-8"), "utf-8", subtype="html")),
+    ]
+
+
+def _load_corpus(path):
+    files = sorted(glob.glob(os.path.join(path, "**", "*.eml"), recursive=True))
+    corpus = []
+    for f in files:
+        with open(f, "rb") as fh:
+            corpus.append((os.path.relpath(f, path), fh.read()))
+    return corpus
+
+
+def _text_parts(msg):
+    for part in msg.walk():
+        if part.get_content_maintype() != "text":
+            continue
+        payload = part.get_payload(decode=True)
+        if payload is not None:
+            yield payload, part.get_content_charset()
+
+
+def _time(fn, items):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        for args in items:
+            fn(*args)
+    return (time.perf_counter() - start) / REPEAT * 1000
+
+
+def main():
+    corpus = _load_corpus(sys.argv[1]) if len(sys.argv) > 1 else _synthetic_corpus()
+    if not corpus:
+        print("语料目录中没有 .eml 文件")
+        return 1
+
+    print(f"{'邮件':<28}{'字节':>10}{'旧实现 ms':>12}{'新实现 ms':>12}{'结果差异':>10}")
+    total_old = total_new = changed = 0
+    for name, raw in corpus:
+        msg = email.message_from_bytes(raw)
+        parts = list(_text_parts(msg))
+        headers = [(msg.get(h),) for h in ("Subject", "From") if msg.get(h)]
+
+        # 与 _parse_mail_message 一致：按发件人地址传入编码提示
+        sender = parseaddr(_decode_mime_header(msg.get("From")))[1].lower() or None
+        old_ms = _time(_legacy_decode_payload, parts) + _time(_legacy_decode_header, headers)
+        new_ms = _time(_decode_payload_smart, [p + (sender,) for p in parts]) + _time(_decode_mime_header, headers)
+        differs = any(_legacy_decode_payload(*p) != _decode_payload_smart(*p) for p in parts) or any(
+            _legacy_decode_header(*h) != _decode_mime_header(*h) for h in headers
+        )
+        total_old += old_ms
+        total_new += new_ms
+        changed += differs
+        print(f"{name[:27]:<28}{len(raw):>10}{old_ms:>12.3f}{new_ms:>12.3f}{'是' if differs else '':>10}")
+
+    print(f"\n共 {len(corpus)} 封，旧实现 {total_old:.2f} ms，新实现 {total_new:.2f} ms，"
+          f"加速 {total_old / total_new if total_new else 0:.2f}x，{changed} 封解码结果不同")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
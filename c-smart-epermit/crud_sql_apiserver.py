@@ -1,28 +1,70 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from pymysql import connect
 from pymysql.err import IntegrityError, DataError
 import pymysql.cursors
 import re
-from datetime import datetime, date
+from datetime import datetime, timedelta
+from decimal import Decimal
 import uuid
-from dateutil import parser as date_parser
 from typing import Optional
-import imaplib
 import email
 from email.header import decode_header
-from email.utils import parsedate_to_datetime
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from email.utils import parsedate_to_datetime, parseaddr
 from email.header import Header
 from html.parser import HTMLParser
-from html import unescape
 import os
-from zhconv import convert
+import sys
+import argparse
+import threading
+import time
+import hashlib
+import math
+import hmac
+import importlib.util
+from collections import OrderedDict, deque
+from functools import lru_cache
+from contextlib import contextmanager
 import json
-from cryptography.fernet import Fernet
 import base64
+import binascii
+from urllib.parse import quote, unquote
+import codecs
 from dotenv import load_dotenv
+from hk_time import CST_TZ, HK_TZ, UTC, cst_now, hk_day_window, hk_now, hk_today
+
+
+def _lazy_import(name: str):
+    """
+    返回延迟加载的模块（importlib.util.LazyLoader）：第一次访问模块属性时才真正执行导入。
+    3.11 的 LazyLoader 首次加载不是线程安全的，多线程服务应在启动时调用 preload_lazy_modules()。
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# 邮件收发、加密、简繁转换等依赖只有部分接口用到，按需加载，import 本模块（测试、脚本、worker 启动）时不付出这部分开销
+imaplib = _lazy_import("imaplib")
+smtplib = _lazy_import("smtplib")
+sqlite3 = _lazy_import("sqlite3")
+mime_multipart = _lazy_import("email.mime.multipart")
+mime_text = _lazy_import("email.mime.text")
+fernet = _lazy_import("cryptography.fernet")
+zhconv = _lazy_import("zhconv")  # 导入时会加载 pkg_resources，约 100ms
+date_parser = _lazy_import("dateutil.parser")
+LAZY_MODULES = (imaplib, smtplib, sqlite3, mime_multipart, mime_text, fernet, zhconv, date_parser)
+
+
+def preload_lazy_modules() -> None:
+    """在单线程阶段（服务启动、pre-fork master）加载全部延迟模块"""
+    for module in LAZY_MODULES:
+        getattr(module, "__name__")  # 访问任意属性即触发加载
 
 # 加载 .env 文件
 load_dotenv()
@@ -53,17 +95,46 @@ DB_CONFIG = {
     "cursorclass": pymysql.cursors.DictCursor
 }
 
+
+# --- 表字段白名单 ---
+# 各表的 *_FIELDS 是查询/更新允许使用的列。代码里声明的列表只是默认值：启动后由 _schema_registry 从
+# information_schema 加载实际列并替换（见「表结构注册表」），避免声明与真实表结构不一致。
+class _TableFields:
+    """表的列名白名单：in 判断为 O(1) 集合查找，迭代按表中列顺序；列集合整体替换，读者不会看到半更新状态"""
+
+    def __init__(self, table: str, declared):
+        self.table = table
+        self.declared = tuple(declared)
+        self._state = (self.declared, frozenset(self.declared))
+
+    def update(self, columns) -> None:
+        columns = tuple(columns)
+        self._state = (columns, frozenset(columns))
+
+    def __contains__(self, name) -> bool:
+        return name in self._state[1]
+
+    def __iter__(self):
+        return iter(self._state[0])
+
+    def __len__(self) -> int:
+        return len(self._state[0])
+
+    def __repr__(self) -> str:
+        return repr(list(self._state[0]))
+
+
 TABLE_NAME = "e_permit3"
-FIELDS = [
+FIELDS = _TableFields(TABLE_NAME, [
     "id", "group_id", "project", "uuid", "bstudio_create_time",
     "location", "number", "floor", "morning",
     "afternoon", "xiaban", "subcontractor", "part_leave_number",
     "process", "time_range", "building", "update_history", "update_safety_history", "update_construct_history", "safety_flag", "application_id"
-]
+])
 
 # --- jiaodika 表配置 ---
 JIAODIKA_TABLE = "jiaodika"
-JIAODIKA_FIELDS = [
+JIAODIKA_FIELDS = _TableFields(JIAODIKA_TABLE, [
     "id",
     "bstudio_create_time",
     "file",
@@ -80,11 +151,11 @@ JIAODIKA_FIELDS = [
     "keydiagrams",
     "mockups",
     "updated_at",
-]
+])
 
 # --- 邮箱账号密码表配置 ---
 EMAIL_ACCOUNT_TABLE = "email_accounts"
-EMAIL_ACCOUNT_FIELDS = [
+EMAIL_ACCOUNT_FIELDS = _TableFields(EMAIL_ACCOUNT_TABLE, [
     "id",
     "email_account",
     "encrypted_password",
@@ -92,45 +163,59 @@ EMAIL_ACCOUNT_FIELDS = [
     "description",
     "created_at",
     "updated_at",
-]
+])
 
 # --- 每日邮件处理记录表配置（handle_ids） ---
 EMAIL_EVERYDAY_TABLE = "email_everyday"
-EMAIL_EVERYDAY_FIELDS = [
+EMAIL_EVERYDAY_FIELDS = _TableFields(EMAIL_EVERYDAY_TABLE, [
     "id",
     "email_account",
     "email_id",
     "received_time",
     "created_at",
-]
+])
+EMAIL_EVERYDAY_BATCH_SIZE = 500  # 批量 INSERT / IN 查询每条语句携带的 UID 数（控制语句大小不超过 max_allowed_packet）
 
 # --- 加密密钥配置 ---
-# 从 .env 文件读取 EMAIL_ENCRYPTION_KEY，必须设置
+# 从 .env 文件读取 EMAIL_ENCRYPTION_KEY，必须设置。加密器在第一次加解密时才创建（服务启动时会主动创建一次，
+# 密钥缺失或格式错误仍在启动时报错）；只 import 本模块、不用加解密的场景不需要配置密钥
 ENCRYPTION_KEY_RAW = os.getenv("EMAIL_ENCRYPTION_KEY")
-if not ENCRYPTION_KEY_RAW:
-    raise RuntimeError("EMAIL_ENCRYPTION_KEY 未设置，请在 .env 文件中配置")
-
-# 处理密钥
-try:
-    # 尝试作为 base64 字符串直接使用
-    _fernet_key = ENCRYPTION_KEY_RAW.encode()
-    # 验证格式
-    base64.urlsafe_b64decode(_fernet_key)
-except Exception:
-    # 如果不是有效的 base64，将原始字符串转换为密钥
-    key_material = ENCRYPTION_KEY_RAW.encode()
-    if len(key_material) < 32:
-        key_material = key_material.ljust(32, b"0")
-    elif len(key_material) > 32:
-        key_material = key_material[:32]
-    _fernet_key = base64.urlsafe_b64encode(key_material)
-
-# 初始化加密器
-try:
-    _fernet = Fernet(_fernet_key)
-except Exception as e:
-    # 如果密钥格式错误，直接报错，不生成新密钥
-    raise RuntimeError(f"EMAIL_ENCRYPTION_KEY 格式错误，无法初始化加密器: {str(e)}")
+_fernet = None
+_fernet_lock = threading.Lock()
+
+
+def _get_fernet():
+    global _fernet
+    if _fernet is not None:
+        return _fernet
+    with _fernet_lock:
+        if _fernet is not None:
+            return _fernet
+        if not ENCRYPTION_KEY_RAW:
+            raise RuntimeError("EMAIL_ENCRYPTION_KEY 未设置，请在 .env 文件中配置")
+
+        # 处理密钥
+        try:
+            # 尝试作为 base64 字符串直接使用
+            fernet_key = ENCRYPTION_KEY_RAW.encode()
+            # 验证格式
+            base64.urlsafe_b64decode(fernet_key)
+        except Exception:
+            # 如果不是有效的 base64，将原始字符串转换为密钥
+            key_material = ENCRYPTION_KEY_RAW.encode()
+            if len(key_material) < 32:
+                key_material = key_material.ljust(32, b"0")
+            elif len(key_material) > 32:
+                key_material = key_material[:32]
+            fernet_key = base64.urlsafe_b64encode(key_material)
+
+        # 初始化加密器
+        try:
+            _fernet = fernet.Fernet(fernet_key)
+        except Exception as e:
+            # 如果密钥格式错误，直接报错，不生成新密钥
+            raise RuntimeError(f"EMAIL_ENCRYPTION_KEY 格式错误，无法初始化加密器: {str(e)}")
+        return _fernet
 
 
 # --- 加密/解密工具函数 ---
@@ -139,7 +224,7 @@ def encrypt_password(password: str) -> str:
     if not password:
         return ""
     try:
-        encrypted = _fernet.encrypt(password.encode())
+        encrypted = _get_fernet().encrypt(password.encode())
         return encrypted.decode()
     except Exception as e:
         raise RuntimeError(f"密码加密失败: {str(e)}")
@@ -150,7 +235,7 @@ def decrypt_password(encrypted_password: str) -> str:
     if not encrypted_password:
         return ""
     try:
-        decrypted = _fernet.decrypt(encrypted_password.encode())
+        decrypted = _get_fernet().decrypt(encrypted_password.encode())
         return decrypted.decode()
     except Exception as e:
         raise RuntimeError(f"密码解密失败: {str(e)}")
@@ -184,6 +269,67 @@ def normalize_date(value):
         return None
 
 
+# --- 表结构注册表 ---
+# 启动时从 information_schema 一次性读取当前库所有表的列，之后每 SCHEMA_REFRESH_INTERVAL 秒后台刷新一次，
+# 也可通过 /columns?refresh=true 手动刷新。/columns 和各 *_FIELDS 白名单都由它提供，请求路径上不再查库。
+SCHEMA_REFRESH_INTERVAL = 300  # 秒
+
+
+class _SchemaRegistry:
+    def __init__(self, *fields: _TableFields):
+        self._fields = {f.table: f for f in fields}
+        self._tables = {}  # 表名 → [列名]（按 ORDINAL_POSITION）
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.loaded_at = None
+
+    def refresh(self) -> dict:
+        rows = execute_query(
+            "SELECT `TABLE_NAME`, `COLUMN_NAME` FROM `information_schema`.`COLUMNS` "
+            "WHERE `TABLE_SCHEMA`=DATABASE() ORDER BY `TABLE_NAME`, `ORDINAL_POSITION`",
+            fetch=True,
+        )
+        tables = {}
+        for row in rows:
+            tables.setdefault(row["TABLE_NAME"], []).append(row["COLUMN_NAME"])
+        with self._lock:
+            self._tables = tables
+            self.loaded_at = time.time()
+        for table, fields in self._fields.items():
+            # 表不存在（或没有权限看到）时保留当前白名单
+            if tables.get(table):
+                fields.update(tables[table])
+        return tables
+
+    def columns(self, table: str) -> Optional[list]:
+        if self.loaded_at is None:
+            self.refresh()
+        with self._lock:
+            columns = self._tables.get(table)
+        return list(columns) if columns is not None else None
+
+    def start(self, interval: int = SCHEMA_REFRESH_INTERVAL) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name="schema-registry", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def _run(self, interval: int) -> None:
+        while not self._stop_event.wait(interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"刷新表结构失败，继续使用上次结果: {e}")
+
+
+_schema_registry = _SchemaRegistry(FIELDS, JIAODIKA_FIELDS, EMAIL_ACCOUNT_FIELDS, EMAIL_EVERYDAY_FIELDS)
+
+
 # ==========================
 # Mail Utilities (IMAP/SMTP)
 # ==========================
@@ -261,121 +407,280 @@ def _parse_smtp_security(value: Optional[str], port: int) -> str:
     return "starttls"
 
 
-def _decode_mime_header(value):
+def _header_str_to_bytes(part: str) -> Optional[bytes]:
+    """decode_header 偶尔返回含非 ASCII 的 str（原始 8bit 头），尽量还原为原始字节"""
+    for enc, errors in (("latin1", "strict"), ("ascii", "surrogateescape")):
+        try:
+            return part.encode(enc, errors)
+        except UnicodeEncodeError:
+            continue
+    return None
+
+
+def _decode_mime_header(value, sender: Optional[str] = None):
     if not value:
         return ""
+    # 绝大多数邮件头是纯 ASCII 且没有 RFC 2047 编码字，直接返回
+    if isinstance(value, str) and value.isascii() and "=?" not in value:
+        return value
     try:
         parts = decode_header(value)
         decoded = []
         for part, enc in parts:
             if isinstance(part, bytes):
-                # 对于 bytes，总是使用智能解码（尝试多种编码）
-                # 即使 decode_header 返回了编码信息，也可能不准确
-                decoded.append(_decode_payload_smart(part, enc))
+                decoded.append(_decode_payload_smart(part, enc, sender=sender))
+            elif part.isascii():
+                decoded.append(part)
             else:
-                # 如果已经是字符串，但可能编码不对，尝试重新编码再解码
-                # 先转成 bytes（假设是 latin1，因为它能无损转换任何字节）
-                try:
-                    part_bytes = str(part).encode('latin1')
-                    decoded.append(_decode_payload_smart(part_bytes, None))
-                except Exception:
-                    decoded.append(str(part))
+                raw = _header_str_to_bytes(part)
+                decoded.append(_decode_payload_smart(raw, None, sender=sender) if raw is not None else part)
         return "".join(decoded)
     except Exception:
         # 如果 decode_header 失败，尝试直接智能解码整个值
         try:
             if isinstance(value, bytes):
-                return _decode_payload_smart(value, None)
+                return _decode_payload_smart(value, None, sender=sender)
             elif isinstance(value, str):
-                # 尝试将字符串转成 bytes 再解码
-                return _decode_payload_smart(value.encode('latin1'), None)
+                raw = _header_str_to_bytes(value)
+                if raw is not None:
+                    return _decode_payload_smart(raw, None, sender=sender)
         except Exception:
             pass
         return str(value)
 
 
+# --- 邮件正文配置 ---
+MAIL_MAX_BODY_CHARS = _env_int("MAIL_MAX_BODY_CHARS") or 20000  # 单封邮件正文最多返回的字符数（请求可指定更小的 max_body_chars）
+MAIL_HTML_FEED_CHUNK = 8192  # HTML 分段喂给解析器，正文字数够了就不再解析剩余部分
+
+# 这些标签内的内容不是正文（脚本、样式、<head> 中的 title/meta 等），直接丢弃
+_HTML_SKIP_TAGS = frozenset(("script", "style", "head", "title", "noscript", "template"))
+_HTML_BLOCK_TAGS = frozenset(("p", "div", "tr", "li"))
+
+
 class _HTMLToTextParser(HTMLParser):
-    def __init__(self):
+    """
+    流式 HTML 转纯文本：边解析边按行整理（去首尾空白、丢弃空行），
+    输出达到 max_chars 后置 truncated，调用方停止继续 feed。
+    """
+
+    def __init__(self, max_chars: Optional[int] = None):
         super().__init__()
-        self._chunks = []
+        self._max_chars = max_chars
+        self._lines = []
+        self._size = 0
+        self._line = []
+        self._line_len = 0
+        self._skip_depth = 0
+        self.truncated = False
+
+    def _flush_line(self):
+        line = "".join(self._line).strip()
+        self._line = []
+        self._line_len = 0
+        if not line or self.truncated:
+            return
+        if self._max_chars is not None:
+            # 换行符也计入字数
+            remaining = self._max_chars - self._size - (1 if self._lines else 0)
+            if len(line) > remaining:
+                line = line[:max(remaining, 0)].rstrip()
+                self.truncated = True
+                if not line:
+                    return
+        self._lines.append(line)
+        self._size += len(line) + (1 if len(self._lines) > 1 else 0)
 
     def handle_data(self, data):
-        if data:
-            self._chunks.append(data)
+        if not data or self._skip_depth or self.truncated:
+            return
+        parts = data.split("\n")
+        for part in parts[:-1]:
+            self._line.append(part)
+            self._flush_line()
+        self._line.append(parts[-1])
+        self._line_len += len(parts[-1])
+        # 超长单行（无换行的大段文本）也要受字数限制
+        if self._max_chars is not None and self._line_len > self._max_chars - self._size:
+            self._flush_line()
 
     def handle_starttag(self, tag, attrs):
-        if tag in ("br",):
-            self._chunks.append("\n")
-        elif tag in ("p", "div", "tr", "li"):
-            self._chunks.append("\n")
+        if tag in _HTML_SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == "body":
+            # 部分邮件没有 </head>，以 <body> 为准结束跳过
+            self._skip_depth = 0
+        elif tag == "br" or tag in _HTML_BLOCK_TAGS:
+            self._flush_line()
+
+    def handle_startendtag(self, tag, attrs):
+        if tag == "br" or tag in _HTML_BLOCK_TAGS:
+            self._flush_line()
 
     def handle_endtag(self, tag):
-        if tag in ("p", "div", "tr", "li"):
-            self._chunks.append("\n")
+        if tag in _HTML_SKIP_TAGS:
+            self._skip_depth = max(self._skip_depth - 1, 0)
+        elif tag in _HTML_BLOCK_TAGS:
+            self._flush_line()
 
     def get_text(self):
-        text = unescape("".join(self._chunks))
-        lines = [ln.strip() for ln in text.splitlines()]
-        return "\n".join([ln for ln in lines if ln != ""])
+        self._flush_line()
+        return "\n".join(self._lines)
 
 
-def _html_to_text(html):
-    parser = _HTMLToTextParser()
+def _html_to_text(html, max_chars: Optional[int] = None):
+    """
+    HTML 转纯文本，返回 (text, truncated)。
+    按 MAIL_HTML_FEED_CHUNK 分段解析，输出达到 max_chars 即停止，解析耗时与返回大小都有上限。
+    """
+    html = html or ""
+    parser = _HTMLToTextParser(max_chars)
     try:
-        parser.feed(html or "")
-        parser.close()
+        for start in range(0, len(html), MAIL_HTML_FEED_CHUNK):
+            parser.feed(html[start:start + MAIL_HTML_FEED_CHUNK])
+            if parser.truncated:
+                break
+        else:
+            parser.close()
     except Exception:
-        return html or ""
-    return parser.get_text()
+        return _truncate_text(html, max_chars)
+    return parser.get_text(), parser.truncated
+
+
+def _truncate_text(text, max_chars: Optional[int] = None):
+    """按字数截断纯文本，返回 (text, truncated)"""
+    text = text or ""
+    if max_chars is not None and len(text) > max_chars:
+        return text[:max_chars], True
+    return text, False
+
+
+# --- 邮件编码识别配置 ---
+MAIL_CHARSET_SAMPLE_BYTES = 2048  # 在多个候选编码间做选择时只解码开头的这部分字节
+MAIL_CHARSET_HINT_SIZE = 2000  # 记住最多多少个发件人的编码
+
+# 声明为 gb2312/gbk 的邮件常含超出字符集的字，统一用超集解码；香港邮件的 big5 同理用 big5hkscs
+_CHARSET_SUPERSETS = {
+    "gb2312": "gb18030",
+    "gbk": "gb18030",
+    "big5": "big5hkscs",
+}
+# 单字节编码任何字节串都能“解码成功”，声明为这些编码时不能直接信任（常见于中文邮件客户端误标）
+_WEAK_CHARSETS = {"ascii", "iso8859-1", "cp1252", "iso8859-15"}
+# 候选中文编码在样本上的判别字（简繁高频字）：正确编码解出来的高频字远多于错误编码
+_COMMON_CJK_PROBES = tuple("的一是不了在人有我他中大上以到和地出也时時这這个個们們来來为為说說请請谢謝于於")
+_charset_hints = OrderedDict()
+_charset_hints_lock = threading.Lock()
+
+
+@lru_cache(maxsize=256)
+def _normalize_charset(charset: Optional[str]) -> Optional[str]:
+    """把声明的 charset 规范为 Python codec 名；未知编码返回 None"""
+    if not charset:
+        return None
+    try:
+        name = codecs.lookup(str(charset).strip().strip('"').lower()).name
+    except LookupError:
+        return None
+    return _CHARSET_SUPERSETS.get(name, name)
+
+
+def _charset_hint(sender: Optional[str]) -> Optional[str]:
+    if not sender:
+        return None
+    with _charset_hints_lock:
+        hint = _charset_hints.get(sender)
+        if hint:
+            _charset_hints.move_to_end(sender)
+        return hint
 
 
-def _decode_payload_smart(payload: bytes, declared_charset: Optional[str] = None) -> str:
+def _remember_charset_hint(sender: Optional[str], charset: str):
+    if not sender or charset in _WEAK_CHARSETS:
+        return
+    with _charset_hints_lock:
+        _charset_hints[sender] = charset
+        _charset_hints.move_to_end(sender)
+        while len(_charset_hints) > MAIL_CHARSET_HINT_SIZE:
+            _charset_hints.popitem(last=False)
+
+
+def _sniff_cjk_charset(payload: bytes) -> str:
+    """
+    在开头样本上比较 gb18030 与 big5hkscs：两者的字节范围大量重叠，几乎都能“解码成功”，
+    因此按样本中高频汉字出现次数打分（str.count 在 C 层完成），选得分高的一个。
+    """
+    sample = payload[:MAIL_CHARSET_SAMPLE_BYTES]
+    best, best_score = "gb18030", -1
+    for enc in ("gb18030", "big5hkscs"):
+        try:
+            text = codecs.getincrementaldecoder(enc)().decode(sample, final=False)
+        except UnicodeDecodeError:
+            continue
+        score = sum(text.count(ch) for ch in _COMMON_CJK_PROBES)
+        if score > best_score:
+            best, best_score = enc, score
+    return best
+
+
+def _decode_payload_smart(payload: bytes, declared_charset: Optional[str] = None, sender: Optional[str] = None) -> str:
     """
-    智能解码邮件 payload，尝试多种编码（优先声明编码，再试常见中文编码）。
+    解码邮件 payload / 邮件头片段，尽量只做一次完整解码：
+    1. 纯 ASCII 直接返回
+    2. 声明了有效的多字节编码（utf-8/gb18030/big5…）且能严格解码，直接信任
+    3. 否则依次尝试：utf-8（严格解码本身就是很强的判别）→ 该发件人上次成功的编码 → 样本判别出的中文编码
+    4. 最后才尝试声明的单字节编码，latin-1 兜底（任何字节都能解码）
     """
     if payload is None:
         return ""
-    
-    # 常见编码列表（按优先级）
-    # 需求：优先级按照 encodings_to_try（gb18030 最高）
-    encodings_to_try = [
-        "gb18030",  # 最全的中文字符集，兼容 gb2312/gbk
-        "utf-8",    # 通用标准
-        "big5",     # 繁体中文
-        "gbk",      # 简体中文常见
-        "latin-1",  # 兜底
-    ]
-    encodings = ["gb18030"]
-    if declared_charset:
-        # 不抢占 gb18030 的最高优先级，但也保留声明编码的尝试机会
-        encodings.append(declared_charset.lower())
-    encodings.extend(encodings_to_try[1:])
-    
-    # 去重但保持顺序
-    seen = set()
-    unique_encodings = []
-    for enc in encodings:
-        if enc not in seen:
-            seen.add(enc)
-            unique_encodings.append(enc)
-    
-    # 逐个尝试解码
-    for enc in unique_encodings:
+    if payload.isascii():
+        return payload.decode("ascii")
+
+    declared = _normalize_charset(declared_charset)
+    if declared and declared not in _WEAK_CHARSETS:
         try:
-            return payload.decode(enc)
-        except (UnicodeDecodeError, LookupError):
+            text = payload.decode(declared)
+            _remember_charset_hint(sender, declared)
+            return text
+        except UnicodeDecodeError:
+            pass
+
+    def _candidates():
+        yield "utf-8"
+        hint = _charset_hint(sender)
+        if hint:
+            yield hint
+        # 只有前面的候选都失败时才做样本判别
+        sniffed = _sniff_cjk_charset(payload)
+        yield sniffed
+        yield "big5hkscs" if sniffed == "gb18030" else "gb18030"
+        if declared:
+            yield declared
+
+    tried = set()
+    for enc in _candidates():
+        if enc in tried or (enc == declared and enc not in _WEAK_CHARSETS):
             continue
-    
-    # 全部失败，用 errors="ignore" 兜底
-    return payload.decode("utf-8", errors="ignore")
+        tried.add(enc)
+        try:
+            text = payload.decode(enc)
+        except UnicodeDecodeError:
+            continue
+        _remember_charset_hint(sender, enc)
+        return text
 
+    return payload.decode("latin-1")
 
-def _extract_mail_body_plain(msg):
+
+def _extract_mail_body_plain(msg, sender: Optional[str] = None, max_chars: Optional[int] = None):
     """
-    返回纯文本：
+    返回 (纯文本, 是否被截断)：
     - 优先 text/plain
     - 否则取第一个 text/*，若为 text/html 则转纯文本
+    - 正文最多 max_chars 个字符（默认 MAIL_MAX_BODY_CHARS）
     """
+    if max_chars is None:
+        max_chars = MAIL_MAX_BODY_CHARS
     if msg.is_multipart():
         fallback_text = ""
         fallback_is_html = False
@@ -389,21 +694,25 @@ def _extract_mail_body_plain(msg):
             if payload is None:
                 continue
             declared_charset = part.get_content_charset()
-            text = _decode_payload_smart(payload, declared_charset)
+            text = _decode_payload_smart(payload, declared_charset, sender=sender)
 
             if ctype == "text/plain":
-                return text
+                return _truncate_text(text, max_chars)
             if ctype.startswith("text/") and not fallback_text:
                 fallback_text = text
                 fallback_is_html = (ctype == "text/html")
-        return _html_to_text(fallback_text) if fallback_is_html else fallback_text
+        if fallback_is_html:
+            return _html_to_text(fallback_text, max_chars)
+        return _truncate_text(fallback_text, max_chars)
 
     payload = msg.get_payload(decode=True)
     if payload is None:
-        return ""
+        return "", False
     declared_charset = msg.get_content_charset()
-    text = _decode_payload_smart(payload, declared_charset)
-    return _html_to_text(text) if msg.get_content_type() == "text/html" else text
+    text = _decode_payload_smart(payload, declared_charset, sender=sender)
+    if msg.get_content_type() == "text/html":
+        return _html_to_text(text, max_chars)
+    return _truncate_text(text, max_chars)
 
 
 def _as_int(v, default):
@@ -427,37 +736,421 @@ def _parse_mail_date_to_iso(date_value: str) -> Optional[str]:
         # 转换为北京时间（UTC+8）
         if dt.tzinfo is None:
             # 如果没有时区信息，假设为UTC
-            dt = pytz.UTC.localize(dt)
+            dt = UTC.localize(dt)
         # 转换为北京时间
-        beijing_tz = pytz.timezone("Asia/Shanghai")
-        dt_beijing = dt.astimezone(beijing_tz)
+        dt_beijing = dt.astimezone(CST_TZ)
         return dt_beijing.isoformat()
     except Exception:
         return None
 
 
-def receive_emails_imap(email_account, email_password, imap_server, imap_port, receive_number=20, mailbox="inbox", unread_only=False, today_only=False):
-    result = []
-    mail = None
+def _parse_mail_message(msg, with_body: bool = True) -> dict:
+    """
+    解析邮件为接口返回所需字段：
+    - from / subject / date（香港时区 RFC 2822）/ date_iso（北京时间 ISO8601）/ body（纯文本）
+    - day: 香港时区日期 YYYY-MM-DD（用于 today_only 过滤，解析失败为 None）
+    - with_body=False 时不解码正文（body 为 None），便于先按日期过滤再取正文
+    - body_truncated: 正文是否超过 MAIL_MAX_BODY_CHARS 被截断
+    """
+    from_addr = _decode_mime_header(msg.get("From"))
+    # 同一发件人的邮件通常使用相同编码，按发件人地址缓存编码提示
+    sender = (parseaddr(from_addr)[1] or "").lower() or None
+    subject = _decode_mime_header(msg.get("Subject"), sender=sender)
+    date_header = _decode_mime_header(msg.get("Date"))
+    date_iso = _parse_mail_date_to_iso(date_header) if date_header else None
+
+    # 将 date 字段也转换为香港时区格式
+    date_hongkong = None
+    mail_day = None
+    if date_header:
+        try:
+            dt = parsedate_to_datetime(date_header)
+            if dt:
+                if dt.tzinfo is None:
+                    dt = UTC.localize(dt)
+                dt_hongkong = dt.astimezone(HK_TZ)
+                mail_day = dt_hongkong.strftime("%Y-%m-%d")
+                # 格式化为 RFC 2822 格式
+                date_hongkong = dt_hongkong.strftime("%a, %d %b %Y %H:%M:%S %z")
+        except Exception:
+            pass
+
+    body, body_truncated = _extract_mail_body_plain(msg, sender=sender) if with_body else (None, False)
+    return {
+        "from": from_addr,
+        "subject": subject,
+        "date": date_hongkong if date_hongkong else date_header,
+        "date_iso": date_iso,
+        "body": body,
+        "body_truncated": body_truncated,
+        "day": mail_day,
+    }
+
+
+def _parse_mail_bytes(raw: bytes) -> dict:
+    return _parse_mail_message(email.message_from_bytes(raw))
+
+
+def _mail_body_chars(v) -> int:
+    """请求里的 max_body_chars：缺省或非法时用 MAIL_MAX_BODY_CHARS，且不超过它（缓存里的正文就只有这么长）"""
+    n = _as_int(v, MAIL_MAX_BODY_CHARS)
+    if n <= 0:
+        return MAIL_MAX_BODY_CHARS
+    return min(n, MAIL_MAX_BODY_CHARS)
+
+
+# --- 收信返回内容配置 ---
+MAIL_SNIPPET_DEFAULT_CHARS = 200  # body_mode="snippet" 未指定长度时的摘要字数
+MAIL_RESULT_FIELDS = ("id", "from", "subject", "date", "date_iso", "body", "body_truncated")
+# body_mode="none" 时只拉取这几个邮件头，不下载正文和附件
+MAIL_HEADER_FETCH_ITEM = "BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)]"
+
+
+def _mail_body_mode(body_mode, max_body_chars=None) -> int:
+    """
+    解析 body_mode，返回本次最多返回的正文字数，0 表示不取正文：
+    - "full"（默认）：max_body_chars（见 _mail_body_chars）
+    - "none"：只取 from/subject/date，不向 IMAP 拉取正文
+    - "snippet" / "snippet:N"：正文前 N 个字符（默认 MAIL_SNIPPET_DEFAULT_CHARS）
+    """
+    max_body_chars = _mail_body_chars(max_body_chars)
+    mode = str(body_mode or "full").strip().lower()
+    if mode == "full":
+        return max_body_chars
+    if mode == "none":
+        return 0
+    name, _, size = mode.partition(":")
+    if name == "snippet":
+        n = _as_int(size, None) if size else MAIL_SNIPPET_DEFAULT_CHARS
+        if n is not None and n > 0:
+            return min(n, max_body_chars)
+    raise ValueError("body_mode 只能是 none / snippet:N / full")
+
+
+def _mail_fields(fields) -> Optional[tuple]:
+    """解析 fields（列表或逗号分隔字符串），None 表示返回全部字段；id 总是返回"""
+    if fields is None or fields == "":
+        return None
+    if isinstance(fields, str):
+        names = [f.strip() for f in fields.split(",")]
+    elif isinstance(fields, list):
+        names = [str(f).strip() for f in fields]
+    else:
+        raise ValueError("fields 必须是字符串列表或逗号分隔的字符串")
+    unknown = [f for f in names if f and f not in MAIL_RESULT_FIELDS]
+    if unknown:
+        raise ValueError(f"fields 包含未知字段: {', '.join(unknown)}（可选: {', '.join(MAIL_RESULT_FIELDS)}）")
+    return tuple(f for f in MAIL_RESULT_FIELDS if f == "id" or f in names)
+
+
+def _mail_receive_options(data: dict) -> dict:
+    """
+    从 /mail/receive* 的请求体解析 body_mode / max_body_chars / fields（非法时抛 ValueError），
+    返回可直接传给 receive_emails_imap 的关键字参数；只指定 fields 且不含 body 时不取正文。
+    """
+    fields = _mail_fields(data.get("fields"))
+    body_mode = data.get("body_mode")
+    if body_mode is None and fields is not None and "body" not in fields:
+        body_mode = "none"
+    max_body_chars = _mail_body_chars(data.get("max_body_chars"))
+    _mail_body_mode(body_mode, max_body_chars)
+    return {"body_mode": body_mode or "full", "max_body_chars": max_body_chars, "fields": fields}
+
+
+def _mail_result_item(uid, parsed: dict, max_body_chars: Optional[int] = None, fields: Optional[tuple] = None) -> dict:
+    """max_body_chars=0 时不返回 body / body_truncated；fields 限定返回的字段"""
+    item = {
+        "id": uid.decode(errors="ignore") if isinstance(uid, (bytes, bytearray)) else str(uid),
+        "from": parsed.get("from"),
+        "subject": parsed.get("subject"),
+        "date": parsed.get("date"),
+        "date_iso": parsed.get("date_iso"),
+    }
+    if max_body_chars != 0:
+        body, truncated = _truncate_text(parsed.get("body"), max_body_chars)
+        item["body"] = body
+        item["body_truncated"] = bool(parsed.get("body_truncated")) or truncated
+    if fields is not None:
+        item = {k: v for k, v in item.items() if k in fields}
+    return item
+
+
+# --- IMAP 会话池配置 ---
+# 复用已登录的 IMAP 连接，避免每次请求都做 TLS 握手 + LOGIN + SELECT + LOGOUT
+IMAP_POOL_IDLE_TIMEOUT = _env_int("IMAP_POOL_IDLE_TIMEOUT") or 300  # 空闲超过该秒数的会话直接淘汰
+IMAP_POOL_NOOP_INTERVAL = _env_int("IMAP_POOL_NOOP_INTERVAL") or 60  # 复用前空闲超过该秒数先 NOOP 探活
+IMAP_POOL_MAX_PER_ACCOUNT = _env_int("IMAP_POOL_MAX_PER_ACCOUNT") or 2  # 每个账号同时占用的连接上限
+IMAP_POOL_ACQUIRE_TIMEOUT = _env_int("IMAP_POOL_ACQUIRE_TIMEOUT") or 30  # 等待空闲名额的最长秒数
+
+
+def _imap_logout_quietly(mail):
     try:
-        n = _as_int(receive_number, 20)
-        if n <= 0:
-            n = 1
-        if n > 200:
-            n = 200
+        mail.logout()
+    except Exception:
+        pass
 
-        # 如果启用 today_only，获取香港时区的今天日期
-        today_date = None
-        if today_only:
-            hongkong_tz = pytz.timezone("Asia/Hong_Kong")
-            today_date = datetime.now(hongkong_tz).date()
 
-        mail = imaplib.IMAP4_SSL(imap_server, imap_port)
-        mail.login(email_account, email_password)
-        # 支持选择不同的邮箱文件夹，默认 inbox
-        mailbox_name = str(mailbox).strip() if mailbox else "inbox"
-        mail.select(mailbox_name)
+def _imap_selected_uidvalidity(mail) -> Optional[int]:
+    """读取 SELECT 返回的 UIDVALIDITY，拿不到时返回 None（此时不使用解析缓存）"""
+    try:
+        _, data = mail.response("UIDVALIDITY")
+        return int(data[0]) if data and data[0] is not None else None
+    except Exception:
+        return None
+
+
+IMAP_UID_SET_MAX_CHARS = 2000  # 单条命令中 UID 集合的最大长度，避免超过服务器命令行长度限制
+
+
+def _imap_uid_sets(uids, max_chars: int = IMAP_UID_SET_MAX_CHARS):
+    """
+    把 UID 列表压缩为 IMAP sequence-set（如 1:5,7,9:12），超长时切分为多段。
+    返回 [(set_str, [uid, ...])]，便于按段回报每个 UID 的结果。
+    """
+    ordered = sorted({int(u) for u in uids})
+    chunks = []
+    parts, members, length = [], [], 0
+    i = 0
+    while i < len(ordered):
+        j = i
+        while j + 1 < len(ordered) and ordered[j + 1] == ordered[j] + 1:
+            j += 1
+        part = str(ordered[i]) if i == j else f"{ordered[i]}:{ordered[j]}"
+        if parts and length + len(part) + 1 > max_chars:
+            chunks.append((",".join(parts), members))
+            parts, members, length = [], [], 0
+        parts.append(part)
+        members.extend(ordered[i:j + 1])
+        length += len(part) + 1
+        i = j + 1
+    if parts:
+        chunks.append((",".join(parts), members))
+    return chunks
+
+
+def _imap_remove_seen(mail, uids) -> set:
+    """批量移除 \\Seen（标记为未读），每段 UID 集合一条 STORE .SILENT；返回 STORE 成功的 UID 集合"""
+    marked = set()
+    for uid_set, members in _imap_uid_sets(uids):
+        status, _ = mail.uid("store", uid_set, "-FLAGS.SILENT", "(\\Seen)")
+        if status == "OK":
+            marked.update(members)
+    return marked
+
+
+_FETCH_UID_RE = re.compile(rb"\bUID (\d+)\b", re.IGNORECASE)
+_FETCH_FLAGS_RE = re.compile(rb"\bFLAGS \(([^)]*)\)", re.IGNORECASE)
+
+
+def _imap_uid_fetch(mail, uids, batch_size: int = 50, item: str = "BODY.PEEK[]"):
+    """按批发送 UID FETCH（一条命令携带多个 UID），逐封 yield (uid, raw_bytes)"""
+    uids = list(uids)
+    for i in range(0, len(uids), batch_size):
+        batch = uids[i:i + batch_size]
+        status, data = mail.uid("fetch", ",".join(str(u) for u in batch), f"(UID {item})")
+        if status != "OK":
+            raise RuntimeError(f"IMAP UID FETCH 返回非 OK: {status}")
+        for part in data or []:
+            if not isinstance(part, tuple):
+                continue
+            m = _FETCH_UID_RE.search(part[0])
+            if m:
+                yield int(m.group(1)), part[1]
+
 
+def _imap_uid_fetch_flags(mail, uids, batch_size: int = 50, item: str = "BODY.PEEK[]"):
+    """
+    同 _imap_uid_fetch，同时 FETCH FLAGS，逐封 yield (uid, raw_bytes, seen)；
+    seen 为 None 表示响应里没有 FLAGS。服务器可能把 FLAGS 放在正文 literal 之后，此时在紧随其后的片段里
+    """
+    uids = list(uids)
+    for i in range(0, len(uids), batch_size):
+        batch = uids[i:i + batch_size]
+        status, data = mail.uid("fetch", ",".join(str(u) for u in batch), f"(UID FLAGS {item})")
+        if status != "OK":
+            raise RuntimeError(f"IMAP UID FETCH 返回非 OK: {status}")
+        current = None  # [uid, raw, flags match]
+        for part in data or []:
+            if isinstance(part, tuple):
+                if current is not None:
+                    yield current[0], current[1], current[2]
+                m = _FETCH_UID_RE.search(part[0])
+                flags = _FETCH_FLAGS_RE.search(part[0])
+                current = [int(m.group(1)), part[1], flags and b"\\seen" in flags.group(1).lower()] if m else None
+            elif current is not None and current[2] is None and isinstance(part, bytes):
+                flags = _FETCH_FLAGS_RE.search(part)
+                if flags:
+                    current[2] = b"\\seen" in flags.group(1).lower()
+        if current is not None:
+            yield current[0], current[1], current[2]
+
+
+def _session_secret(password) -> bytes:
+    return hashlib.sha256((password or "").encode("utf-8")).digest()
+
+
+class _PooledSession:
+    """IMAP / SMTP 会话池中的一个已登录连接；secret 为密码摘要，用于发现密码变更"""
+
+    __slots__ = ("conn", "secret", "last_used")
+
+    def __init__(self, conn, secret):
+        self.conn = conn
+        self.secret = secret
+        self.last_used = time.monotonic()
+
+
+class _ImapSessionPool:
+    """
+    已登录 IMAP 会话池，按 (server, port, account, mailbox) 复用连接：
+    - 复用前若空闲超过 IMAP_POOL_NOOP_INTERVAL 秒，先发 NOOP 探活，失败则丢弃重连
+    - 空闲超过 IMAP_POOL_IDLE_TIMEOUT 秒的会话会被淘汰（LOGOUT）
+    - 每个账号同时占用的连接数不超过 IMAP_POOL_MAX_PER_ACCOUNT
+    - 密码变更后旧会话不会被复用（按密码摘要比对）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._limits = {}
+
+    def _limit_for(self, server, port, account):
+        key = (server, port, account)
+        with self._lock:
+            sem = self._limits.get(key)
+            if sem is None:
+                sem = threading.BoundedSemaphore(IMAP_POOL_MAX_PER_ACCOUNT)
+                self._limits[key] = sem
+            return sem
+
+    def _evict_idle_locked(self, now):
+        expired = []
+        for key in list(self._idle):
+            alive = []
+            for sess in self._idle[key]:
+                if now - sess.last_used > IMAP_POOL_IDLE_TIMEOUT:
+                    expired.append(sess)
+                else:
+                    alive.append(sess)
+            if alive:
+                self._idle[key] = alive
+            else:
+                del self._idle[key]
+        return expired
+
+    def _connect(self, server, port, account, password, mailbox):
+        mail = imaplib.IMAP4_SSL(server, port)
+        try:
+            mail.login(account, password)
+            status, _ = mail.select(mailbox)
+            if status != "OK":
+                raise RuntimeError(f"IMAP SELECT {mailbox} 返回非 OK: {status}")
+        except Exception:
+            _imap_logout_quietly(mail)
+            raise
+        # SELECT 的 UIDVALIDITY 只在连接建立时返回一次，记录在连接上供解析缓存使用
+        mail.uidvalidity = _imap_selected_uidvalidity(mail)
+        return mail
+
+    def _checkout(self, key, password):
+        secret = _session_secret(password)
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                expired = self._evict_idle_locked(now)
+                idle = self._idle.get(key)
+                sess = idle.pop() if idle else None
+            for old in expired:
+                _imap_logout_quietly(old.conn)
+            if sess is None:
+                server, port, account, mailbox = key
+                return _PooledSession(self._connect(server, port, account, password, mailbox), secret)
+            if not hmac.compare_digest(sess.secret, secret):
+                _imap_logout_quietly(sess.conn)
+                continue
+            if now - sess.last_used > IMAP_POOL_NOOP_INTERVAL:
+                try:
+                    status, _ = sess.conn.noop()
+                except Exception:
+                    status = None
+                if status != "OK":
+                    _imap_logout_quietly(sess.conn)
+                    continue
+            return sess
+
+    def _checkin(self, key, sess):
+        sess.last_used = time.monotonic()
+        with self._lock:
+            self._idle.setdefault(key, []).append(sess)
+
+    @contextmanager
+    def session(self, server, port, account, password, mailbox):
+        """借出一个已 SELECT 好 mailbox 的连接；with 块内抛异常时连接被丢弃而不是归还"""
+        port = int(port)
+        sem = self._limit_for(server, port, account)
+        if not sem.acquire(timeout=IMAP_POOL_ACQUIRE_TIMEOUT):
+            raise RuntimeError(f"IMAP 并发连接数已达上限（{IMAP_POOL_MAX_PER_ACCOUNT}），请稍后重试")
+        key = (server, port, account, mailbox)
+        sess = None
+        try:
+            sess = self._checkout(key, password)
+            yield sess.conn
+            self._checkin(key, sess)
+            sess = None
+        finally:
+            if sess is not None:
+                _imap_logout_quietly(sess.conn)
+            sem.release()
+
+    def close_all(self):
+        with self._lock:
+            sessions = [sess for idle in self._idle.values() for sess in idle]
+            self._idle.clear()
+        for sess in sessions:
+            _imap_logout_quietly(sess.conn)
+
+
+_imap_pool = _ImapSessionPool()
+
+
+def _imap_call(imap_server, imap_port, email_account, email_password, mailbox, op):
+    """
+    在池化连接上执行 op(mail)。
+    复用的连接可能已被服务器断开（abort / socket 错误），此时丢弃该连接并用新连接重试一次。
+    """
+    for attempt in range(2):
+        try:
+            with _imap_pool.session(imap_server, imap_port, email_account, email_password, mailbox) as mail:
+                return op(mail)
+        except (imaplib.IMAP4.abort, OSError):
+            if attempt:
+                raise
+
+
+def receive_emails_imap(email_account, email_password, imap_server, imap_port, receive_number=20, mailbox="inbox", unread_only=False, today_only=False, max_body_chars=None, body_mode="full", fields=None):
+    """
+    body_mode / max_body_chars 见 _mail_body_mode；body_mode="none" 时只 FETCH 邮件头，"snippet" 时正文只部分 FETCH（_mail_fetch_snippet）。
+    fields 为 _mail_fields 解析后的字段元组，None 返回全部字段。
+    """
+    n = _as_int(receive_number, 20)
+    body_chars = _mail_body_mode(body_mode, max_body_chars)
+    # 摘要模式只 FETCH 邮件头，正文开头用部分 FETCH 单独拉取（见 _mail_fetch_snippet）
+    snippet = bool(body_chars) and str(body_mode or "").strip().lower().startswith("snippet")
+    if n <= 0:
+        n = 1
+    if n > 200:
+        n = 200
+
+    # 如果启用 today_only，获取香港时区的今天日期
+    today_str = None
+    if today_only:
+        today_str = hk_today()
+
+    # 支持选择不同的邮箱文件夹，默认 inbox
+    mailbox_name = str(mailbox).strip() if mailbox else "inbox"
+
+    def _op(mail):
+        result = []
         # 更简单、稳定的"最新在前"实现：UID SEARCH + 本地按 UID 倒序取前 N 封
         # - 不依赖服务器 SORT 扩展（很多服务器不支持，会 BAD/NO）
         # - UID 可能不连续（删除/服务器分配策略），但通常单调递增；数字越大越新
@@ -469,87 +1162,549 @@ def receive_emails_imap(email_account, email_password, imap_server, imap_port, r
 
         uids = (data[0] or b"").split()
         if not uids:
-            return {"result": []}
+            return result
 
         # 如果启用 today_only，需要获取更多邮件以便过滤（最多 500 封）
         # 否则只取前 n 封
         max_fetch = 500 if today_only else n
-        latest_uids = sorted(uids, key=lambda x: int(x), reverse=True)[:max_fetch]
+        latest_uids = sorted((int(x) for x in uids), reverse=True)[:max_fetch]
+
+        # 解析缓存以 (账号, 文件夹, UIDVALIDITY) 为前缀；同一 UIDVALIDITY 内 UID 对应的邮件不会变
+        uidvalidity = getattr(mail, "uidvalidity", None)
+        cache_key = (email_account, mailbox_name, uidvalidity) if uidvalidity is not None else None
+
+        # 分批处理：每批只对缓存未命中的 UID 发一条 UID FETCH；today_only 凑够 n 封即停止
+        # today_only 跳过的邮件先收集起来，最后一次性 STORE 标记为未读
+        skipped = []
+        for start in range(0, len(latest_uids), MAIL_FETCH_BATCH):
+            window = latest_uids[start:start + MAIL_FETCH_BATCH]
+            # today_only 时先只解析邮件头，确认是今天的邮件再解码正文；不要正文时只 FETCH 邮件头
+            entries = _mail_fetch_parsed(
+                mail, cache_key, window,
+                with_body=bool(body_chars) and not today_only,
+                headers_only=not body_chars or snippet,
+            )
+            for uid in window:
+                if uid not in entries:
+                    continue
+                parsed, msg = entries[uid]
+                mail_date_hongkong = parsed["day"]
+
+                # 如果启用 today_only，需要判断日期
+                if today_only and today_str:
+                    if mail_date_hongkong != today_str:
+                        # 无法解析日期或不是今天的邮件，标记为未读并跳过
+                        skipped.append(uid)
+                        continue
+                    # 是今天的邮件，继续处理（不改变已读状态）
+
+                if body_chars and parsed["body"] is None:
+                    if snippet:
+                        parsed = _mail_fetch_snippet(mail, uid, parsed, body_chars)
+                    else:
+                        parsed = _mail_fill_body(mail, cache_key, uid, parsed, msg)
+                    if parsed is None:
+                        continue
+                result.append(_mail_result_item(uid, parsed, body_chars, fields))
 
-        for uid in latest_uids:
-            # 使用 BODY.PEEK[] 而不是 RFC822，避免标记邮件为已读
-            status, msg_data = mail.uid("fetch", uid, "(BODY.PEEK[])")
-            if status != "OK" or not msg_data or not msg_data[0]:
+                # 如果启用 today_only，已经收集到足够的今天邮件，可以提前结束
+                if today_only and len(result) >= n:
+                    break
+            else:
                 continue
+            break
 
-            msg = email.message_from_bytes(msg_data[0][1])
-            subject = _decode_mime_header(msg.get("Subject"))
-            from_addr = _decode_mime_header(msg.get("From"))
-            date_header = _decode_mime_header(msg.get("Date"))
-            date_iso = _parse_mail_date_to_iso(date_header) if date_header else None
-            
-            # 将 date 字段也转换为香港时区格式
-            date_hongkong = None
-            mail_date_hongkong = None
-            if date_header:
-                try:
-                    dt = parsedate_to_datetime(date_header)
-                    if dt:
-                        if dt.tzinfo is None:
-                            dt = pytz.UTC.localize(dt)
-                        hongkong_tz = pytz.timezone("Asia/Hong_Kong")
-                        dt_hongkong = dt.astimezone(hongkong_tz)
-                        mail_date_hongkong = dt_hongkong.date()
-                        # 格式化为 RFC 2822 格式
-                        date_hongkong = dt_hongkong.strftime("%a, %d %b %Y %H:%M:%S %z")
-                except Exception:
-                    pass
-            
-            # 如果启用 today_only，需要判断日期
-            if today_only and today_date:
-                if not mail_date_hongkong:
-                    # 如果无法解析日期，标记为未读并跳过
-                    try:
-                        mail.uid("store", uid, "-FLAGS", "\\Seen")
-                    except Exception:
-                        pass
-                    continue
-                if mail_date_hongkong != today_date:
-                    # 不是今天的邮件，标记为未读并跳过
-                    try:
-                        mail.uid("store", uid, "-FLAGS", "\\Seen")
-                    except Exception:
-                        pass
-                    continue
-                # 是今天的邮件，继续处理（不改变已读状态）
-            
-            body = _extract_mail_body_plain(msg)
-
-            result.append(
-                {
-                    "id": uid.decode(errors="ignore") if isinstance(uid, (bytes, bytearray)) else str(uid),
-                    "from": from_addr,
-                    "subject": subject,
-                    "date": date_hongkong if date_hongkong else date_header,
-                    "date_iso": date_iso,
-                    "body": body,
-                }
-            )
-            
-            # 如果启用 today_only，已经收集到足够的今天邮件，可以提前结束
-            if today_only and len(result) >= n:
-                break
+        if skipped:
+            try:
+                _imap_remove_seen(mail, skipped)
+            except imaplib.IMAP4.abort:
+                raise
+            except Exception:
+                pass
+        return result
+
+    try:
+        result = _imap_call(imap_server, imap_port, email_account, email_password, mailbox_name, _op)
     except imaplib.IMAP4.error as e:
         raise RuntimeError(f"IMAP 登录/读取失败: {str(e)}") from e
     except Exception as e:
         raise RuntimeError(f"IMAP 读取失败: {str(e)}") from e
+    return {"result": result}
+
+
+# ==========================
+# 本地邮件缓存（SQLite）
+# ==========================
+# 由 mail_idle_watcher.py 通过 IMAP IDLE 实时写入，/mail/receive_from_db 直接读取，
+# 避免每次轮询都连 IMAP 拉取 + 解析整批邮件。
+# - mail_messages: 已解析的邮件，UID 仅在同一 UIDVALIDITY 内有效，因此作为主键的一部分
+# - mail_sync_state: 每个 (账号, 文件夹) 的同步进度与 watcher 心跳；心跳过期则回退直连 IMAP
+MAIL_CACHE_DB_PATH = _env_str("MAIL_CACHE_DB_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "mail_cache.sqlite3"
+)
+MAIL_CACHE_MAX_STALENESS = _env_int("MAIL_CACHE_MAX_STALENESS") or 180  # 秒
+
+_MAIL_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mail_messages (
+    email_account TEXT NOT NULL,
+    mailbox TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    from_addr TEXT,
+    subject TEXT,
+    date TEXT,
+    date_iso TEXT,
+    day TEXT,
+    body TEXT,
+    body_truncated INTEGER NOT NULL DEFAULT 0,
+    seen INTEGER NOT NULL DEFAULT 0,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (email_account, mailbox, uidvalidity, uid)
+);
+CREATE TABLE IF NOT EXISTS mail_sync_state (
+    email_account TEXT NOT NULL,
+    mailbox TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    last_uid INTEGER NOT NULL DEFAULT 0,
+    heartbeat_at REAL NOT NULL,
+    PRIMARY KEY (email_account, mailbox)
+);
+"""
+
+
+_mail_cache_initialized = set()  # 本进程已建表（并切换为 WAL）的缓存库路径
+
+
+def _mail_cache_conn(create: bool = False):
+    """
+    打开缓存库；create=False 且文件不存在时返回 None（未部署 watcher）。
+    create=True 时每个路径在本进程内只执行一次建表与 WAL 设置（WAL 模式持久化在库文件中）
+    """
+    path = MAIL_CACHE_DB_PATH
+    exists = os.path.exists(path)
+    if not create and not exists:
+        return None
+    conn = sqlite3.connect(path, timeout=10)
+    conn.row_factory = sqlite3.Row
+    if create and (path not in _mail_cache_initialized or not exists):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_MAIL_CACHE_SCHEMA)
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(mail_messages)")}
+        if "body_truncated" not in columns:
+            # 旧版缓存库没有 body_truncated 列
+            conn.execute("ALTER TABLE mail_messages ADD COLUMN body_truncated INTEGER NOT NULL DEFAULT 0")
+        _mail_cache_initialized.add(path)
+    return conn
+
+
+def _mail_cache_put_messages(conn, email_account, mailbox, uidvalidity, items):
+    """items: [(uid, parsed, seen)]，parsed 为 _parse_mail_message 的结果"""
+    now = time.time()
+    conn.executemany(
+        "INSERT OR REPLACE INTO mail_messages "
+        "(email_account, mailbox, uidvalidity, uid, from_addr, subject, date, date_iso, day, body, body_truncated, "
+        "seen, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (email_account, mailbox, uidvalidity, int(uid), p.get("from"), p.get("subject"), p.get("date"),
+             p.get("date_iso"), p.get("day"), p.get("body"), 1 if p.get("body_truncated") else 0,
+             1 if seen else 0, now)
+            for uid, p, seen in items
+        ],
+    )
+
+
+def _mail_cache_row_parsed(row) -> dict:
+    """mail_messages 的一行还原为 _parse_mail_message 的结构"""
+    return {
+        "from": row["from_addr"],
+        "subject": row["subject"],
+        "date": row["date"],
+        "date_iso": row["date_iso"],
+        "body": row["body"],
+        "body_truncated": bool(row["body_truncated"]),
+        "day": row["day"],
+    }
+
+
+def _mail_cache_receive(email_account, mailbox="inbox", receive_number=20, unread_only=False, today_only=False,
+                        max_body_chars=None, body_mode="full", fields=None):
+    """
+    从本地缓存读取邮件，返回结构与 receive_emails_imap 一致。
+    缓存不存在、该账号未被 watcher 同步或心跳过期时返回 None，由调用方回退到 IMAP。
+    /mail/receive 的只取邮件头结果也写入同一张表（body 为 NULL），需要正文时遇到这样的行同样返回 None，
+    不能当作空正文返回。
+    """
+    conn = _mail_cache_conn()
+    if conn is None:
+        return None
+    try:
+        n = min(max(_as_int(receive_number, 20), 1), 200)
+        mailbox_name = str(mailbox).strip() if mailbox else "inbox"
+        state = conn.execute(
+            "SELECT uidvalidity, heartbeat_at FROM mail_sync_state WHERE email_account=? AND mailbox=?",
+            (email_account, mailbox_name),
+        ).fetchone()
+        if state is None or time.time() - state["heartbeat_at"] > MAIL_CACHE_MAX_STALENESS:
+            return None
+
+        conditions = ["email_account=?", "mailbox=?", "uidvalidity=?"]
+        params = [email_account, mailbox_name, state["uidvalidity"]]
+        if unread_only:
+            conditions.append("seen=0")
+        if today_only:
+            conditions.append("day=?")
+            params.append(hk_today())
+        body_chars = _mail_body_mode(body_mode, max_body_chars)
+        # 不要正文时不读 body 列
+        body_column = "body" if body_chars else "NULL AS body"
+        rows = conn.execute(
+            f"SELECT uid, from_addr, subject, date, date_iso, day, {body_column}, body_truncated FROM mail_messages "
+            f"WHERE {' AND '.join(conditions)} ORDER BY uid DESC LIMIT ?",
+            tuple(params) + (n,),
+        ).fetchall()
+        if body_chars and any(row["body"] is None for row in rows):
+            return None
+        result = [_mail_result_item(row["uid"], _mail_cache_row_parsed(row), body_chars, fields) for row in rows]
+        return {"result": result}
+    except sqlite3.Error:
+        return None
     finally:
-        if mail:
+        conn.close()
+
+
+# --- 已解析邮件缓存配置 ---
+# 两级缓存：进程内 LRU + 上面的 SQLite mail_messages 表（与 watcher 共用）
+# 重复 /mail/receive 时复用已解析结果，只对新 UID 发 FETCH
+MAIL_PARSED_CACHE_SIZE = _env_int("MAIL_PARSED_CACHE_SIZE") or 2000  # 进程内最多缓存的邮件数
+MAIL_CACHE_MAX_PER_MAILBOX = _env_int("MAIL_CACHE_MAX_PER_MAILBOX") or 5000  # 磁盘上每个文件夹保留的最新邮件数
+MAIL_FETCH_BATCH = _env_int("MAIL_FETCH_BATCH") or 20  # 每条 UID FETCH 携带的 UID 数
+
+
+class _ParsedMailCache:
+    """
+    已解析邮件缓存，键为 (email_account, mailbox, uidvalidity, uid)，值为 _parse_mail_message 的结果。
+    body 为 None 表示只解析过邮件头（today_only 跳过的邮件），需要正文时视为未命中。
+    磁盘读写失败只会退化为未命中，不影响收信。
+    """
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, k, parsed):
+        with self._lock:
+            self._lru[k] = parsed
+            self._lru.move_to_end(k)
+            while len(self._lru) > self._capacity:
+                self._lru.popitem(last=False)
+
+    def get_many(self, key, uids) -> dict:
+        found = {}
+        missing = []
+        with self._lock:
+            for uid in uids:
+                parsed = self._lru.get(key + (uid,))
+                if parsed is None:
+                    missing.append(uid)
+                else:
+                    self._lru.move_to_end(key + (uid,))
+                    found[uid] = parsed
+        if not missing:
+            return found
+
+        conn = _mail_cache_conn()
+        if conn is None:
+            return found
+        try:
+            placeholders = ", ".join(["?"] * len(missing))
+            rows = conn.execute(
+                f"SELECT uid, from_addr, subject, date, date_iso, day, body, body_truncated FROM mail_messages "
+                f"WHERE email_account=? AND mailbox=? AND uidvalidity=? AND uid IN ({placeholders})",
+                tuple(key) + tuple(missing),
+            ).fetchall()
+        except sqlite3.Error:
+            rows = []
+        finally:
+            conn.close()
+        for row in rows:
+            parsed = _mail_cache_row_parsed(row)
+            self._remember(key + (row["uid"],), parsed)
+            found[row["uid"]] = parsed
+        return found
+
+    def put_many(self, key, items, seen=None):
+        """
+        items: [(uid, parsed)]；已存在的行保留原有正文（不会被只有邮件头的结果覆盖）。
+        seen: {uid: bool}，来自 FETCH FLAGS 的真实已读状态，会覆盖已有行；不在其中的 UID 新行记为未读、已有行不改
+        """
+        if not items:
+            return
+        for uid, parsed in items:
+            self._remember(key + (uid,), parsed)
+        try:
+            conn = _mail_cache_conn(create=True)
+        except sqlite3.Error:
+            return
+        try:
+            email_account, mailbox, uidvalidity = key
+            now = time.time()
+            seen = seen or {}
+            sql = (
+                "INSERT INTO mail_messages "
+                "(email_account, mailbox, uidvalidity, uid, from_addr, subject, date, date_iso, day, body, "
+                "body_truncated, seen, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (email_account, mailbox, uidvalidity, uid) DO UPDATE SET "
+                "body_truncated = CASE WHEN excluded.body IS NULL THEN mail_messages.body_truncated "
+                "ELSE excluded.body_truncated END, "
+                "body = COALESCE(excluded.body, mail_messages.body), fetched_at = excluded.fetched_at"
+            )
+            for known in (True, False):
+                rows = [
+                    (email_account, mailbox, uidvalidity, uid, p.get("from"), p.get("subject"), p.get("date"),
+                     p.get("date_iso"), p.get("day"), p.get("body"), 1 if p.get("body_truncated") else 0,
+                     1 if seen.get(uid) else 0, now)
+                    for uid, p in items if (seen.get(uid) is not None) == known
+                ]
+                if rows:
+                    conn.executemany(sql + (", seen = excluded.seen" if known else ""), rows)
+            # 控制磁盘占用：UIDVALIDITY 变化后的旧数据直接删除，每个文件夹只保留最新的若干封
+            conn.execute(
+                "DELETE FROM mail_messages WHERE email_account=? AND mailbox=? AND uidvalidity<>?",
+                (email_account, mailbox, uidvalidity),
+            )
+            conn.execute(
+                "DELETE FROM mail_messages WHERE email_account=? AND mailbox=? AND uidvalidity=? AND uid < ("
+                "SELECT MIN(uid) FROM (SELECT uid FROM mail_messages WHERE email_account=? AND mailbox=? "
+                "AND uidvalidity=? ORDER BY uid DESC LIMIT ?))",
+                (email_account, mailbox, uidvalidity, email_account, mailbox, uidvalidity, MAIL_CACHE_MAX_PER_MAILBOX),
+            )
+            conn.commit()
+        except sqlite3.Error:
+            pass
+        finally:
+            conn.close()
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+
+
+_mail_parsed_cache = _ParsedMailCache(MAIL_PARSED_CACHE_SIZE)
+
+
+def _mail_fetch_parsed(mail, cache_key, uids, with_body: bool = True, headers_only: bool = False) -> dict:
+    """
+    批量获取已解析邮件：先查解析缓存，只对未命中（或需要正文但缓存里只有邮件头）的 UID 发 FETCH。
+    返回 {uid: (parsed, msg)}；msg 仅在本次新拉取完整邮件时非 None，便于之后补解析正文而不必重新 FETCH。
+    headers_only=True 时只 FETCH MAIL_HEADER_FETCH_ITEM（隐含 with_body=False）。
+    """
+    if headers_only:
+        with_body = False
+    out = {}
+    cached = _mail_parsed_cache.get_many(cache_key, uids) if cache_key else {}
+    missing = []
+    for uid in uids:
+        parsed = cached.get(uid)
+        if parsed is not None and (parsed["body"] is not None or not with_body):
+            out[uid] = (parsed, None)
+        else:
+            missing.append(uid)
+
+    fetched = []
+    seen = {}
+    item = MAIL_HEADER_FETCH_ITEM if headers_only else "BODY.PEEK[]"
+    # 顺带 FETCH FLAGS：写入与 watcher 共用的缓存表时记录真实的已读状态
+    for uid, raw, is_seen in _imap_uid_fetch_flags(mail, missing, batch_size=MAIL_FETCH_BATCH, item=item):
+        msg = email.message_from_bytes(raw)
+        parsed = _parse_mail_message(msg, with_body=with_body)
+        out[uid] = (parsed, None if headers_only else msg)
+        fetched.append((uid, parsed))
+        seen[uid] = is_seen
+    if cache_key:
+        _mail_parsed_cache.put_many(cache_key, fetched, seen=seen)
+    return out
+
+
+def _mail_fill_body(mail, cache_key, uid, parsed, msg):
+    """为只解析过邮件头的结果补上正文；msg 为 None 时（来自缓存）重新 FETCH 该封"""
+    if msg is None:
+        refetched = _mail_fetch_parsed(mail, cache_key, [uid], with_body=True)
+        return refetched[uid][0] if uid in refetched else None
+    sender = (parseaddr(parsed.get("from") or "")[1] or "").lower() or None
+    body, body_truncated = _extract_mail_body_plain(msg, sender=sender)
+    parsed = dict(parsed, body=body, body_truncated=body_truncated)
+    if cache_key:
+        _mail_parsed_cache.put_many(cache_key, [(uid, parsed)])
+    return parsed
+
+
+# --- SMTP 会话池配置 ---
+# 复用已登录的 SMTP 连接（TLS 握手 + AUTH 只做一次），多封邮件在同一会话上连续发送
+SMTP_POOL_IDLE_TIMEOUT = _env_int("SMTP_POOL_IDLE_TIMEOUT") or 120  # Exchange 默认会断开长时间空闲的 SMTP 连接
+SMTP_POOL_NOOP_INTERVAL = _env_int("SMTP_POOL_NOOP_INTERVAL") or 30  # 复用前空闲超过该秒数先 NOOP 探活
+SMTP_POOL_MAX_PER_ACCOUNT = _env_int("SMTP_POOL_MAX_PER_ACCOUNT") or 2  # 每个账号同时占用的连接上限
+SMTP_TIMEOUT = _env_int("SMTP_TIMEOUT") or 20
+
+
+def _smtp_quit_quietly(server):
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
+
+
+class _SmtpSessionPool:
+    """
+    已登录 SMTP 会话池，按 (server, port, security, account) 复用连接，策略与 _ImapSessionPool 相同：
+    空闲超时淘汰、复用前 NOOP 探活、每账号并发上限、密码变更后不复用旧会话。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._limits = {}
+
+    def _limit_for(self, key):
+        with self._lock:
+            sem = self._limits.get(key)
+            if sem is None:
+                sem = threading.BoundedSemaphore(SMTP_POOL_MAX_PER_ACCOUNT)
+                self._limits[key] = sem
+            return sem
+
+    def _connect(self, server, port, security, account, password):
+        if security == "ssl":
+            conn = smtplib.SMTP_SSL(server, port, timeout=SMTP_TIMEOUT)
+        else:
+            conn = smtplib.SMTP(server, port, timeout=SMTP_TIMEOUT)
+        try:
+            conn.ehlo()
+            if security == "starttls":
+                # 兼容部分服务器：先 ehlo 再 starttls 再 ehlo
+                conn.starttls()
+                conn.ehlo()
+            conn.login(account, password)
+        except Exception:
+            _smtp_quit_quietly(conn)
+            raise
+        return conn
+
+    def _checkout(self, key, password):
+        secret = _session_secret(password)
+        while True:
+            now = time.monotonic()
+            expired = []
+            with self._lock:
+                for k in list(self._idle):
+                    alive = [s for s in self._idle[k] if now - s.last_used <= SMTP_POOL_IDLE_TIMEOUT]
+                    expired.extend(s for s in self._idle[k] if now - s.last_used > SMTP_POOL_IDLE_TIMEOUT)
+                    if alive:
+                        self._idle[k] = alive
+                    else:
+                        del self._idle[k]
+                idle = self._idle.get(key)
+                sess = idle.pop() if idle else None
+            for old in expired:
+                _smtp_quit_quietly(old.conn)
+            if sess is None:
+                server, port, security, account = key
+                return _PooledSession(self._connect(server, port, security, account, password), secret)
+            if not hmac.compare_digest(sess.secret, secret):
+                _smtp_quit_quietly(sess.conn)
+                continue
+            if now - sess.last_used > SMTP_POOL_NOOP_INTERVAL:
+                try:
+                    code, _ = sess.conn.noop()
+                except Exception:
+                    code = None
+                if code != 250:
+                    _smtp_quit_quietly(sess.conn)
+                    continue
+            return sess
+
+    @contextmanager
+    def session(self, server, port, security, account, password):
+        """借出一个已登录的 SMTP 连接；with 块内抛异常时连接被丢弃而不是归还"""
+        key = (server, int(port), security, account)
+        sem = self._limit_for(key)
+        if not sem.acquire(timeout=IMAP_POOL_ACQUIRE_TIMEOUT):
+            raise RuntimeError(f"SMTP 并发连接数已达上限（{SMTP_POOL_MAX_PER_ACCOUNT}），请稍后重试")
+        sess = None
+        try:
+            sess = self._checkout(key, password)
             try:
-                mail.logout()
-            except Exception:
-                pass
-    return {"result": result}
+                yield sess.conn
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as e:
+                # 单封邮件被拒时 sendmail 已发送 RSET，连接可继续使用；421 表示服务器即将关闭连接
+                if getattr(e, "smtp_code", None) != 421:
+                    self._checkin(key, sess)
+                    sess = None
+                raise
+            self._checkin(key, sess)
+            sess = None
+        finally:
+            if sess is not None:
+                _smtp_quit_quietly(sess.conn)
+            sem.release()
+
+    def _checkin(self, key, sess):
+        sess.last_used = time.monotonic()
+        with self._lock:
+            self._idle.setdefault(key, []).append(sess)
+
+    def close_all(self):
+        with self._lock:
+            sessions = [sess for idle in self._idle.values() for sess in idle]
+            self._idle.clear()
+        for sess in sessions:
+            _smtp_quit_quietly(sess.conn)
+
+
+_smtp_pool = _SmtpSessionPool()
+
+
+def _smtp_call(smtp_server, smtp_port, smtp_security, email_account, email_password, op):
+    """
+    在池化连接上执行 op(server)。
+    复用的连接可能已被服务器断开，此时丢弃该连接并用新连接重试一次。
+    投递语义是“至少一次”：断开若发生在 DATA 结束符已发出、250 回复尚未收到之间，服务器可能已经接收该邮件，
+    重试会重复投递。空闲连接多在发送前的探活/MAIL FROM 阶段断开，这种情况重试是安全的。
+    """
+    security = _parse_smtp_security(smtp_security, int(smtp_port))
+    for attempt in range(2):
+        try:
+            with _smtp_pool.session(smtp_server, smtp_port, security, email_account, email_password) as server:
+                return op(server)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            if attempt:
+                raise
+
+
+def _smtp_error_is_transient(e: Exception) -> bool:
+    """连接中断、超时、4xx（含 Exchange 的 421/451/452 限流）视为可重试；5xx 与认证失败不重试"""
+    if isinstance(e, (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)):
+        return True
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    return False
+
+
+def _build_mail_mime(email_account, to_email, subject, content, content_type="text/plain") -> str:
+    msg = mime_multipart.MIMEMultipart("alternative")
+    msg["From"] = Header(email_account, "utf-8")
+    msg["To"] = Header(to_email, "utf-8")
+    msg["Subject"] = Header(subject or "", "utf-8")
+
+    ctype = "plain" if (content_type or "").lower() in ("text/plain", "plain") else "html"
+    part = mime_text.MIMEText(content or "", ctype, "utf-8")
+    msg.attach(part)
+    return msg.as_string()
 
 
 def send_email_smtp(
@@ -565,37 +1720,330 @@ def send_email_smtp(
 ):
     """
     SMTP 发送邮件（邮箱+密码登录），支持 text/plain 或 text/html。
+    连接来自 _smtp_pool，连续发信不再每封都重新握手登录。
     """
     try:
-        msg = MIMEMultipart("alternative")
-        msg["From"] = Header(email_account, "utf-8")
-        msg["To"] = Header(to_email, "utf-8")
-        msg["Subject"] = Header(subject or "", "utf-8")
-
-        ctype = "plain" if (content_type or "").lower() in ("text/plain", "plain") else "html"
-        part = MIMEText(content or "", ctype, "utf-8")
-        msg.attach(part)
-
-        security = _parse_smtp_security(smtp_security, int(smtp_port))
-        if security == "ssl":
-            with smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=20) as server:
-                server.ehlo()
-                server.login(email_account, email_password)
-                server.sendmail(email_account, [to_email], msg.as_string())
-        else:
-            with smtplib.SMTP(smtp_server, smtp_port, timeout=20) as server:
-                server.ehlo()
-                if security == "starttls":
-                    # 兼容部分服务器：先 ehlo 再 starttls 再 ehlo
-                    server.starttls()
-                    server.ehlo()
-                server.login(email_account, email_password)
-                server.sendmail(email_account, [to_email], msg.as_string())
+        raw = _build_mail_mime(email_account, to_email, subject, content, content_type)
+        _smtp_call(smtp_server, smtp_port, smtp_security, email_account, email_password,
+                   lambda server: server.sendmail(email_account, [to_email], raw))
         return {"ok": True}
     except Exception as e:
         raise RuntimeError(f"SMTP 发送失败: {str(e)}") from e
 
 
+# ==========================
+# 发信队列（SQLite）
+# ==========================
+# /mail/send（queued=true）与 /mail/send_batch 只把邮件写入本地队列并立即返回 message_id，
+# 后台投递线程按账号限流、限并发地通过 _smtp_pool 发送，SMTP 慢或暂时不可用时接口耗时不受影响。
+# - 队列持久化在 SQLite，进程重启后未完成的邮件继续投递（至少一次）
+# - 密码加密存储（encrypt_password），投递完成后清除
+# - 限流与并发按进程计算；多进程部署时各进程共享队列（领取是原子的），限额按进程数分摊配置
+# - 领取时记录租约（owner_pid, claimed_at）。进程启动时只收回本 pid 遗留的、或超过 MAIL_OUTBOX_LEASE_TIMEOUT 的租约，
+#   不会把其他存活进程正在发送的邮件放回队列；之后每小时清理时也会收回超时租约（进程崩溃的情况）
+MAIL_OUTBOX_DB_PATH = _env_str("MAIL_OUTBOX_DB_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "mail_outbox.sqlite3"
+)
+MAIL_OUTBOX_WORKERS = _env_int("MAIL_OUTBOX_WORKERS") or 4  # 投递线程数
+MAIL_OUTBOX_ACCOUNT_CONCURRENCY = _env_int("MAIL_OUTBOX_ACCOUNT_CONCURRENCY") or 1  # 每个账号同时投递的邮件数
+MAIL_OUTBOX_RATE_PER_MINUTE = _env_int("MAIL_OUTBOX_RATE_PER_MINUTE") or 30  # 每个账号每分钟最多发送数（Exchange 默认 MessageRateLimit）
+MAIL_OUTBOX_MAX_ATTEMPTS = _env_int("MAIL_OUTBOX_MAX_ATTEMPTS") or 3  # 每封邮件最多尝试次数（仅临时错误重试）
+MAIL_OUTBOX_RETRY_BASE = _env_int("MAIL_OUTBOX_RETRY_BASE") or 30  # 重试退避基数（秒），第 n 次重试等待 base * 2^(n-1)
+MAIL_OUTBOX_POLL_INTERVAL = 1.0  # 没有可投递邮件时的轮询间隔（秒）
+MAIL_OUTBOX_RETENTION = _env_int("MAIL_OUTBOX_RETENTION") or 7 * 86400  # 已完成邮件的状态保留秒数
+MAIL_OUTBOX_BATCH_MAX_MESSAGES = _env_int("MAIL_OUTBOX_BATCH_MAX_MESSAGES") or 500  # /mail/send_batch 单批最多邮件数
+MAIL_OUTBOX_LEASE_TIMEOUT = _env_int("MAIL_OUTBOX_LEASE_TIMEOUT") or 600  # 投递中的邮件超过该秒数未完成视为进程已退出，重新入队
+
+_MAIL_OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mail_outbox (
+    message_id TEXT PRIMARY KEY,
+    batch_id TEXT,
+    email_account TEXT NOT NULL,
+    encrypted_password TEXT,
+    smtp_server TEXT NOT NULL,
+    smtp_port INTEGER NOT NULL,
+    smtp_security TEXT,
+    to_addr TEXT NOT NULL,
+    subject TEXT,
+    content TEXT,
+    content_type TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    sent_at REAL,
+    owner_pid INTEGER,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_mail_outbox_due ON mail_outbox (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_mail_outbox_batch ON mail_outbox (batch_id);
+"""
+
+_MAIL_OUTBOX_STATUS_COLUMNS = (
+    "message_id, batch_id, email_account, to_addr, subject, status, attempts, last_error, "
+    "created_at, updated_at, sent_at"
+)
+
+
+def _mail_outbox_conn():
+    conn = sqlite3.connect(MAIL_OUTBOX_DB_PATH, timeout=10, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_MAIL_OUTBOX_SCHEMA)
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(mail_outbox)")}
+    for column, ddl in (("owner_pid", "INTEGER"), ("claimed_at", "REAL")):
+        if column not in columns:  # 旧版本建的表没有租约列
+            conn.execute(f"ALTER TABLE mail_outbox ADD COLUMN {column} {ddl}")
+    return conn
+
+
+def _mail_outbox_status_item(row) -> dict:
+    return {
+        "message_id": row["message_id"],
+        "batch_id": row["batch_id"],
+        "email_account": row["email_account"],
+        "to": row["to_addr"],
+        "subject": row["subject"],
+        "status": row["status"],
+        "attempts": row["attempts"],
+        "error": row["last_error"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+        "sent_at": row["sent_at"],
+    }
+
+
+class _AccountRateLimiter:
+    """按账号的令牌桶：容量与每分钟速率相同，允许短时突发，长期不超过 rate_per_minute"""
+
+    def __init__(self, rate_per_minute: int):
+        self._rate = float(rate_per_minute)
+        self._buckets = {}
+
+    def try_acquire(self, account, now) -> bool:
+        tokens, last = self._buckets.get(account, (self._rate, now))
+        tokens = min(self._rate, tokens + (now - last) * self._rate / 60.0)
+        if tokens < 1:
+            self._buckets[account] = (tokens, now)
+            return False
+        self._buckets[account] = (tokens - 1, now)
+        return True
+
+
+class _MailOutbox:
+    """发信队列：enqueue 写入 SQLite 后唤醒投递线程；投递线程领取到期邮件，受账号并发与速率限制"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._workers = []
+        self._in_flight = {}
+        self._limiter = None
+        self._last_cleanup = 0.0
+        self._recovered_pid = None
+
+    def start(self):
+        """进程启动时调用：收回本进程上次退出时遗留的租约与超时租约，再启动投递线程（幂等）"""
+        with self._lock:
+            if self._recovered_pid != os.getpid():
+                conn = _mail_outbox_conn()
+                try:
+                    self._requeue_stale(conn, own_pid=True)
+                finally:
+                    conn.close()
+                self._recovered_pid = os.getpid()
+        self._ensure_workers()
+
+    def _requeue_stale(self, conn, own_pid: bool = False) -> int:
+        """把超时（或 own_pid 时属于本 pid）的投递中邮件放回队列；不动其他存活进程的租约"""
+        cutoff = time.time() - MAIL_OUTBOX_LEASE_TIMEOUT
+        return conn.execute(
+            "UPDATE mail_outbox SET status='queued', owner_pid=NULL, claimed_at=NULL "
+            "WHERE status='sending' AND (COALESCE(claimed_at, updated_at)<? OR owner_pid=?)",
+            (cutoff, os.getpid() if own_pid else -1),
+        ).rowcount
+
+    def _ensure_workers(self):
+        """启动投递线程（幂等），不收回租约"""
+        with self._lock:
+            if any(w.is_alive() for w in self._workers):
+                return
+            self._stopping.clear()
+            self._limiter = _AccountRateLimiter(MAIL_OUTBOX_RATE_PER_MINUTE)
+            self._workers = [
+                threading.Thread(target=self._run, name=f"mail-outbox-{i}", daemon=True)
+                for i in range(MAIL_OUTBOX_WORKERS)
+            ]
+            for w in self._workers:
+                w.start()
+
+    def stop(self, timeout: float = 5.0):
+        """停止投递线程（正在发送的邮件会发完）"""
+        self._stopping.set()
+        self._wakeup.set()
+        for w in self._workers:
+            w.join(timeout)
+        self._workers = []
+
+    def enqueue(self, account: dict, messages: list, batch_id: Optional[str] = None) -> list:
+        """
+        account: email_account / email_password / smtp_server / smtp_port / smtp_security
+        messages: [{to, subject, content, content_type}]，返回对应的 message_id 列表
+        """
+        now = time.time()
+        encrypted_pwd = encrypt_password(account["email_password"])
+        rows = []
+        for m in messages:
+            rows.append((
+                uuid.uuid4().hex, batch_id, account["email_account"], encrypted_pwd, account["smtp_server"],
+                int(account["smtp_port"]), account.get("smtp_security"), m["to"], m.get("subject") or "",
+                m.get("content") or "", m.get("content_type") or "text/plain", now, now, now,
+            ))
+        conn = _mail_outbox_conn()
+        try:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO mail_outbox (message_id, batch_id, email_account, encrypted_password, smtp_server, "
+                "smtp_port, smtp_security, to_addr, subject, content, content_type, next_attempt_at, created_at, "
+                "updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        self._ensure_workers()
+        self._wakeup.set()
+        return [r[0] for r in rows]
+
+    def status(self, message_ids=None, batch_id=None) -> list:
+        conn = _mail_outbox_conn()
+        try:
+            if batch_id:
+                rows = conn.execute(
+                    f"SELECT {_MAIL_OUTBOX_STATUS_COLUMNS} FROM mail_outbox WHERE batch_id=? ORDER BY created_at, rowid",
+                    (batch_id,),
+                ).fetchall()
+            else:
+                ids = list(message_ids or [])
+                placeholders = ", ".join(["?"] * len(ids))
+                rows = conn.execute(
+                    f"SELECT {_MAIL_OUTBOX_STATUS_COLUMNS} FROM mail_outbox WHERE message_id IN ({placeholders})",
+                    tuple(ids),
+                ).fetchall() if ids else []
+                order = {mid: i for i, mid in enumerate(ids)}
+                rows = sorted(rows, key=lambda r: order[r["message_id"]])
+        finally:
+            conn.close()
+        return [_mail_outbox_status_item(r) for r in rows]
+
+    def _claim(self, conn):
+        """
+        原子地领取一封到期邮件（标记为 sending 并记录租约）。每个账号只取最早到期的一封作为候选，
+        大批量账号不会占满候选、挡住其他账号；受账号并发与速率限制的账号留给之后的轮次
+        """
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            candidates = conn.execute(
+                "SELECT * FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY email_account "
+                "ORDER BY next_attempt_at, created_at, rowid) AS account_rank "
+                "FROM mail_outbox WHERE status='queued' AND next_attempt_at<=?) "
+                "WHERE account_rank=1 ORDER BY next_attempt_at, created_at",
+                (now,),
+            ).fetchall()
+            with self._lock:
+                for row in candidates:
+                    account = row["email_account"]
+                    if self._in_flight.get(account, 0) >= MAIL_OUTBOX_ACCOUNT_CONCURRENCY:
+                        continue
+                    if not self._limiter.try_acquire(account, now):
+                        continue
+                    self._in_flight[account] = self._in_flight.get(account, 0) + 1
+                    conn.execute(
+                        "UPDATE mail_outbox SET status='sending', attempts=attempts+1, owner_pid=?, claimed_at=?, "
+                        "updated_at=? WHERE message_id=?",
+                        (os.getpid(), now, now, row["message_id"]),
+                    )
+                    conn.execute("COMMIT")
+                    return row
+            conn.execute("COMMIT")
+            return None
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _deliver(self, conn, row):
+        attempts = row["attempts"] + 1
+        try:
+            password = decrypt_password(row["encrypted_password"])
+            raw = _build_mail_mime(row["email_account"], row["to_addr"], row["subject"], row["content"],
+                                   row["content_type"])
+            _smtp_call(row["smtp_server"], row["smtp_port"], row["smtp_security"], row["email_account"], password,
+                       lambda server: server.sendmail(row["email_account"], [row["to_addr"]], raw))
+        except Exception as e:
+            now = time.time()
+            if _smtp_error_is_transient(e) and attempts < MAIL_OUTBOX_MAX_ATTEMPTS:
+                conn.execute(
+                    "UPDATE mail_outbox SET status='queued', last_error=?, next_attempt_at=?, updated_at=?, "
+                    "owner_pid=NULL, claimed_at=NULL WHERE message_id=?",
+                    (str(e), now + MAIL_OUTBOX_RETRY_BASE * 2 ** (attempts - 1), now, row["message_id"]),
+                )
+            else:
+                conn.execute(
+                    "UPDATE mail_outbox SET status='failed', last_error=?, encrypted_password=NULL, updated_at=?, "
+                    "owner_pid=NULL, claimed_at=NULL WHERE message_id=?",
+                    (str(e), now, row["message_id"]),
+                )
+            return
+        now = time.time()
+        conn.execute(
+            "UPDATE mail_outbox SET status='sent', last_error=NULL, encrypted_password=NULL, sent_at=?, updated_at=?, "
+            "owner_pid=NULL, claimed_at=NULL WHERE message_id=?",
+            (now, now, row["message_id"]),
+        )
+
+    def _cleanup(self, conn):
+        now = time.time()
+        if now - self._last_cleanup < 3600:
+            return
+        self._last_cleanup = now
+        self._requeue_stale(conn)
+        conn.execute(
+            "DELETE FROM mail_outbox WHERE status IN ('sent', 'failed') AND updated_at<?",
+            (now - MAIL_OUTBOX_RETENTION,),
+        )
+
+    def _run(self):
+        while not self._stopping.is_set():
+            row = None
+            try:
+                conn = _mail_outbox_conn()
+                try:
+                    self._cleanup(conn)
+                    row = self._claim(conn)
+                    if row is not None:
+                        self._deliver(conn, row)
+                finally:
+                    conn.close()
+            except Exception as e:
+                print(f"[mail_outbox] 投递线程异常: {e}")
+            finally:
+                if row is not None:
+                    with self._lock:
+                        self._in_flight[row["email_account"]] -= 1
+                    # 同账号的下一封可能正在等并发名额
+                    self._wakeup.set()
+            if row is None:
+                self._wakeup.wait(MAIL_OUTBOX_POLL_INTERVAL)
+                self._wakeup.clear()
+
+
+_mail_outbox = _MailOutbox()
+
+
 def mark_emails_unread_imap(
     email_account,
     email_password,
@@ -608,47 +2056,689 @@ def mark_emails_unread_imap(
     将指定邮件标记为未读
     - email_uids: 邮件 UID 列表（字符串或整数列表）
     - mailbox: 邮箱文件夹，默认 inbox
+    - 返回 results：每个 UID 的结果（ok / invalid_uid / not_found / store_failed）
     """
-    mail = None
-    try:
-        mail = imaplib.IMAP4_SSL(imap_server, imap_port)
-        mail.login(email_account, email_password)
-        
-        mailbox_name = str(mailbox).strip() if mailbox else "inbox"
-        mail.select(mailbox_name)
-        
-        # 处理 UID 列表
-        if isinstance(email_uids, str):
-            uid_list = [uid.strip() for uid in email_uids.split(",")]
-        elif isinstance(email_uids, list):
-            uid_list = [str(uid) for uid in email_uids]
-        else:
-            uid_list = [str(email_uids)]
-        
-        # 移除 \Seen 标志（标记为未读）
-        # 使用 -FLAGS 来移除标志
-        marked_count = 0
+    mailbox_name = str(mailbox).strip() if mailbox else "inbox"
+
+    # 处理 UID 列表
+    if isinstance(email_uids, str):
+        uid_list = [uid.strip() for uid in email_uids.split(",")]
+    elif isinstance(email_uids, list):
+        uid_list = [str(uid).strip() for uid in email_uids]
+    else:
+        uid_list = [str(email_uids).strip()]
+
+    def _op(mail):
+        # 先用一条 UID SEARCH 确认哪些 UID 存在，再按压缩后的 UID 集合批量 STORE -FLAGS.SILENT (\Seen)
+        # 数百封邮件只需一两次往返，同时仍能给出每个 UID 的结果
+        valid = [int(uid) for uid in uid_list if uid.isdigit()]
+        existing = set()
+        for uid_set, _ in _imap_uid_sets(valid):
+            status, data = mail.uid("search", None, "UID", uid_set)
+            if status != "OK":
+                raise RuntimeError(f"IMAP UID SEARCH 返回非 OK: {status}")
+            existing.update(int(x) for x in (data[0] or b"").split())
+        marked = _imap_remove_seen(mail, existing) if existing else set()
+
+        results = []
         for uid in uid_list:
-            try:
-                # 移除 \Seen 标志
-                status, response = mail.uid("store", uid, "-FLAGS", "\\Seen")
-                if status == "OK":
-                    marked_count += 1
-            except Exception as e:
-                # 单个邮件失败不影响其他邮件
-                continue
-        
-        return {"ok": True, "marked_count": marked_count, "total": len(uid_list)}
+            if not uid.isdigit():
+                results.append({"uid": uid, "ok": False, "error": "invalid_uid"})
+            elif int(uid) not in existing:
+                results.append({"uid": uid, "ok": False, "error": "not_found"})
+            elif int(uid) not in marked:
+                results.append({"uid": uid, "ok": False, "error": "store_failed"})
+            else:
+                results.append({"uid": uid, "ok": True})
+        return results
+
+    try:
+        results = _imap_call(imap_server, imap_port, email_account, email_password, mailbox_name, _op)
+        marked_count = sum(1 for r in results if r["ok"])
+        return {"ok": True, "marked_count": marked_count, "total": len(uid_list), "results": results}
     except imaplib.IMAP4.error as e:
         raise RuntimeError(f"IMAP 操作失败: {str(e)}") from e
     except Exception as e:
         raise RuntimeError(f"标记邮件为未读失败: {str(e)}") from e
-    finally:
-        if mail:
+
+
+# ==========================
+# 邮箱凭据缓存
+# ==========================
+# /mail/*_from_db 每次调用都要 SELECT email_accounts 并逐个 Fernet 解密；凭据很少变化，进程内按 TTL 缓存：
+# - 账号列表（账号 + 密文）缓存 MAIL_CREDENTIAL_CACHE_TTL 秒，命中时不查库
+# - 解密后的密码只存在内存，用 bytearray 保存，过期/淘汰/失效时先清零再丢弃；按密文匹配，密文变化即视为未命中
+# - 本进程内 create/update/delete email_account 会立即失效；其他进程的修改最多延迟一个 TTL 生效
+# 注意：返回给调用方的 str 无法清零，清零只针对缓存自身持有的副本。
+MAIL_CREDENTIAL_CACHE_TTL = _env_int("MAIL_CREDENTIAL_CACHE_TTL") or 300  # 秒
+MAIL_CREDENTIAL_CACHE_SIZE = _env_int("MAIL_CREDENTIAL_CACHE_SIZE") or 256  # 最多缓存的解密密码数
+
+
+def _zeroize(buf: bytearray) -> None:
+    buf[:] = bytes(len(buf))
+
+
+class _CredentialCache:
+    def __init__(self, ttl: int = MAIL_CREDENTIAL_CACHE_TTL, max_size: int = MAIL_CREDENTIAL_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._rows = {}  # email_account 或 None（全部账号）→ (rows, expires_at)
+        self._secrets = OrderedDict()  # email_account → (encrypted_password, bytearray, expires_at)
+        # 每次失效 +1；查询开始后发生过失效的结果不写回缓存，避免把旧数据放回去
+        self._generation = 0
+
+    def accounts(self, email_account: Optional[str] = None) -> list:
+        """返回 email_accounts 行 [{email_account, encrypted_password}]；email_account 为空时返回全部账号"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._rows.get(email_account)
+            if cached is not None and cached[1] > now:
+                return [dict(row) for row in cached[0]]
+            generation = self._generation
+
+        if email_account:
+            sql = f"SELECT `email_account`, `encrypted_password` FROM `{EMAIL_ACCOUNT_TABLE}` WHERE `email_account`=%s"
+            rows = execute_query(sql, (email_account,), fetch=True)
+        else:
+            sql = f"SELECT `email_account`, `encrypted_password` FROM `{EMAIL_ACCOUNT_TABLE}` ORDER BY `id`"
+            rows = execute_query(sql, (), fetch=True)
+        rows = [
+            {"email_account": row.get("email_account"), "encrypted_password": row.get("encrypted_password")}
+            for row in rows or []
+        ]
+        with self._lock:
+            if generation == self._generation:
+                self._rows[email_account] = (rows, time.monotonic() + self.ttl)
+        return [dict(row) for row in rows]
+
+    def password(self, email_account: str, encrypted_password: str) -> str:
+        """解密密码；同一账号、同一密文在 TTL 内只解密一次"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._secrets.get(email_account)
+            if cached is not None:
+                if cached[0] == encrypted_password and cached[2] > now:
+                    self._secrets.move_to_end(email_account)
+                    return cached[1].decode("utf-8")
+                _zeroize(self._secrets.pop(email_account)[1])
+            generation = self._generation
+
+        password = decrypt_password(encrypted_password)
+        with self._lock:
+            if generation == self._generation and email_account not in self._secrets:
+                self._secrets[email_account] = (
+                    encrypted_password, bytearray(password.encode("utf-8")), time.monotonic() + self.ttl
+                )
+                while len(self._secrets) > self.max_size:
+                    _zeroize(self._secrets.popitem(last=False)[1][1])
+        return password
+
+    def invalidate(self, email_account: Optional[str] = None) -> None:
+        """email_account 为空时清空全部；账号列表（全部账号）总是一并失效"""
+        with self._lock:
+            self._generation += 1
+            if email_account:
+                self._rows.pop(email_account, None)
+                self._rows.pop(None, None)
+                entry = self._secrets.pop(email_account, None)
+                if entry is not None:
+                    _zeroize(entry[1])
+                return
+            self._rows.clear()
+            for _, secret, _ in self._secrets.values():
+                _zeroize(secret)
+            self._secrets.clear()
+
+
+_credential_cache = _CredentialCache()
+
+
+# ==========================
+# 邮件结构与按部分下载（BODYSTRUCTURE）
+# ==========================
+# /mail/parts 只 FETCH BODYSTRUCTURE 返回 MIME 结构树，调用方再按 part 编号（如 "1.2"）单独下载需要的部分，
+# 附件通过 BODY.PEEK[part]<offset.size> 分段拉取、边解码边输出，不在内存里拼出整个附件。
+MAIL_PART_CHUNK_BYTES = _env_int("MAIL_PART_CHUNK_BYTES") or 256 * 1024  # 每次分段 FETCH 的字节数（编码后）
+
+_PART_ID_RE = re.compile(r"^[1-9]\d*(\.[1-9]\d*)*$")
+
+
+def _imap_parse_sexp(raw: bytes):
+    """解析 IMAP 响应中的括号列表：NIL → None，字符串/原子 → str，列表 → list；支持 {n} literal"""
+    pos = 0
+    length = len(raw)
+
+    def parse_list():
+        nonlocal pos
+        items = []
+        while pos < length:
+            ch = raw[pos:pos + 1]
+            if ch == b")":
+                pos += 1
+                return items
+            if ch in (b" ", b"\r", b"\n"):
+                pos += 1
+            elif ch == b"(":
+                pos += 1
+                items.append(parse_list())
+            elif ch == b'"':
+                pos += 1
+                buf = bytearray()
+                while pos < length and raw[pos:pos + 1] != b'"':
+                    if raw[pos:pos + 1] == b"\\":
+                        pos += 1
+                    buf += raw[pos:pos + 1]
+                    pos += 1
+                pos += 1
+                items.append(buf.decode("utf-8", errors="replace"))
+            elif ch == b"{":
+                end = raw.index(b"}", pos)
+                size = int(raw[pos + 1:end])
+                pos = end + 1
+                if raw[pos:pos + 2] == b"\r\n":
+                    pos += 2
+                items.append(raw[pos:pos + size].decode("utf-8", errors="replace"))
+                pos += size
+            else:
+                start = pos
+                while pos < length and raw[pos:pos + 1] not in (b" ", b"(", b")", b"\r", b"\n"):
+                    pos += 1
+                atom = raw[start:pos].decode("ascii", errors="replace")
+                items.append(None if atom.upper() == "NIL" else atom)
+        return items
+
+    return parse_list()
+
+
+def _imap_fetch_response_bytes(data) -> bytes:
+    """把 imaplib 拆开的 FETCH 响应（literal 为 tuple）重新拼成一段，供 _imap_parse_sexp 解析"""
+    chunks = []
+    for item in data or []:
+        if isinstance(item, tuple):
+            chunks.append(item[0] + b"\r\n" + item[1])
+        elif isinstance(item, bytes):
+            chunks.append(item)
+    return b"".join(chunks)
+
+
+def _bodystructure_params(values) -> dict:
+    params = {}
+    if isinstance(values, list):
+        for i in range(0, len(values) - 1, 2):
+            if values[i] is not None:
+                params[str(values[i]).lower()] = values[i + 1]
+    return params
+
+
+def _bodystructure_filename(params: dict) -> Optional[str]:
+    """文件名可能是 RFC 2231（filename*=utf-8''...）或 RFC 2047（=?utf-8?B?...?=）编码"""
+    for key in ("filename", "name"):
+        if params.get(key + "*"):
+            charset, value = "utf-8", params[key + "*"]
+            if value.count("'") >= 2:
+                # charset'language'percent-encoded
+                charset, _, value = value.split("'", 2)
             try:
-                mail.logout()
-            except Exception:
+                return unquote(value, encoding=charset or "utf-8", errors="strict")
+            except (LookupError, UnicodeDecodeError):
                 pass
+        if params.get(key):
+            return _decode_mime_header(params[key])
+    return None
+
+
+def _bodystructure_node(body, part_id: Optional[str]) -> dict:
+    """把解析后的 BODYSTRUCTURE 转为接口返回的结构树节点"""
+    if body and isinstance(body[0], list):
+        # multipart: (子part)(子part)... subtype [params disposition language location]
+        children = []
+        idx = 0
+        while idx < len(body) and isinstance(body[idx], list):
+            children.append(body[idx])
+            idx += 1
+        subtype = (body[idx] if idx < len(body) else "mixed") or "mixed"
+        return {
+            "part": part_id,
+            "type": f"multipart/{subtype.lower()}",
+            "parts": [
+                _bodystructure_node(child, f"{part_id}.{i}" if part_id else str(i))
+                for i, child in enumerate(children, 1)
+            ],
+        }
+
+    maintype = (body[0] or "text").lower()
+    subtype = (body[1] or "plain").lower()
+    params = _bodystructure_params(body[2])
+    node = {
+        "part": part_id or "1",
+        "type": f"{maintype}/{subtype}",
+        "charset": params.get("charset"),
+        "content_id": body[3],
+        "encoding": (body[5] or "7bit").lower(),
+        "size": _as_int(body[6], None),
+    }
+    # 基本字段 7 个；text/* 多 lines，message/rfc822 多 envelope + body + lines
+    ext = 7
+    if maintype == "text":
+        ext = 8
+    elif maintype == "message" and subtype == "rfc822" and len(body) > 9:
+        ext = 10
+        nested = body[8]
+        if nested and isinstance(nested[0], list):
+            # 内嵌 multipart 的子 part 编号直接接在 message/rfc822 的编号后面（RFC 3501 6.4.5）
+            node["parts"] = _bodystructure_node(nested, node["part"])["parts"]
+        elif nested:
+            node["parts"] = [_bodystructure_node(nested, node["part"] + ".1")]
+    disposition = body[ext + 1] if len(body) > ext + 1 else None
+    disposition_params = {}
+    if isinstance(disposition, list) and disposition:
+        node["disposition"] = (disposition[0] or "").lower() or None
+        disposition_params = _bodystructure_params(disposition[1] if len(disposition) > 1 else None)
+    else:
+        node["disposition"] = None
+    node["filename"] = _bodystructure_filename({**params, **disposition_params})
+    return node
+
+
+def _bodystructure_find(node: dict, part_id: str) -> Optional[dict]:
+    if node.get("part") == part_id and "parts" not in node:
+        return node
+    for child in node.get("parts") or []:
+        found = _bodystructure_find(child, part_id)
+        if found is not None:
+            return found
+    # 非 multipart 的 message/rfc822 本身也可以整体下载
+    if node.get("part") == part_id:
+        return node
+    return None
+
+
+def _imap_fetch_bodystructure(mail, uid) -> Optional[dict]:
+    """在已选中文件夹的连接上 FETCH 一封邮件的 BODYSTRUCTURE，返回结构树；邮件不存在时返回 None"""
+    status, data = mail.uid("fetch", str(int(uid)), "(UID BODYSTRUCTURE)")
+    if status != "OK":
+        raise RuntimeError(f"IMAP UID FETCH BODYSTRUCTURE 返回非 OK: {status}")
+    raw = _imap_fetch_response_bytes(data)
+    marker = raw.upper().find(b"BODYSTRUCTURE")
+    if marker < 0:
+        return None
+    start = raw.find(b"(", marker)
+    parsed = _imap_parse_sexp(raw[start + 1:]) if start >= 0 else None
+    if not parsed:
+        return None
+    return _bodystructure_node(parsed, None)
+
+
+def fetch_mail_structure_imap(email_account, email_password, imap_server, imap_port, uid, mailbox="inbox"):
+    """
+    返回指定 UID 邮件的 MIME 结构树（只 FETCH BODYSTRUCTURE，不下载任何内容）。
+    邮件不存在时返回 None。
+    """
+    mailbox_name = str(mailbox).strip() if mailbox else "inbox"
+    try:
+        return _imap_call(imap_server, imap_port, email_account, email_password, mailbox_name,
+                          lambda mail: _imap_fetch_bodystructure(mail, uid))
+    except imaplib.IMAP4.error as e:
+        raise RuntimeError(f"IMAP 读取邮件结构失败: {str(e)}") from e
+
+
+class _PartDecoder:
+    """Content-Transfer-Encoding 增量解码：分段到达的数据在 base64 四字节组 / QP 行边界处续接"""
+
+    def __init__(self, encoding: str):
+        self._encoding = (encoding or "7bit").lower()
+        self._pending = b""
+
+    def feed(self, data: bytes) -> bytes:
+        if self._encoding == "base64":
+            data = self._pending + re.sub(rb"[^A-Za-z0-9+/=]", b"", data)
+            cut = len(data) - len(data) % 4
+            self._pending = data[cut:]
+            return base64.b64decode(data[:cut]) if cut else b""
+        if self._encoding == "quoted-printable":
+            data = self._pending + data
+            cut = data.rfind(b"\n") + 1
+            self._pending = data[cut:]
+            return binascii.a2b_qp(data[:cut])
+        return data
+
+    def close(self) -> bytes:
+        pending, self._pending = self._pending, b""
+        if not pending:
+            return b""
+        if self._encoding == "base64":
+            return base64.b64decode(pending + b"=" * (-len(pending) % 4))
+        if self._encoding == "quoted-printable":
+            return binascii.a2b_qp(pending)
+        return pending
+
+
+def iter_mail_part_imap(email_account, email_password, imap_server, imap_port, uid, part, encoding, mailbox="inbox",
+                        chunk_size: Optional[int] = None):
+    """
+    逐段 FETCH 指定 part 并 yield 解码后的字节，内存占用与 chunk_size 同级。
+    每段单独借用池化连接，慢速下游不会长期占住 IMAP 会话。
+    """
+    mailbox_name = str(mailbox).strip() if mailbox else "inbox"
+    chunk_size = chunk_size or MAIL_PART_CHUNK_BYTES
+    uid = int(uid)
+    decoder = _PartDecoder(encoding)
+    offset = 0
+    while True:
+        item = f"BODY.PEEK[{part}]<{offset}.{chunk_size}>"
+        chunk = _imap_call(
+            imap_server, imap_port, email_account, email_password, mailbox_name,
+            lambda mail: b"".join(raw for _, raw in _imap_uid_fetch(mail, [uid], item=item)),
+        )
+        offset += len(chunk)
+        out = decoder.feed(chunk)
+        if out:
+            yield out
+        if len(chunk) < chunk_size:
+            break
+    tail = decoder.close()
+    if tail:
+        yield tail
+
+
+# --- 正文摘要（body_mode="snippet"）---
+# 摘要只需要正文开头：先 FETCH BODYSTRUCTURE 找到正文 part，再用 BODY.PEEK[part]<0.n> 只拉取开头 n 字节，
+# 不下载整封邮件和附件。n 按字数、传输编码估算；HTML 正文开头常是样式等标记，预留更多字节。
+MAIL_SNIPPET_BYTES_PER_CHAR = 4  # UTF-8 最坏情况
+MAIL_SNIPPET_HTML_EXTRA_BYTES = 16 * 1024
+
+
+def _mail_snippet_part(node: dict) -> Optional[dict]:
+    """与 _extract_mail_body_plain 的取舍一致：跳过附件，优先 text/plain，否则第一个 text/*"""
+    fallback = None
+    stack = [node]
+    while stack:
+        current = stack.pop(0)
+        if "parts" in current and current.get("type", "").startswith("multipart/"):
+            stack[:0] = current["parts"]
+            continue
+        if current.get("disposition") == "attachment" or not current.get("type", "").startswith("text/"):
+            continue
+        if current["type"] == "text/plain":
+            return current
+        if fallback is None:
+            fallback = current
+    return fallback
+
+
+def _mail_snippet_fetch_bytes(part: dict, max_chars: int) -> int:
+    size = MAIL_SNIPPET_BYTES_PER_CHAR * max_chars
+    if part["type"] == "text/html":
+        size = size * 4 + MAIL_SNIPPET_HTML_EXTRA_BYTES
+    if part["encoding"] == "base64":
+        size = size * 4 // 3 + size // 38  # 每 76 字符一个 CRLF
+    elif part["encoding"] == "quoted-printable":
+        size *= 3
+    return min(size, MAIL_PART_CHUNK_BYTES)
+
+
+def _mail_fetch_snippet(mail, uid, parsed: dict, max_chars: int) -> dict:
+    """为只有邮件头的结果补上正文前 max_chars 字（部分 FETCH，不写入解析缓存：缓存里的 body 表示完整正文）"""
+    structure = _imap_fetch_bodystructure(mail, uid)
+    part = _mail_snippet_part(structure) if structure else None
+    if part is None:
+        return dict(parsed, body="", body_truncated=False)
+    fetch_bytes = _mail_snippet_fetch_bytes(part, max_chars)
+    item = f"BODY.PEEK[{part['part']}]<0.{fetch_bytes}>"
+    chunk = b"".join(raw for _, raw in _imap_uid_fetch(mail, [uid], item=item))
+    decoder = _PartDecoder(part["encoding"])
+    payload = decoder.feed(chunk) + decoder.close()
+    sender = (parseaddr(parsed.get("from") or "")[1] or "").lower() or None
+    text = _decode_payload_smart(payload, part.get("charset"), sender=sender)
+    if part["type"] == "text/html":
+        body, truncated = _html_to_text(text, max_chars)
+    else:
+        body, truncated = _truncate_text(text, max_chars)
+    partial = len(chunk) >= fetch_bytes and (part.get("size") is None or part["size"] > fetch_bytes)
+    return dict(parsed, body=body, body_truncated=truncated or partial)
+
+
+# --- 已处理邮件内存索引配置 ---
+# /email_everyday/check 每批邮件都会调用；用进程内索引回答大部分“是否已处理”，只有可能命中时才查 MySQL
+HANDLED_BLOOM_CAPACITY = _env_int("HANDLED_BLOOM_CAPACITY") or 200000  # 每个账号 Bloom filter 按此数量设计（超出后误判率上升，仍然正确）
+HANDLED_BLOOM_FP_RATE = 0.01
+HANDLED_RECENT_SIZE = _env_int("HANDLED_RECENT_SIZE") or 5000  # 每个账号精确记住的最近 UID 数（含 received_time）
+HANDLED_SYNC_INTERVAL = _env_int("HANDLED_SYNC_INTERVAL") or 5  # 增量同步间隔（秒），覆盖其他进程写入的记录
+HANDLED_SYNC_OVERLAP = _env_int("HANDLED_SYNC_OVERLAP") or 60  # 增量同步回看窗口（秒）：并发事务的自增 id 可能晚于更大的 id 提交
+EMAIL_EVERYDAY_RETENTION_DAYS = _env_int("EMAIL_EVERYDAY_RETENTION_DAYS") or 90  # 保留期（email_everyday_maintenance.py 清理更早的记录）
+HANDLED_WARMUP_PAGE = 10000  # 预热时每页读取的行数（按 id 翻页）
+
+
+class _BloomFilter:
+    """定长 Bloom filter，k 个位置由 blake2b 摘要的两段做 double hashing 得到"""
+
+    def __init__(self, capacity: int, fp_rate: float):
+        capacity = max(capacity, 1)
+        self._bits_count = max(int(-capacity * math.log(fp_rate) / (math.log(2) ** 2)), 64)
+        self._hashes = max(int(round(self._bits_count / capacity * math.log(2))), 1)
+        self._bits = bytearray((self._bits_count + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self._hashes):
+            yield (h1 + i * h2) % self._bits_count
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class _HandledMailIndex:
+    """
+    email_everyday 的进程内索引，每个账号一个 Bloom filter + 最近 HANDLED_RECENT_SIZE 个 UID 的精确表：
+    - Bloom 判定不存在 → 一定未处理，不查库
+    - 在精确表中 → 已处理，received_time 直接返回
+    - 其余（可能命中）、索引里没有的账号、以及早于保留期可能已被清理的记录 → 查 MySQL 确认
+    预热完成前（ready=False）或增量同步失败时，调用方应全部查库。
+    其他进程写入的记录通过按 id 的增量同步在 HANDLED_SYNC_INTERVAL 秒内可见；每次同步从 HANDLED_SYNC_OVERLAP 秒前的
+    last_id 开始重读，晚提交的较小 id 不会被跳过。
+    账号按 MySQL _ci 排序规则的比较方式归一（忽略大小写与尾部空格）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._blooms = {}
+        self._recent = {}
+        self._last_id = 0
+        self._last_sync = 0.0
+        self._checkpoints = deque()  # (monotonic, last_id)，用于确定回看窗口的起点
+        self.ready = False
+
+    @staticmethod
+    def _account_key(email_account) -> str:
+        return str(email_account).rstrip().lower()
+
+    def _add_locked(self, email_account, email_id, received_time):
+        email_account = self._account_key(email_account)
+        bloom = self._blooms.get(email_account)
+        if bloom is None:
+            bloom = self._blooms[email_account] = _BloomFilter(HANDLED_BLOOM_CAPACITY, HANDLED_BLOOM_FP_RATE)
+            self._recent[email_account] = OrderedDict()
+        bloom.add(email_id)
+        recent = self._recent[email_account]
+        recent[email_id] = received_time
+        recent.move_to_end(email_id)
+        while len(recent) > HANDLED_RECENT_SIZE:
+            recent.popitem(last=False)
+
+    def _load_rows(self, rows):
+        with self._lock:
+            for row in rows:
+                self._add_locked(row["email_account"], str(row["email_id"]), row["received_time"])
+                self._last_id = max(self._last_id, row["id"])
+
+    def _fetch_after(self, last_id):
+        return execute_query(
+            f"SELECT `id`, `email_account`, `email_id`, `received_time` FROM `{EMAIL_EVERYDAY_TABLE}` "
+            f"WHERE `id` > %s ORDER BY `id` LIMIT {HANDLED_WARMUP_PAGE}",
+            (last_id,),
+            fetch=True,
+        )
+
+    def _catch_up(self, from_id=None):
+        last_id = self._last_id if from_id is None else from_id
+        while True:
+            rows = self._fetch_after(last_id)
+            self._load_rows(rows)
+            if len(rows) < HANDLED_WARMUP_PAGE:
+                return
+            last_id = rows[-1]["id"]
+
+    def _overlap_floor(self) -> int:
+        """返回 HANDLED_SYNC_OVERLAP 秒前的 last_id，增量同步从这里开始重读（已读过的行重复加入无副作用）"""
+        now = time.monotonic()
+        self._checkpoints.append((now, self._last_id))
+        while len(self._checkpoints) > 1 and self._checkpoints[1][0] <= now - HANDLED_SYNC_OVERLAP:
+            self._checkpoints.popleft()
+        return self._checkpoints[0][1]
+
+    def warm_up(self):
+        """按 id 翻页读入整张 email_everyday；启动时在后台线程调用"""
+        with self._sync_lock:
+            started = time.perf_counter()
+            self._catch_up()
+            self._last_sync = time.monotonic()
+            self.ready = True
+        print(f"已处理邮件索引预热完成：{len(self._blooms)} 个账号，耗时 {time.perf_counter() - started:.2f}s")
+
+    def sync(self) -> bool:
+        """距上次同步超过 HANDLED_SYNC_INTERVAL 秒时读入新增记录；索引不可用时返回 False"""
+        if not self.ready:
+            return False
+        if time.monotonic() - self._last_sync < HANDLED_SYNC_INTERVAL:
+            return True
+        with self._sync_lock:
+            if time.monotonic() - self._last_sync < HANDLED_SYNC_INTERVAL:
+                return True
+            try:
+                self._catch_up(self._overlap_floor())
+            except Exception as e:
+                print(f"已处理邮件索引增量同步失败: {e}")
+                return False
+            self._last_sync = time.monotonic()
+            return True
+
+    def add(self, email_account, email_ids, received_time):
+        with self._lock:
+            for email_id in email_ids:
+                self._add_locked(email_account, str(email_id), received_time)
+
+    def classify(self, email_account, email_ids):
+        """
+        返回 (known, maybe)：known 为精确表中的 {email_id: received_time}，maybe 为需要查库确认的 UID。
+        保留期清理在另一个进程里删除记录，精确表不会收到通知；received_time 早于清理截止时间的条目可能已被删除，
+        交给查库确认
+        """
+        prune_cutoff = (hk_now() - timedelta(days=EMAIL_EVERYDAY_RETENTION_DAYS)).replace(
+            hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+        known = {}
+        maybe = []
+        with self._lock:
+            key = self._account_key(email_account)
+            bloom = self._blooms.get(key)
+            if bloom is None:
+                # 索引里没有该账号（或写法不同）时不能断定未处理
+                return known, list(email_ids)
+            recent = self._recent.get(key) or {}
+            for email_id in email_ids:
+                if email_id in recent:
+                    received_time = recent[email_id]
+                    if isinstance(received_time, datetime) and received_time < prune_cutoff:
+                        maybe.append(email_id)
+                    else:
+                        known[email_id] = received_time
+                elif email_id in bloom:
+                    maybe.append(email_id)
+        return known, maybe
+
+
+_handled_index = _HandledMailIndex()
+
+
+def _email_everyday_lookup(cur, email_account, uids) -> dict:
+    """查询哪些 UID 已在 email_everyday 中，返回 {email_id: received_time}；IN 列表按 EMAIL_EVERYDAY_BATCH_SIZE 分批"""
+    found = {}
+    uids = list(uids)
+    for i in range(0, len(uids), EMAIL_EVERYDAY_BATCH_SIZE):
+        chunk = uids[i:i + EMAIL_EVERYDAY_BATCH_SIZE]
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cur.execute(
+            f"SELECT `email_id`, `received_time` FROM `{EMAIL_EVERYDAY_TABLE}` "
+            f"WHERE `email_account`=%s AND `email_id` IN ({placeholders})",
+            (email_account, *chunk),
+        )
+        for row in cur.fetchall():
+            found[row["email_id"]] = row["received_time"]
+    return found
+
+
+# email_everyday 依赖的索引：名称 → 列（已有以相同列开头的索引时不重复创建）
+# - (email_account, email_id)：/email_everyday/check 与 add_read_ids 的 IN 查询
+# - (received_time)：/email_everyday 分页排序与保留期清理（InnoDB 二级索引隐含主键 id）
+EMAIL_EVERYDAY_INDEXES = {
+    "idx_email_everyday_account_email": ("email_account", "email_id"),
+    "idx_email_everyday_received": ("received_time",),
+}
+
+
+def ensure_email_everyday_index(create: bool = True) -> list:
+    """
+    确保 email_everyday 上有 EMAIL_EVERYDAY_INDEXES 中的索引，等价 DDL：
+        ALTER TABLE `email_everyday` ADD INDEX `idx_email_everyday_account_email` (`email_account`, `email_id`);
+        ALTER TABLE `email_everyday` ADD INDEX `idx_email_everyday_received` (`received_time`);
+    返回本次新建的索引名列表；create=False 时只检查，返回缺少的索引名。
+    """
+    rows = execute_query(
+        "SELECT `INDEX_NAME`, `SEQ_IN_INDEX`, `COLUMN_NAME` FROM `information_schema`.`STATISTICS` "
+        "WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=%s ORDER BY `INDEX_NAME`, `SEQ_IN_INDEX`",
+        (EMAIL_EVERYDAY_TABLE,),
+        fetch=True,
+    )
+    indexes = {}
+    for row in rows:
+        indexes.setdefault(row["INDEX_NAME"], []).append(row["COLUMN_NAME"].lower())
+    created = []
+    for name, columns in EMAIL_EVERYDAY_INDEXES.items():
+        if any(tuple(cols[:len(columns)]) == columns for cols in indexes.values()):
+            continue
+        if create:
+            column_sql = ", ".join(f"`{c}`" for c in columns)
+            execute_query(f"ALTER TABLE `{EMAIL_EVERYDAY_TABLE}` ADD INDEX `{name}` ({column_sql})")
+        created.append(name)
+    return created
+
+
+# 表按 received_time 分区后 (email_account, email_id) 唯一键无法保留（见 email_everyday_maintenance.partition_ddl），
+# 设置为 1 时 add_read_ids 用 MySQL GET_LOCK 串行化同一账号的“查询 + 写入”，代替唯一键去重
+EMAIL_EVERYDAY_SERIALIZE_WRITES = _env_int("EMAIL_EVERYDAY_SERIALIZE_WRITES") == 1
+EMAIL_EVERYDAY_LOCK_TIMEOUT = 10  # 等待账号写锁的秒数
+
+
+def _email_everyday_lock_name(email_account) -> str:
+    """GET_LOCK 名称最长 64 字符；账号按 _ci 规则归一后取摘要"""
+    digest = hashlib.sha1(str(email_account).rstrip().lower().encode("utf-8")).hexdigest()
+    return f"{EMAIL_EVERYDAY_TABLE}:{digest}"
+
+
+def _email_uid_list(email_uids) -> list:
+    """UID 参数（逗号分隔字符串、整数或列表）转为去掉首尾空格的字符串列表，写入和查询按同一规则归一"""
+    if isinstance(email_uids, str):
+        return [uid.strip() for uid in email_uids.split(",")]
+    if isinstance(email_uids, list):
+        return [str(uid).strip() for uid in email_uids]
+    return [str(email_uids).strip()]
 
 
 def add_read_ids(email_account, email_uids):
@@ -656,47 +2746,56 @@ def add_read_ids(email_account, email_uids):
     将邮件 UID 添加到 email_everyday 表（不进行 IMAP 操作，只更新数据库）
     - email_account: 邮箱账号
     - email_uids: 邮件 UID 列表（字符串、整数或列表）
+    - 先用一条 IN 查询找出已存在的 UID，再用多行 INSERT IGNORE 写入其余 UID（均按 EMAIL_EVERYDAY_BATCH_SIZE 分批），
+      500 个 UID 只需两条语句
+    - 返回 added_uids（本次新写入）与 existing_uids（之前已存在）
+    - EMAIL_EVERYDAY_SERIALIZE_WRITES 时同一账号的写入持有 GET_LOCK 串行执行（表分区、没有唯一键时）
     """
-    import pytz
-    from datetime import datetime
-    
-    # 处理 UID 列表
-    if isinstance(email_uids, str):
-        uid_list = [uid.strip() for uid in email_uids.split(",")]
-    elif isinstance(email_uids, list):
-        uid_list = [str(uid) for uid in email_uids]
-    else:
-        uid_list = [str(email_uids)]
+    # 处理 UID 列表（去空、去重，保持顺序）
+    uid_list = list(dict.fromkeys(uid for uid in _email_uid_list(email_uids) if uid))
     
     # 获取当前时间（北京时间）
-    beijing_tz = pytz.timezone("Asia/Shanghai")
-    current_time = datetime.now(beijing_tz)
+    current_time = cst_now()
     
     # 插入到 email_everyday 表
     try:
         conn = get_conn()
-        added_count = 0
         try:
             with conn.cursor() as cur:
-                for uid in uid_list:
-                    try:
-                        # 使用 INSERT IGNORE 避免重复插入
-                        sql = f"""
-                            INSERT IGNORE INTO `{EMAIL_EVERYDAY_TABLE}` 
-                            (`email_account`, `email_id`, `received_time`) 
-                            VALUES (%s, %s, %s)
-                        """
-                        cur.execute(sql, (email_account, uid, current_time))
-                        if cur.rowcount > 0:
-                            added_count += 1
-                    except Exception as e:
-                        # 单个 UID 失败不影响其他
-                        continue
+                if EMAIL_EVERYDAY_SERIALIZE_WRITES:
+                    # 会话级锁，提交后随连接关闭释放
+                    cur.execute("SELECT GET_LOCK(%s, %s) AS `locked`",
+                                (_email_everyday_lock_name(email_account), EMAIL_EVERYDAY_LOCK_TIMEOUT))
+                    if not (cur.fetchone() or {}).get("locked"):
+                        raise RuntimeError("等待账号写锁超时")
+                existing = _email_everyday_lookup(cur, email_account, uid_list)
+                new_uids = [uid for uid in uid_list if uid not in existing]
+                added_count = 0
+                for i in range(0, len(new_uids), EMAIL_EVERYDAY_BATCH_SIZE):
+                    chunk = new_uids[i:i + EMAIL_EVERYDAY_BATCH_SIZE]
+                    # INSERT IGNORE：并发请求在查询之后抢先写入同一 UID 时不报错
+                    sql = (
+                        f"INSERT IGNORE INTO `{EMAIL_EVERYDAY_TABLE}` "
+                        f"(`email_account`, `email_id`, `received_time`) VALUES "
+                        + ", ".join(["(%s, %s, %s)"] * len(chunk))
+                    )
+                    params = []
+                    for uid in chunk:
+                        params.extend((email_account, uid, current_time))
+                    cur.execute(sql, tuple(params))
+                    added_count += max(cur.rowcount, 0)
                 conn.commit()
         finally:
             conn.close()
+        # 同步更新进程内索引（received_time 与 MySQL DATETIME 一样不带时区）
+        _handled_index.add(email_account, new_uids, current_time.replace(tzinfo=None))
         
-        return {"ok": True, "added_count": added_count, "added_uids": uid_list}
+        return {
+            "ok": True,
+            "added_count": added_count,
+            "added_uids": new_uids,
+            "existing_uids": [uid for uid in uid_list if uid in existing],
+        }
     except Exception as e:
         raise RuntimeError(f"添加 handle_ids 失败: {str(e)}") from e
 
@@ -744,6 +2843,8 @@ def mail_receive():
         unread_only = data.get("unread_only", False)
         if isinstance(unread_only, str):
             unread_only = unread_only.lower() in ("true", "1", "yes")
+        # 正文返回方式：body_mode（none / snippet:N / full）、max_body_chars、fields
+        receive_options = _mail_receive_options(data)
     except ValueError as e:
         return _json_error(str(e), 400)
 
@@ -756,6 +2857,7 @@ def mail_receive():
             receive_number=receive_number,
             mailbox=mailbox,
             unread_only=unread_only,
+            **receive_options,
         )
         return jsonify({"ok": True, **res})
     except Exception as e:
@@ -773,6 +2875,10 @@ def mail_receive_from_db():
     - unread_only 可选：是否只获取未读邮件，默认 false（全部获取）
     - mailbox 可选：指定邮箱文件夹，默认 inbox
     - today_only 可选：是否只获取今天的邮件（香港时区），默认 false（全部获取）
+    - max_body_chars 可选：正文最多返回的字符数，默认且最大为 MAIL_MAX_BODY_CHARS，截断时 body_truncated=true
+    - body_mode 可选：none（只取发件人/主题/日期，不拉取正文）/ snippet:N（正文前 N 字）/ full（默认）
+    - fields 可选：只返回这些字段（如 ["subject", "from"]），id 总是返回；不含 body 时等同 body_mode=none
+    - 若 mail_idle_watcher.py 正在同步该账号，则直接从本地缓存返回（from_cache=true）
     """
     # 隐私要求：不允许使用 URL query 传任何参数（避免进 nginx/flask 日志）
     if request.args:
@@ -808,19 +2914,13 @@ def mail_receive_from_db():
         today_only = data.get("today_only", False)
         if isinstance(today_only, str):
             today_only = today_only.lower() in ("true", "1", "yes")
+        receive_options = _mail_receive_options(data)
     except ValueError as e:
         return _json_error(str(e), 400)
 
     try:
-        # 从数据库读取邮箱账号列表
-        if email_account:
-            # 指定单个邮箱
-            sql = f"SELECT `email_account`, `encrypted_password` FROM `{EMAIL_ACCOUNT_TABLE}` WHERE `email_account`=%s"
-            accounts = execute_query(sql, (email_account,), fetch=True)
-        else:
-            # 不指定则读取所有邮箱
-            sql = f"SELECT `email_account`, `encrypted_password` FROM `{EMAIL_ACCOUNT_TABLE}` ORDER BY `id`"
-            accounts = execute_query(sql, (), fetch=True)
+        # 读取邮箱账号列表（指定 email_account 时只取该账号；走凭据缓存）
+        accounts = _credential_cache.accounts(email_account)
         
         if not accounts:
             return _json_error("未找到邮箱账号", 404, code="no_email_accounts")
@@ -836,10 +2936,23 @@ def mail_receive_from_db():
             if not acc or not encrypted_pwd:
                 errors.append({"email_account": acc, "error": "账号或密码为空"})
                 continue
+
+            # watcher 正在实时同步该账号时，直接读本地缓存，不连 IMAP
+            cached = _mail_cache_receive(
+                acc,
+                mailbox=mailbox,
+                receive_number=receive_number,
+                unread_only=unread_only,
+                today_only=today_only,
+                **receive_options,
+            )
+            if cached is not None:
+                all_results.append({"email_account": acc, "ok": True, "from_cache": True, **cached})
+                continue
             
             try:
                 # 解密密码
-                email_password = decrypt_password(encrypted_pwd)
+                email_password = _credential_cache.password(acc, encrypted_pwd)
             except Exception as e:
                 errors.append({"email_account": acc, "error": f"密码解密失败: {str(e)}"})
                 continue
@@ -855,6 +2968,7 @@ def mail_receive_from_db():
                     mailbox=mailbox,
                     unread_only=unread_only,
                     today_only=today_only,
+                    **receive_options,
                 )
                 all_results.append({
                     "email_account": acc,
@@ -880,6 +2994,26 @@ def mail_receive_from_db():
         return _json_error("收取邮件失败", 502, code="mail_receive_failed", detail=str(e))
 
 
+def _smtp_request_account(data: dict) -> dict:
+    """/mail/send* 的发信账号参数（账号、密码、服务器、端口、加密方式）"""
+    email_account = _require_str(data, "email_account")
+    email_password = _require_str(data, "email_password")
+    # 生产推荐：server/port 从环境变量读取，调用方无需传
+    smtp_server = data.get("SMTP_SERVER") or data.get("smtp_server") or DEFAULT_SMTP_SERVER
+    smtp_port = data.get("SMTP_PORT") or data.get("smtp_port") or DEFAULT_SMTP_PORT
+    if not smtp_server:
+        raise ValueError("缺少参数: SMTP_SERVER（建议用环境变量 DEFAULT_SMTP_SERVER 配置）")
+    if smtp_port is None:
+        raise ValueError("缺少参数: SMTP_PORT（建议用环境变量 DEFAULT_SMTP_PORT 配置）")
+    return {
+        "email_account": email_account,
+        "email_password": email_password,
+        "smtp_server": str(smtp_server).strip(),
+        "smtp_port": int(smtp_port),
+        "smtp_security": data.get("smtp_security") or DEFAULT_SMTP_SECURITY,  # 可选: starttls / ssl / plain
+    }
+
+
 @app.route("/mail/send", methods=["POST"])
 def mail_send():
     # 隐私要求：不允许使用 URL query 传任何参数（避免进 nginx/flask 日志）
@@ -891,17 +3025,7 @@ def mail_send():
         return _json_error("body 必须是 JSON object", 400)
 
     try:
-        email_account = _require_str(data, "email_account")
-        email_password = _require_str(data, "email_password")
-        # 生产推荐：server/port 从环境变量读取，调用方无需传
-        smtp_server = data.get("SMTP_SERVER") or data.get("smtp_server") or DEFAULT_SMTP_SERVER
-        smtp_port = data.get("SMTP_PORT") or data.get("smtp_port") or DEFAULT_SMTP_PORT
-        if not smtp_server:
-            raise ValueError("缺少参数: SMTP_SERVER（建议用环境变量 DEFAULT_SMTP_SERVER 配置）")
-        if smtp_port is None:
-            raise ValueError("缺少参数: SMTP_PORT（建议用环境变量 DEFAULT_SMTP_PORT 配置）")
-        smtp_server = str(smtp_server).strip()
-        smtp_port = int(smtp_port)
+        account = _smtp_request_account(data)
         to_email = _require_str(data, "to", aliases=["to_email", "recipient"])
     except ValueError as e:
         return _json_error(str(e), 400)
@@ -909,25 +3033,135 @@ def mail_send():
     subject = data.get("subject", "") or ""
     content = data.get("content", "") or ""
     content_type = data.get("content_type", "text/plain") or "text/plain"
-    smtp_security = data.get("smtp_security") or DEFAULT_SMTP_SECURITY  # 可选: starttls / ssl / plain
+
+    # queued=true：写入发信队列后立即返回 message_id，用 /mail/outbox/status 查询投递结果
+    queued = data.get("queued", False)
+    if isinstance(queued, str):
+        queued = queued.lower() in ("true", "1", "yes")
+    if queued:
+        try:
+            message_id = _mail_outbox.enqueue(
+                account, [{"to": to_email, "subject": subject, "content": content, "content_type": content_type}]
+            )[0]
+        except Exception as e:
+            return _json_error("邮件入队失败", 500, code="mail_enqueue_failed", detail=str(e))
+        return jsonify({"ok": True, "queued": True, "message_id": message_id}), 202
 
     try:
         res = send_email_smtp(
-            email_account=email_account,
-            email_password=email_password,
-            smtp_server=smtp_server,
-            smtp_port=smtp_port,
             to_email=to_email,
             subject=subject,
             content=content,
             content_type=content_type,
-            smtp_security=smtp_security,
+            **account,
         )
         return jsonify(res)
     except Exception as e:
         return _json_error("发送邮件失败", 502, code="mail_send_failed", detail=str(e))
 
 
+@app.route("/mail/send_batch", methods=["POST"])
+def mail_send_batch():
+    """
+    批量发信：写入发信队列后立即返回 batch_id 与每封邮件的 message_id，由投递线程复用已登录的 SMTP 会话发送
+    - 账号参数同 /mail/send
+    - messages 必填：[{to, subject, content, content_type}]，未填的 subject/content/content_type 取顶层同名字段
+    - 用 /mail/send_batch/status 查询每封邮件的状态（queued / sending / sent / failed）
+    """
+    # 隐私要求：不允许使用 URL query 传任何参数
+    if request.args:
+        return _json_error("隐私要求：/mail/send_batch 不允许使用 URL query 传参，请全部放到 JSON body", 400)
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return _json_error("body 必须是 JSON object", 400)
+
+    try:
+        account = _smtp_request_account(data)
+        raw_messages = data.get("messages")
+        if not isinstance(raw_messages, list) or not raw_messages:
+            raise ValueError("缺少参数: messages（非空数组）")
+        if len(raw_messages) > MAIL_OUTBOX_BATCH_MAX_MESSAGES:
+            raise ValueError(f"messages 最多 {MAIL_OUTBOX_BATCH_MAX_MESSAGES} 封")
+        messages = []
+        for i, m in enumerate(raw_messages):
+            if not isinstance(m, dict):
+                raise ValueError(f"messages[{i}] 必须是 JSON object")
+            try:
+                to_email = _require_str(m, "to", aliases=["to_email", "recipient"])
+            except ValueError:
+                raise ValueError(f"messages[{i}] 缺少参数: to")
+            messages.append({
+                "to": to_email,
+                "subject": m.get("subject", data.get("subject")) or "",
+                "content": m.get("content", data.get("content")) or "",
+                "content_type": m.get("content_type", data.get("content_type")) or "text/plain",
+            })
+    except ValueError as e:
+        return _json_error(str(e), 400)
+
+    batch_id = uuid.uuid4().hex
+    try:
+        message_ids = _mail_outbox.enqueue(account, messages, batch_id=batch_id)
+    except Exception as e:
+        return _json_error("邮件入队失败", 500, code="mail_enqueue_failed", detail=str(e))
+    return jsonify({"ok": True, "batch_id": batch_id, "message_ids": message_ids, "total": len(messages)}), 202
+
+
+@app.route("/mail/send_batch/status", methods=["POST"])
+def mail_send_batch_status():
+    """查询批量发信状态：body 为 {"batch_id": "..."}"""
+    if request.args:
+        return _json_error("隐私要求：/mail/send_batch/status 不允许使用 URL query 传参，请全部放到 JSON body", 400)
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return _json_error("body 必须是 JSON object", 400)
+    try:
+        batch_id = _require_str(data, "batch_id")
+    except ValueError as e:
+        return _json_error(str(e), 400)
+
+    messages = _mail_outbox.status(batch_id=batch_id)
+    if not messages:
+        return _json_error("批次不存在或已过期", 404, code="batch_not_found")
+    pending = sum(1 for m in messages if m["status"] in ("queued", "sending"))
+    return jsonify({
+        "ok": True,
+        "batch_id": batch_id,
+        "status": "done" if pending == 0 else "pending",
+        "total": len(messages),
+        "sent_count": sum(1 for m in messages if m["status"] == "sent"),
+        "failed_count": sum(1 for m in messages if m["status"] == "failed"),
+        "pending_count": pending,
+        "messages": messages,
+    })
+
+
+@app.route("/mail/outbox/status", methods=["POST"])
+def mail_outbox_status():
+    """按 message_id 查询发信队列中邮件的状态：body 为 {"message_id": "..."} 或 {"message_ids": [...]}"""
+    if request.args:
+        return _json_error("隐私要求：/mail/outbox/status 不允许使用 URL query 传参，请全部放到 JSON body", 400)
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return _json_error("body 必须是 JSON object", 400)
+    message_ids = data.get("message_ids") or data.get("message_id")
+    if isinstance(message_ids, str):
+        message_ids = [x.strip() for x in message_ids.split(",") if x.strip()]
+    if not isinstance(message_ids, list) or not message_ids:
+        return _json_error("缺少参数: message_id / message_ids", 400)
+
+    messages = _mail_outbox.status(message_ids=[str(x) for x in message_ids])
+    found = {m["message_id"] for m in messages}
+    return jsonify({
+        "ok": True,
+        "messages": messages,
+        "not_found": [str(x) for x in message_ids if str(x) not in found],
+    })
+
+
 @app.route("/mail/mark_unread", methods=["POST"])
 def mail_mark_unread():
     """
@@ -1013,17 +3247,12 @@ def mail_mark_unread_from_db():
             raise ValueError("缺少参数: email_uids")
         
         mailbox = data.get("mailbox") or data.get("folder") or "inbox"
-    except ValueError as e:
-        return _json_error(str(e), 400)
-
-    try:
-        # 从数据库读取邮箱账号列表
-        if email_account:
-            sql = f"SELECT `email_account`, `encrypted_password` FROM `{EMAIL_ACCOUNT_TABLE}` WHERE `email_account`=%s"
-            accounts = execute_query(sql, (email_account,), fetch=True)
-        else:
-            sql = f"SELECT `email_account`, `encrypted_password` FROM `{EMAIL_ACCOUNT_TABLE}` ORDER BY `id`"
-            accounts = execute_query(sql, (), fetch=True)
+    except ValueError as e:
+        return _json_error(str(e), 400)
+
+    try:
+        # 读取邮箱账号列表（指定 email_account 时只取该账号；走凭据缓存）
+        accounts = _credential_cache.accounts(email_account)
         
         if not accounts:
             return _json_error("未找到邮箱账号", 404, code="no_email_accounts")
@@ -1041,7 +3270,7 @@ def mail_mark_unread_from_db():
                 continue
             
             try:
-                email_password = decrypt_password(encrypted_pwd)
+                email_password = _credential_cache.password(acc, encrypted_pwd)
             except Exception as e:
                 errors.append({"email_account": acc, "error": f"密码解密失败: {str(e)}"})
                 continue
@@ -1077,6 +3306,131 @@ def mail_mark_unread_from_db():
         return _json_error("标记邮件为未读失败", 502, code="mail_mark_unread_failed", detail=str(e))
 
 
+def _mail_parts_request(data: dict) -> dict:
+    """/mail/parts* 的公共参数；未传 email_password 时从 email_accounts 表读取并解密"""
+    email_account = _require_str(data, "email_account")
+    imap_server = data.get("IMAP_SERVER") or data.get("imap_server") or DEFAULT_IMAP_SERVER
+    imap_port = data.get("IMAP_PORT") or data.get("imap_port") or DEFAULT_IMAP_PORT
+    if not imap_server:
+        raise ValueError("缺少参数: IMAP_SERVER（建议用环境变量 DEFAULT_IMAP_SERVER 配置）")
+    if imap_port is None:
+        raise ValueError("缺少参数: IMAP_PORT（建议用环境变量 DEFAULT_IMAP_PORT 配置）")
+    uid = str(data.get("uid") or data.get("email_uid") or "").strip()
+    if not uid.isdigit():
+        raise ValueError("缺少参数: uid（邮件 UID，数字）")
+
+    email_password = data.get("email_password")
+    if not isinstance(email_password, str) or not email_password.strip():
+        rows = _credential_cache.accounts(email_account)
+        if not rows or not rows[0].get("encrypted_password"):
+            raise LookupError("未找到邮箱账号")
+        email_password = _credential_cache.password(email_account, rows[0]["encrypted_password"])
+
+    return {
+        "email_account": email_account,
+        "email_password": email_password.strip(),
+        "imap_server": str(imap_server).strip(),
+        "imap_port": int(imap_port),
+        "uid": uid,
+        "mailbox": data.get("mailbox") or data.get("folder") or "inbox",
+    }
+
+
+@app.route("/mail/parts", methods=["POST"])
+def mail_parts():
+    """
+    返回邮件的 MIME 结构树（不下载正文和附件）
+    - email_account 必填；email_password 可选，不传则从 email_accounts 表读取
+    - uid 必填；mailbox 可选，默认 inbox
+    - 每个节点含 part 编号（如 "1.2"）、type、charset、encoding、size、disposition、filename，
+      multipart 节点含 parts；用 /mail/parts/fetch 按 part 编号下载
+    """
+    # 隐私要求：不允许使用 URL query 传任何参数
+    if request.args:
+        return _json_error("隐私要求：/mail/parts 不允许使用 URL query 传参，请全部放到 JSON body", 400)
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return _json_error("body 必须是 JSON object", 400)
+
+    try:
+        params = _mail_parts_request(data)
+    except ValueError as e:
+        return _json_error(str(e), 400)
+    except LookupError as e:
+        return _json_error(str(e), 404, code="no_email_accounts")
+    except Exception as e:
+        return _json_error("读取邮箱账号失败", 502, code="mail_account_failed", detail=str(e))
+
+    try:
+        structure = fetch_mail_structure_imap(**params)
+    except Exception as e:
+        return _json_error("读取邮件结构失败", 502, code="mail_parts_failed", detail=str(e))
+    if structure is None:
+        return _json_error("邮件不存在", 404, code="mail_not_found")
+    return jsonify({"ok": True, "uid": params["uid"], "structure": structure})
+
+
+@app.route("/mail/parts/fetch", methods=["POST"])
+def mail_parts_fetch():
+    """
+    下载邮件的单个 part（如附件交给 OCR），按 Content-Transfer-Encoding 解码后流式返回原始内容
+    - 参数同 /mail/parts，另需 part（/mail/parts 返回的编号，如 "2" 或 "1.2"）
+    - 分段 FETCH（MAIL_PART_CHUNK_BYTES），大附件不会整体读入内存
+    """
+    # 隐私要求：不允许使用 URL query 传任何参数
+    if request.args:
+        return _json_error("隐私要求：/mail/parts/fetch 不允许使用 URL query 传参，请全部放到 JSON body", 400)
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return _json_error("body 必须是 JSON object", 400)
+
+    try:
+        part = str(data.get("part") or "").strip()
+        if not _PART_ID_RE.match(part):
+            raise ValueError("缺少参数: part（如 \"1\" 或 \"1.2\"）")
+        params = _mail_parts_request(data)
+    except ValueError as e:
+        return _json_error(str(e), 400)
+    except LookupError as e:
+        return _json_error(str(e), 404, code="no_email_accounts")
+    except Exception as e:
+        return _json_error("读取邮箱账号失败", 502, code="mail_account_failed", detail=str(e))
+
+    try:
+        structure = fetch_mail_structure_imap(**params)
+        node = _bodystructure_find(structure, part) if structure is not None else None
+        if node is None:
+            return _json_error("邮件或 part 不存在", 404, code="mail_part_not_found")
+        if node["type"].startswith("multipart/"):
+            return _json_error("multipart 节点没有内容，请指定其下的 part", 400)
+        chunks = iter_mail_part_imap(part=part, encoding=node["encoding"], **params)
+        # 先取第一段：连接/权限错误在这里以 JSON 报错返回，而不是变成中断的响应体
+        first = next(chunks, b"")
+    except Exception as e:
+        return _json_error("下载邮件内容失败", 502, code="mail_part_fetch_failed", detail=str(e))
+
+    def _stream():
+        yield first
+        try:
+            yield from chunks
+        except Exception as e:
+            # 响应头已发出，只能中断连接，调用方会收到不完整的分块响应
+            print(f"/mail/parts/fetch 分段下载中断: {e}")
+            raise
+
+    mimetype = node["type"]
+    if node.get("charset") and mimetype.startswith("text/"):
+        mimetype += f"; charset={node['charset']}"
+    headers = {}
+    filename = node.get("filename")
+    if filename:
+        disposition = node.get("disposition") or "attachment"
+        headers["Content-Disposition"] = f"{disposition}; filename*=UTF-8''{quote(filename)}"
+    return Response(stream_with_context(_stream()), content_type=mimetype, headers=headers)
+
+
 @app.route("/mail/mark_read", methods=["POST"])
 def mail_mark_read():
     """
@@ -1164,23 +3518,19 @@ def create_record():
 
 
 from datetime import datetime
-import pytz
 import uuid
-from dateutil.parser import parse as date_parser
 
 
 def generate_gmt_cst_time():
     """生成当前北京时间，格式为 Fri, 10 Oct 2025 11:03:13 GMT"""
-    cst_tz = pytz.timezone("Asia/Shanghai")
-    cst_time = datetime.now(cst_tz)
-    return cst_time.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    return cst_now().strftime("%a, %d %b %Y %H:%M:%S GMT")
 
 
 def normalize_date(value):
     """解析 GMT 格式时间并返回 YYYY-MM-DD"""
     try:
         dt = datetime.strptime(value, "%a, %d %b %Y %H:%M:%S GMT")
-        dt = pytz.UTC.localize(dt)
+        dt = UTC.localize(dt)
         return dt.strftime("%Y-%m-%d")
     except ValueError:
         return None
@@ -1234,10 +3584,7 @@ def insert_one_record(data):
 
     number = int(data["number"])
     new_part = int(data.get("part_leave_number", 0) or 0)
-    hkt_tz = pytz.timezone("Asia/Hong_Kong")
-    today_str = (datetime.now(hkt_tz).strftime("%Y-%m-%d"))[:10]
-    start_time = f"{today_str} 00:00:00"
-    end_time = f"{today_str} 23:59:59"
+    today_str, start_time, end_time = hk_day_window()
 
     # 查找当天已存在的记录
     # 如果是外墙群组，需要添加 process 和 time_range 的查询条件
@@ -1319,13 +3666,14 @@ def insert_one_record(data):
 
         # 构造插入数据
         # - id 建议由数据库 AUTO_INCREMENT 生成，因此这里不再由服务端生成/传入
-        insert_fields = [f for f in FIELDS if f != "id"]
+        # - 声明过的列总是写入（未传为 NULL）；表里新增的列只有传入时才写，其余交给数据库默认值
+        insert_fields = [f for f in FIELDS if f != "id" and (f in FIELDS.declared or f in data)]
         record = {k: data.get(k) for k in insert_fields}
         record["uuid"] = data.get("uuid") or str(uuid.uuid4())
         record["xiaban"] = 1 if new_part == number else 0
 
         # 处理时间字段 - 统一使用服务器当前时间，不考虑用户传入的时间
-        record["bstudio_create_time"] = datetime.now(hkt_tz).strftime("%Y-%m-%d %H:%M:%S")
+        record["bstudio_create_time"] = hk_now().strftime("%Y-%m-%d %H:%M:%S")
 
         # 插入
         cols = ", ".join(f"`{f}`" for f in insert_fields)
@@ -1461,9 +3809,8 @@ def list_records():
 
 @app.route("/records/today", methods=["GET"])
 def get_today_records():
-    today_str = date.today().strftime("%Y-%m-%d")
-    start_time = f"{today_str} 00:00:00"
-    end_time = f"{today_str} 23:59:59"
+    # 按香港时区的“今天”，不受服务器本地时区影响
+    today_str, start_time, end_time = hk_day_window()
     filters = request.args.to_dict()
     conditions = ["`bstudio_create_time` BETWEEN %s AND %s"]
     params = [start_time, end_time]
@@ -1715,9 +4062,7 @@ def add_worker_func(data):
 
     # 3. 查询数据库是否存在记录
     # 使用当天的日期范围进行查询 +8小时
-    today_str = datetime.now(pytz.timezone('Asia/Shanghai')).strftime("%Y-%m-%d")
-    start_time = f"{today_str} 00:00:00"
-    end_time = f"{today_str} 23:59:59"
+    today_str, start_time, end_time = hk_day_window()
     # 打印时间日志用于调试
     print(f"新增工人-查询时间范围: {start_time} 至 {end_time}")
 
@@ -1917,13 +4262,122 @@ def delete_fastgpt_records():
 
 @app.route("/columns", methods=["GET"])
 def show_columns():
+    """
+    返回表的列名（来自表结构注册表，不查库）
+    - table: 表名（必填）
+    - refresh=true: 先从 information_schema 重新加载（新建表/改表结构后使用）
+    """
     table = request.args.get("table")
     if not table:
         return jsonify({"error": "请提供表名"}), 400
-    sql = f"SHOW COLUMNS FROM `{table}`"
-    rows = execute_query(sql, fetch=True)
-    return jsonify({"columns": [row["Field"] for row in rows]})
+    if str(request.args.get("refresh", "")).lower() in ("true", "1", "yes"):
+        _schema_registry.refresh()
+    columns = _schema_registry.columns(table)
+    if columns is None:
+        return jsonify({"error": f"表不存在: {table}"}), 404
+    return jsonify({"columns": columns})
+
+
+
+# --- 简繁转换配置 ---
+def convert(text: str, target: str) -> str:
+    return zhconv.convert(text, target)
+
+
+CONVERT_TARGETS = ("zh-cn", "zh-tw", "zh-hk", "zh-sg", "zh-hans", "zh-hant")
+# 机器人转换的多是楼层、判头、工序等短且高度重复的字符串，按 (text, target) 做 LRU 缓存；
+# 长文本命中率低且占内存，超过 CONVERT_CACHE_MAX_TEXT_LEN 的直接转换不进缓存
+CONVERT_CACHE_SIZE = _env_int("CONVERT_CACHE_SIZE") or 8192
+CONVERT_CACHE_MAX_TEXT_LEN = _env_int("CONVERT_CACHE_MAX_TEXT_LEN") or 256
+CONVERT_BATCH_MAX_ITEMS = _env_int("CONVERT_BATCH_MAX_ITEMS") or 1000
+
+_convert_uncached_count = 0
+
+
+@lru_cache(maxsize=CONVERT_CACHE_SIZE)
+def _convert_cached(text: str, target: str) -> str:
+    return convert(text, target)
+
+
+def _convert_text(text: str, target: str) -> str:
+    global _convert_uncached_count
+    if len(text) <= CONVERT_CACHE_MAX_TEXT_LEN:
+        return _convert_cached(text, target)
+    _convert_uncached_count += 1
+    return convert(text, target)
+
+
+# zhconv 在每个 target 第一次转换时才加载词典并构建前缀集（约几十到上百毫秒），部署/重启后首个请求会很慢；
+# 服务启动时由 startup_checks() 调用 warm_up_converters() 提前构建。pre-fork 部署在 master 进程里调用
+# （gunicorn.conf.py 的 on_starting 钩子），fork 出的 worker 以写时复制共享这些表
+_convert_warmup_report = {}
+
+
+def warm_up_converters() -> dict:
+    """为 CONVERT_TARGETS 中每个 target 构建 zhconv 转换表，返回 {target: 耗时毫秒}"""
+    report = {}
+    for target in CONVERT_TARGETS:
+        started = time.perf_counter()
+        convert("后", target)
+        report[target] = round((time.perf_counter() - started) * 1000, 1)
+    _convert_warmup_report.update(report)
+    return report
+
 
+def _convert_target(target):
+    if target not in CONVERT_TARGETS:
+        raise ValueError(f"参数 target 无效，支持的值: {', '.join(CONVERT_TARGETS)}")
+    return target
+
+
+# 流式转换（/convert?stream=true）：边读请求体边按行转换边输出，内存占用与文档大小无关。
+# 词组不会跨行，按换行切分转换结果与整篇转换一致；单行超过 CONVERT_STREAM_MAX_PENDING 时退而在标点/空白处切分
+CONVERT_STREAM_READ_BYTES = 64 * 1024
+CONVERT_STREAM_MAX_PENDING = _env_int("CONVERT_STREAM_MAX_PENDING") or 64 * 1024  # 字符
+_CONVERT_SOFT_BREAKS = "。！？；，、.!?;, \t"
+
+
+def _convert_split_point(pending: str, max_pending: int) -> int:
+    """返回 pending 中可以安全转换的前缀长度；0 表示继续等待更多输入"""
+    cut = pending.rfind("\n") + 1
+    if cut or len(pending) < max_pending:
+        return cut
+    cut = max(pending.rfind(ch) for ch in _CONVERT_SOFT_BREAKS) + 1
+    return cut or len(pending)
+
+
+def _iter_converted_chunks(raw_chunks, target: str, max_pending: int = None):
+    """把 UTF-8 字节块流转换为已转换文本块流（多字节字符跨块时由增量解码器拼接）"""
+    max_pending = max_pending or CONVERT_STREAM_MAX_PENDING
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    for raw in raw_chunks:
+        pending += decoder.decode(raw)
+        cut = _convert_split_point(pending, max_pending)
+        if cut:
+            yield convert(pending[:cut], target)
+            pending = pending[cut:]
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield convert(pending, target)
+
+
+def _convert_stream_response(target: str):
+    chunks = iter(lambda: request.stream.read(CONVERT_STREAM_READ_BYTES), b"")
+    converted = _iter_converted_chunks(chunks, target)
+    try:
+        # 先取第一段：空请求体、首段转换失败时仍能返回 JSON 错误
+        first = next(converted, None)
+    except Exception as e:
+        return _json_error("转换失败", 500, code="convert_failed", detail=str(e))
+    if first is None:
+        return _json_error("缺少文本内容", 400)
+
+    def _stream():
+        yield first
+        yield from converted
+
+    return Response(stream_with_context(_stream()), content_type="text/plain; charset=utf-8")
 
 
 @app.route("/convert", methods=["POST"])
@@ -1933,41 +4387,215 @@ def convert_text():
     接收原始文本作为 body，target 通过 query 参数或 header 指定（默认 zh-hant）
     支持的 target: zh-cn, zh-tw, zh-hk, zh-sg, zh-hans, zh-hant
     返回: {"ok": True, "result": "转换后的文本"}
+    stream=true（query 参数或 X-Stream header）时按行流式转换，直接以分块 text/plain 返回转换后的文本，
+    适合 OCR 出来的大篇 Markdown
     """
+    # 从 query 参数或 header 获取 target，默认 zh-hant
+    target = request.args.get("target") or request.headers.get("X-Target", "zh-hant")
+    try:
+        _convert_target(target)
+    except ValueError as e:
+        return _json_error(str(e), 400, code="invalid_target")
+
+    stream = request.args.get("stream") or request.headers.get("X-Stream") or ""
+    if stream.lower() in ("true", "1", "yes"):
+        return _convert_stream_response(target)
+
     # 直接读取原始文本内容
     text = request.get_data(as_text=True)
     if not text:
         return _json_error("缺少文本内容", 400)
     
-    # 从 query 参数或 header 获取 target，默认 zh-hant
-    target = request.args.get("target") or request.headers.get("X-Target", "zh-hant")
-    
-    valid_targets = ["zh-cn", "zh-tw", "zh-hk", "zh-sg", "zh-hans", "zh-hant"]
-    if target not in valid_targets:
-        return _json_error(
-            f"参数 target 无效，支持的值: {', '.join(valid_targets)}", 
-            400,
-            code="invalid_target"
-        )
-    
     try:
-        result = convert(text, target)
+        result = _convert_text(text, target)
         return jsonify({"ok": True, "result": result})
     except Exception as e:
         return _json_error("转换失败", 500, code="convert_failed", detail=str(e))
 
 
+@app.route("/convert/batch", methods=["POST"])
+def convert_batch():
+    """
+    批量中文转换
+    body: {"texts": ["3/F", "拆板", ...], "target": "zh-hant"}
+    - target 也可通过 query 参数或 X-Target header 指定，默认 zh-hant
+    - texts 最多 CONVERT_BATCH_MAX_ITEMS 条，每条必须是字符串
+    返回: {"ok": True, "target": ..., "results": [按 texts 顺序的转换结果]}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return _json_error("body 必须是 JSON object", 400)
+    texts = data.get("texts")
+    if not isinstance(texts, list) or not texts:
+        return _json_error("缺少参数: texts（字符串数组）", 400)
+    if len(texts) > CONVERT_BATCH_MAX_ITEMS:
+        return _json_error(f"texts 最多 {CONVERT_BATCH_MAX_ITEMS} 条", 400)
+    if not all(isinstance(t, str) for t in texts):
+        return _json_error("texts 中每一项都必须是字符串", 400)
+
+    target = data.get("target") or request.args.get("target") or request.headers.get("X-Target", "zh-hant")
+    try:
+        _convert_target(target)
+    except ValueError as e:
+        return _json_error(str(e), 400, code="invalid_target")
+
+    try:
+        results = [_convert_text(t, target) for t in texts]
+    except Exception as e:
+        return _json_error("转换失败", 500, code="convert_failed", detail=str(e))
+    return jsonify({"ok": True, "target": target, "results": results})
+
+
+@app.route("/convert/stats", methods=["GET"])
+def convert_stats():
+    """
+    转换缓存统计：命中/未命中次数、命中率、当前条目数；uncached 为超长未走缓存的转换次数；
+    warmup_ms 为启动预热各 target 的耗时（未预热时为 null）
+    """
+    info = _convert_cached.cache_info()
+    lookups = info.hits + info.misses
+    return jsonify({
+        "ok": True,
+        "hits": info.hits,
+        "misses": info.misses,
+        "hit_rate": round(info.hits / lookups, 4) if lookups else None,
+        "size": info.currsize,
+        "max_size": info.maxsize,
+        "uncached": _convert_uncached_count,
+        "warmup_ms": _convert_warmup_report or None,
+    })
+
+
 # ==========================
 # jiaodika 表：查询 & 更新
 # ==========================
 
 
+# jiaodika 是以读为主的参考数据，只经 create_jiaodika / update_jiaodika 写入：GET /jiaodika 从进程内快照读取，
+# 不再每次查库并序列化全部长文本列。
+# - 本进程写入后立即失效；其他进程的写入通过指纹（行数、最大 id、SUM(row_version)）发现，
+#   指纹每 JIAODIKA_SNAPSHOT_REVALIDATE 秒最多查一次，快照最长保留 JIAODIKA_SNAPSHOT_MAX_AGE 秒。
+#   row_version 每次 UPDATE 加 1（见 ensure_jiaodika_version_column）；表上还没有这一列时指纹退回用 MAX(updated_at)，
+#   updated_at 只精确到秒，同一秒内的第二次修改发现不了，其他进程最长要到 JIAODIKA_SNAPSHOT_MAX_AGE 才重新加载
+# - ETag 由指纹和查询参数计算，各进程一致；If-None-Match 命中时返回 304，不序列化
+# - 过滤在内存中按 MySQL `=` 的语义比较（见 _jiaodika_value_matches），结果与原先的 SQL 过滤一致
+JIAODIKA_SNAPSHOT_REVALIDATE = _env_int("JIAODIKA_SNAPSHOT_REVALIDATE") or 5
+JIAODIKA_SNAPSHOT_MAX_AGE = _env_int("JIAODIKA_SNAPSHOT_MAX_AGE") or 60
+JIAODIKA_PAGE_MAX = 1000
+JIAODIKA_VERSION_COLUMN = "row_version"
+_MYSQL_NUMBER_PREFIX_RE = re.compile(r"\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?")
+
+
+def _jiaodika_collation_key(value) -> str:
+    """*_ci 排序规则下的比较键：忽略大小写与尾部空格（PAD SPACE）"""
+    return str(value).rstrip().casefold()
+
+
+def _jiaodika_value_matches(value, expected) -> bool:
+    """与 MySQL `列 = 值` 一致：数值列把值按数字前缀转换后比较（'5abc' = 5，'abc' = 0），字符串列按 _ci 规则比较"""
+    if value is None:
+        return False
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        m = _MYSQL_NUMBER_PREFIX_RE.match(str(expected))
+        return float(value) == (float(m.group(0)) if m else 0.0)
+    return _jiaodika_collation_key(value) == _jiaodika_collation_key(expected)
+
+
+def ensure_jiaodika_version_column(create: bool = True) -> bool:
+    """
+    确保 jiaodika 上有修改计数列，等价 DDL：
+        ALTER TABLE `jiaodika` ADD COLUMN `row_version` BIGINT UNSIGNED NOT NULL DEFAULT 0;
+    返回是否本次新建；create=False 时只检查，返回是否缺少。
+    """
+    if JIAODIKA_VERSION_COLUMN in (_schema_registry.columns(JIAODIKA_TABLE) or ()):
+        return False
+    if not create:
+        return True
+    execute_query(
+        f"ALTER TABLE `{JIAODIKA_TABLE}` ADD COLUMN `{JIAODIKA_VERSION_COLUMN}` BIGINT UNSIGNED NOT NULL DEFAULT 0"
+    )
+    _schema_registry.refresh()
+    return True
+
+
+class _JiaodikaSnapshot:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rows = None
+        self.by_category = {}  # gongchengfenlei（_jiaodika_collation_key）→ rows，最常见的查询直接取
+        self.fingerprint = None
+        self.loaded_at = 0.0
+        self.checked_at = 0.0
+
+    def _fingerprint(self) -> str:
+        if JIAODIKA_VERSION_COLUMN in JIAODIKA_FIELDS:
+            version_sql = f"SUM(`{JIAODIKA_VERSION_COLUMN}`)"
+        else:
+            version_sql = "MAX(`updated_at`)"
+        rows = execute_query(
+            f"SELECT COUNT(*) AS `n`, MAX(`id`) AS `max_id`, {version_sql} AS `version` FROM `{JIAODIKA_TABLE}`",
+            fetch=True,
+        )
+        row = rows[0] if rows else {}
+        return f"{row.get('n')}-{row.get('max_id')}-{row.get('version')}"
+
+    def get(self):
+        """返回 (rows, by_category, fingerprint)；rows 按 id 升序，调用方不得修改"""
+        with self._lock:
+            now = time.monotonic()
+            if self.rows is not None and now - self.loaded_at < JIAODIKA_SNAPSHOT_MAX_AGE:
+                if now - self.checked_at < JIAODIKA_SNAPSHOT_REVALIDATE:
+                    return self.rows, self.by_category, self.fingerprint
+                fingerprint = self._fingerprint()
+                self.checked_at = now
+                if fingerprint == self.fingerprint:
+                    return self.rows, self.by_category, self.fingerprint
+            # 先取指纹再读数据：两者之间有写入时快照比指纹新，下次校验会再加载一次，不会漏掉写入
+            fingerprint = self._fingerprint()
+            rows = execute_query(f"SELECT * FROM `{JIAODIKA_TABLE}` ORDER BY `id`", fetch=True)
+            by_category = {}
+            for row in rows:
+                category = row.get("gongchengfenlei")
+                key = _jiaodika_collation_key(category) if category is not None else None
+                by_category.setdefault(key, []).append(row)
+            self.rows, self.by_category, self.fingerprint = rows, by_category, fingerprint
+            self.loaded_at = self.checked_at = time.monotonic()
+            return rows, by_category, fingerprint
+
+    def invalidate(self):
+        with self._lock:
+            self.rows = None
+            self.by_category = {}
+
+
+_jiaodika_snapshot = _JiaodikaSnapshot()
+
+
+def _jiaodika_fields(fields) -> list:
+    """解析 fields 参数（逗号分隔字符串或数组）；总是包含 id（分页游标需要）"""
+    if not fields:
+        return []
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    if not isinstance(fields, list):
+        raise ValueError("fields 必须是逗号分隔的字符串或数组")
+    fields = [str(f).strip() for f in fields if str(f).strip()]
+    unknown = [f for f in fields if f not in JIAODIKA_FIELDS]
+    if unknown:
+        raise ValueError(f"未知字段: {', '.join(unknown)}")
+    return ["id"] + [f for f in fields if f != "id"]
+
+
 @app.route("/jiaodika", methods=["GET"])
 def list_jiaodika():
     """
     查询 jiaodika 表
     - 支持 URL query 参数和 GET JSON body 作为过滤条件
     - 仅支持已知字段过滤（JIAODIKA_FIELDS）
+    - fields：只返回指定列（逗号分隔），如 fields=gongxu,caozuogongyi
+    - 分页：传 limit（最大 JIAODIKA_PAGE_MAX）时按 id 升序分页，还有下一页时响应头 X-Next-Cursor
+      给出游标，下次请求带 cursor 继续；不传 limit 返回全部
+    - 响应带 ETag，请求带 If-None-Match 且数据未变时返回 304
     """
     query_filters = request.args.to_dict()
     body_filters = request.get_json(silent=True) or {}
@@ -1977,38 +4605,80 @@ def list_jiaodika():
     filters = {**body_filters, **query_filters}
 
     conditions = []
-    params = []
     for k, v in filters.items():
         if k in JIAODIKA_FIELDS:
             if k == "bstudio_create_time" and v:
                 # 支持传 YYYY-MM-DD，按一天范围查
                 try:
                     dt = datetime.strptime(v[:10], "%Y-%m-%d")
-                    start = dt.strftime("%Y-%m-%d 00:00:00")
-                    end = dt.strftime("%Y-%m-%d 23:59:59")
-                    conditions.append("`bstudio_create_time` BETWEEN %s AND %s")
-                    params.extend([start, end])
+                    conditions.append((k, (dt.strftime("%Y-%m-%d 00:00:00"), dt.strftime("%Y-%m-%d 23:59:59"))))
                     continue
                 except Exception:
                     # 解析失败则按等值匹配
                     pass
-            conditions.append(f"`{k}`=%s")
-            params.append(v)
+            conditions.append((k, str(v)))
 
-    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
-    sql = f"SELECT * FROM `{JIAODIKA_TABLE}` {where} ORDER BY `id`"
-    rows = execute_query(sql, tuple(params), fetch=True)
-    return jsonify(rows)
+    try:
+        fields = _jiaodika_fields(filters.get("fields"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    limit = filters.get("limit")
+    limit = min(max(_as_int(limit, JIAODIKA_PAGE_MAX), 1), JIAODIKA_PAGE_MAX) if limit not in (None, "") else None
+    cursor = filters.get("cursor")
+    try:
+        after_id = int(cursor) if cursor not in (None, "") else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "cursor 无效"}), 400
+
+    rows, by_category, fingerprint = _jiaodika_snapshot.get()
+    params_key = json.dumps([conditions, fields, limit, after_id], ensure_ascii=False, default=str)
+    etag = hashlib.sha1(f"{fingerprint}|{params_key}".encode("utf-8")).hexdigest()[:20]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    category = dict(conditions).get("gongchengfenlei")
+    if category is not None:
+        rows = by_category.get(_jiaodika_collation_key(category), [])
+    matched = []
+    for row in rows:
+        if after_id is not None and row["id"] <= after_id:
+            continue
+        ok = True
+        for k, v in conditions:
+            value = row.get(k)
+            if isinstance(v, tuple):
+                ok = value is not None and v[0] <= str(value)[:19] <= v[1]
+            else:
+                ok = _jiaodika_value_matches(value, v)
+            if not ok:
+                break
+        if ok:
+            matched.append(row)
+            if limit is not None and len(matched) > limit:
+                break
 
+    has_more = limit is not None and len(matched) > limit
+    if has_more:
+        matched = matched[:limit]
+    if fields:
+        matched = [{f: row.get(f) for f in fields} for row in matched]
+    response = jsonify(matched)
+    response.set_etag(etag)
+    if has_more:
+        response.headers["X-Next-Cursor"] = str(matched[-1]["id"])
+    return response
 
-def _insert_one_jiaodika(data: dict):
+
+def _jiaodika_insert_values(data: dict):
     """
-    插入一条 jiaodika 记录
+    把一条 jiaodika 记录整理为 (列名元组, 值元组)；不合法时抛 ValueError
     - 允许部分字段缺省，只插入提供的字段
     - 自动填充 bstudio_create_time / updated_at（如未提供）
     """
     if not isinstance(data, dict):
-        return {"error": "每条记录必须是 JSON 对象"}
+        raise ValueError("每条记录必须是 JSON 对象")
 
     # 自动时间
     now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -2026,52 +4696,98 @@ def _insert_one_jiaodika(data: dict):
         if k == "updated_at":
             record[k] = data.get(k) or now_str
             continue
+        if k == JIAODIKA_VERSION_COLUMN:
+            continue
         if k in data:
             record[k] = data.get(k)
 
     # 只插入有值的字段
-    cols = []
-    vals = []
-    for k, v in record.items():
-        if v is not None:
-            cols.append(f"`{k}`")
-            vals.append(v)
-
+    cols = tuple(k for k, v in record.items() if v is not None)
     if not cols:
-        return {"error": "没有可插入字段"}
+        raise ValueError("没有可插入字段")
+    return cols, tuple(record[k] for k in cols)
 
+
+def _jiaodika_insert_sql(cols) -> str:
     placeholders = ", ".join(["%s"] * len(cols))
-    cols_sql = ", ".join(cols)
-    sql = f"INSERT INTO `{JIAODIKA_TABLE}` ({cols_sql}) VALUES ({placeholders})"
+    cols_sql = ", ".join(f"`{k}`" for k in cols)
+    return f"INSERT INTO `{JIAODIKA_TABLE}` ({cols_sql}) VALUES ({placeholders})"
+
+
+def _insert_one_jiaodika(data: dict):
+    """插入一条 jiaodika 记录"""
+    try:
+        cols, vals = _jiaodika_insert_values(data)
+    except ValueError as e:
+        return {"error": str(e)}
 
     try:
-        affected = execute_query(sql, tuple(vals))
+        affected = execute_query(_jiaodika_insert_sql(cols), vals)
         return {"status": "ok", "affected_rows": affected}
     except Exception as e:
         return {"error": "插入失败", "detail": str(e)}
 
 
+def _insert_many_jiaodika(records: list) -> list:
+    """
+    批量插入 jiaodika，返回与 records 一一对应的结果
+    - 按列集合分组，每组一次 executemany（pymysql 会改写为多行 INSERT），全部在一个事务里提交
+    - 任一组失败则整体回滚，改为逐条插入，逐条报告成功/失败（与原先逐条插入的结果一致）
+    """
+    results = [None] * len(records)
+    groups = {}  # 列名元组 → [(下标, 值元组)]
+    for i, rec in enumerate(records):
+        try:
+            cols, vals = _jiaodika_insert_values(rec)
+        except ValueError as e:
+            results[i] = {"error": str(e)}
+            continue
+        groups.setdefault(cols, []).append((i, vals))
+    if not groups:
+        return results
+
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            for cols, items in groups.items():
+                cur.executemany(_jiaodika_insert_sql(cols), [vals for _, vals in items])
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"jiaodika 批量插入失败，改为逐条插入: {e}")
+        for items in groups.values():
+            for i, _ in items:
+                results[i] = _insert_one_jiaodika(records[i])
+        return results
+    finally:
+        conn.close()
+
+    for items in groups.values():
+        for i, _ in items:
+            results[i] = {"status": "ok", "affected_rows": 1}
+    return results
+
+
 @app.route("/jiaodika", methods=["POST"])
 def create_jiaodika():
     """
     新增 jiaodika 记录
     - 支持单条：body 为 JSON 对象
-    - 支持批量：body 为 JSON 数组
+    - 支持批量：body 为 JSON 数组（一个事务内批量写入，见 _insert_many_jiaodika）
     """
     data = request.get_json(force=True)
 
     # 批量
     if isinstance(data, list):
-        results = []
-        for rec in data:
-            res = _insert_one_jiaodika(rec)
-            results.append(res)
+        results = _insert_many_jiaodika(data)
+        _jiaodika_snapshot.invalidate()
         # 有错误时返回 207，和 /records 接口风格保持一致
         has_error = any(isinstance(r, dict) and r.get("error") for r in results)
         return jsonify(results), 207 if has_error else 201
 
     # 单条
     res = _insert_one_jiaodika(data)
+    _jiaodika_snapshot.invalidate()
     if isinstance(res, dict) and res.get("error"):
         # 和上面 /records 保持类似语义，这里直接 200 兼容现有调用方式
         return jsonify(res), 200
@@ -2082,25 +4798,211 @@ def create_jiaodika():
 def update_jiaodika(record_id):
     """
     按 id 更新 jiaodika 表
-    - body 为要更新的字段，忽略 id
+    - body 为要更新的字段，忽略 id；updated_at（NOW(6)）和 row_version 由服务端写入
     """
     data = request.get_json(force=True)
     if not isinstance(data, dict):
         return jsonify({"error": "body 必须是 JSON 对象"}), 400
 
-    updates = [f"`{k}`=%s" for k in data if k in JIAODIKA_FIELDS and k != "id"]
-    if not updates:
+    # updated_at / row_version 由服务端维护，忽略 body 中的值
+    columns = [k for k in data if k in JIAODIKA_FIELDS and k not in ("id", "updated_at", JIAODIKA_VERSION_COLUMN)]
+    if not columns:
         return jsonify({"error": "无可更新字段"}), 400
 
+    updates = [f"`{k}`=%s" for k in columns] + ["`updated_at`=NOW(6)"]
+    # 其他进程的 jiaodika 快照靠 row_version 发现修改
+    if JIAODIKA_VERSION_COLUMN in JIAODIKA_FIELDS:
+        updates.append(f"`{JIAODIKA_VERSION_COLUMN}`=`{JIAODIKA_VERSION_COLUMN}`+1")
+
     sql = f"UPDATE `{JIAODIKA_TABLE}` SET {', '.join(updates)} WHERE `id`=%s"
-    params = tuple(data[k] for k in data if k in JIAODIKA_FIELDS and k != "id") + (record_id,)
+    params = tuple(data[k] for k in columns) + (record_id,)
 
     affected = execute_query(sql, params)
+    _jiaodika_snapshot.invalidate()
     if affected == 0:
         return jsonify({"error": "未找到该记录"}), 404
     return jsonify({"status": "ok", "updated_id": record_id})
 
 
+# ==========================
+# jiaodika 表：全文检索
+# ==========================
+# /jiaodika/search?q= 在工序、操作工艺、安全事项等长文本列上按关键词检索，返回按相关度排序的前 k 条和命中片段。
+# 使用 MySQL FULLTEXT 索引（ngram 分词，支持中文，见 ensure_jiaodika_fulltext_index）；索引不存在、
+# 或关键词短于 ngram_token_size（默认 2）时回退为 LIKE 扫描，结果在 Python 里按命中次数排序。
+JIAODIKA_SEARCH_FIELDS = (
+    "gongchengfenlei",
+    "gongxu",
+    "zhuyaocailiao",
+    "gongjushebei",
+    "gongrenzige",
+    "caozuogongyi",
+    "yanshoubiaozhun",
+    "anquanshixiang",
+    "huanbaoshixiang",
+)
+JIAODIKA_FULLTEXT_INDEX = "ft_jiaodika_content"
+JIAODIKA_NGRAM_TOKEN_SIZE = 2
+JIAODIKA_SEARCH_TOP_K = 10
+JIAODIKA_SEARCH_MAX_K = 50
+JIAODIKA_SNIPPET_CHARS = 80
+JIAODIKA_FULLTEXT_RECHECK = _env_int("JIAODIKA_FULLTEXT_RECHECK") or 300  # 索引不可用时隔多少秒重新检查（秒）
+ER_FT_MATCHING_KEY_NOT_FOUND = 1191  # MATCH 找不到对应的 FULLTEXT 索引
+
+_jiaodika_fulltext_available = None  # None 表示尚未检查
+_jiaodika_fulltext_checked_at = 0.0  # 上次判定为不可用的时间（monotonic）
+
+
+def ensure_jiaodika_fulltext_index(create: bool = True) -> bool:
+    """
+    确保 jiaodika 上有覆盖 JIAODIKA_SEARCH_FIELDS 的 FULLTEXT 索引，等价 DDL：
+        ALTER TABLE `jiaodika` ADD FULLTEXT INDEX `ft_jiaodika_content` (`gongchengfenlei`, ...) WITH PARSER ngram;
+    返回是否本次新建；create=False 时只检查，返回是否缺少。
+    """
+    global _jiaodika_fulltext_available
+    if _jiaodika_has_fulltext_index():
+        _jiaodika_fulltext_available = True
+        return False
+    if not create:
+        return True
+    column_sql = ", ".join(f"`{c}`" for c in JIAODIKA_SEARCH_FIELDS)
+    execute_query(
+        f"ALTER TABLE `{JIAODIKA_TABLE}` ADD FULLTEXT INDEX `{JIAODIKA_FULLTEXT_INDEX}` ({column_sql}) WITH PARSER ngram"
+    )
+    _jiaodika_fulltext_available = True
+    return True
+
+
+def _jiaodika_has_fulltext_index() -> bool:
+    rows = execute_query(
+        "SELECT `COLUMN_NAME` FROM `information_schema`.`STATISTICS` "
+        "WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=%s AND `INDEX_NAME`=%s AND `INDEX_TYPE`='FULLTEXT'",
+        (JIAODIKA_TABLE, JIAODIKA_FULLTEXT_INDEX),
+        fetch=True,
+    )
+    # MATCH() 的列必须与索引的列完全一致
+    return {row["COLUMN_NAME"].lower() for row in rows} == set(JIAODIKA_SEARCH_FIELDS)
+
+
+def _jiaodika_search_terms(q: str) -> list:
+    terms = []
+    for term in re.split(r"\s+", q.strip()):
+        if term and term not in terms:
+            terms.append(term)
+    return terms
+
+
+def _jiaodika_fulltext_search(terms: list, k: int) -> list:
+    # ngram 分词下 NATURAL LANGUAGE MODE 按 bigram 命中计分；MATCH 作为 WHERE 条件时结果已按相关度排序
+    match_sql = f"MATCH({', '.join(f'`{c}`' for c in JIAODIKA_SEARCH_FIELDS)}) AGAINST (%s IN NATURAL LANGUAGE MODE)"
+    q = " ".join(terms)
+    sql = (
+        f"SELECT `id`, {', '.join(f'`{c}`' for c in JIAODIKA_SEARCH_FIELDS)}, {match_sql} AS `score` "
+        f"FROM `{JIAODIKA_TABLE}` WHERE {match_sql} ORDER BY `score` DESC, `id` LIMIT {int(k)}"
+    )
+    return execute_query(sql, (q, q), fetch=True)
+
+
+def _like_escape(term: str) -> str:
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _jiaodika_like_search(terms: list, k: int) -> list:
+    # 每个关键词至少在一个列中出现（AND of OR），得分为各关键词在各列中的出现次数之和
+    conditions = []
+    params = []
+    for term in terms:
+        conditions.append("(" + " OR ".join(f"`{c}` LIKE %s" for c in JIAODIKA_SEARCH_FIELDS) + ")")
+        params.extend([f"%{_like_escape(term)}%"] * len(JIAODIKA_SEARCH_FIELDS))
+    sql = (
+        f"SELECT `id`, {', '.join(f'`{c}`' for c in JIAODIKA_SEARCH_FIELDS)} FROM `{JIAODIKA_TABLE}` "
+        f"WHERE {' AND '.join(conditions)}"
+    )
+    rows = execute_query(sql, tuple(params), fetch=True)
+    for row in rows:
+        row["score"] = sum(str(row.get(c) or "").count(term) for c in JIAODIKA_SEARCH_FIELDS for term in terms)
+    rows.sort(key=lambda r: (-r["score"], r["id"]))
+    return rows[:k]
+
+
+def _jiaodika_snippet(text: str, terms: list, width: int = JIAODIKA_SNIPPET_CHARS) -> Optional[str]:
+    """取第一个命中位置前后约 width 个字符；整词没命中时按 ngram 片段找（与 FULLTEXT 的匹配方式一致）"""
+    if not text:
+        return None
+    needles = list(terms)
+    for term in terms:
+        needles.extend(term[i:i + JIAODIKA_NGRAM_TOKEN_SIZE] for i in range(len(term) - JIAODIKA_NGRAM_TOKEN_SIZE + 1))
+    for needle in needles:
+        pos = text.find(needle)
+        if pos < 0:
+            continue
+        start = max(0, pos - width // 2)
+        end = min(len(text), start + width)
+        start = max(0, end - width)
+        return ("…" if start > 0 else "") + text[start:end] + ("…" if end < len(text) else "")
+    return None
+
+
+@app.route("/jiaodika/search", methods=["GET"])
+def search_jiaodika():
+    """
+    jiaodika 全文检索
+    - q: 关键词（必填），多个关键词用空格分隔
+    - k: 返回条数，默认 JIAODIKA_SEARCH_TOP_K，最大 JIAODIKA_SEARCH_MAX_K
+    - 返回 {"q", "mode": "fulltext"|"like", "results": [{id, gongchengfenlei, gongxu, score, snippets: {列名: 片段}}]}
+    """
+    global _jiaodika_fulltext_available, _jiaodika_fulltext_checked_at
+    filters = {**(request.get_json(silent=True) or {}), **request.args.to_dict()}
+    terms = _jiaodika_search_terms(str(filters.get("q") or ""))
+    if not terms:
+        return jsonify({"error": "缺少参数: q"}), 400
+    k = min(max(_as_int(filters.get("k"), JIAODIKA_SEARCH_TOP_K), 1), JIAODIKA_SEARCH_MAX_K)
+
+    # 未检查过，或判定不可用已超过 JIAODIKA_FULLTEXT_RECHECK 秒（索引可能已补建）时重新检查
+    if _jiaodika_fulltext_available is None or (
+            not _jiaodika_fulltext_available
+            and time.monotonic() - _jiaodika_fulltext_checked_at >= JIAODIKA_FULLTEXT_RECHECK):
+        try:
+            _jiaodika_fulltext_available = _jiaodika_has_fulltext_index()
+        except Exception as e:
+            print(f"检查 jiaodika 全文索引失败: {e}")
+            _jiaodika_fulltext_available = False
+        if not _jiaodika_fulltext_available:
+            _jiaodika_fulltext_checked_at = time.monotonic()
+
+    rows = None
+    mode = "like"
+    if _jiaodika_fulltext_available and all(len(t) >= JIAODIKA_NGRAM_TOKEN_SIZE for t in terms):
+        try:
+            rows = _jiaodika_fulltext_search(terms, k)
+            mode = "fulltext"
+        except pymysql.err.MySQLError as e:
+            # 只有索引不存在才停用全文检索（之后按 JIAODIKA_FULLTEXT_RECHECK 重新检查）；
+            # 断线、锁等待超时等临时错误只让本次请求回退 LIKE
+            print(f"jiaodika 全文检索失败，回退 LIKE: {e}")
+            if e.args and e.args[0] == ER_FT_MATCHING_KEY_NOT_FOUND:
+                _jiaodika_fulltext_available = False
+                _jiaodika_fulltext_checked_at = time.monotonic()
+    if rows is None:
+        rows = _jiaodika_like_search(terms, k)
+
+    results = []
+    for row in rows:
+        snippets = {}
+        for c in JIAODIKA_SEARCH_FIELDS:
+            snippet = _jiaodika_snippet(str(row.get(c) or ""), terms)
+            if snippet:
+                snippets[c] = snippet
+        results.append({
+            "id": row["id"],
+            "gongchengfenlei": row.get("gongchengfenlei"),
+            "gongxu": row.get("gongxu"),
+            "score": round(float(row.get("score") or 0), 4),
+            "snippets": snippets,
+        })
+    return jsonify({"q": " ".join(terms), "mode": mode, "results": results})
+
+
 # ==========================
 # 邮箱账号密码表：CRUD 接口
 # ==========================
@@ -2237,6 +5139,7 @@ def _insert_one_email_account(data: dict):
         
         try:
             affected = execute_query(sql, params)
+            _credential_cache.invalidate(email_account)
             return {"status": "updated", "updated_id": record_id, "affected_rows": affected}
         except Exception as e:
             return {"error": "更新失败", "detail": str(e)}
@@ -2263,6 +5166,7 @@ def _insert_one_email_account(data: dict):
 
         try:
             affected = execute_query(sql, tuple(record.values()))
+            _credential_cache.invalidate(email_account)
             return {"status": "created", "affected_rows": affected}
         except Exception as e:
             return {"error": "插入失败", "detail": str(e)}
@@ -2325,6 +5229,8 @@ def update_email_account(record_id):
     params = tuple(data[k] for k in data if k in EMAIL_ACCOUNT_FIELDS and k != "id") + (record_id,)
 
     affected = execute_query(sql, params)
+    # 按 id 更新时不知道（原）账号名，且可能改了 email_account 本身，整体失效
+    _credential_cache.invalidate()
     if affected == 0:
         return jsonify({"error": "未找到该记录"}), 404
     return jsonify({"status": "ok", "updated_id": record_id})
@@ -2335,6 +5241,7 @@ def delete_email_account(record_id):
     """按 id 删除邮箱账号"""
     sql = f"DELETE FROM `{EMAIL_ACCOUNT_TABLE}` WHERE `id`=%s"
     deleted = execute_query(sql, (record_id,))
+    _credential_cache.invalidate()
     if deleted == 0:
         return jsonify({"error": "未找到该记录"}), 404
     return jsonify({"status": "ok", "deleted_id": record_id})
@@ -2422,12 +5329,35 @@ def get_refresh_token():
 # email_everyday 表：查询接口
 # ==========================
 
+EMAIL_EVERYDAY_PAGE_SIZE = 200
+EMAIL_EVERYDAY_PAGE_MAX = 1000
+
+
+def _email_everyday_encode_cursor(received_time, row_id) -> str:
+    if isinstance(received_time, datetime):
+        received_time = received_time.strftime("%Y-%m-%d %H:%M:%S")
+    raw = json.dumps([str(received_time), int(row_id)])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _email_everyday_decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        received_time, row_id = json.loads(raw)
+        return str(received_time), int(row_id)
+    except Exception:
+        raise ValueError("cursor 无效")
+
+
 @app.route("/email_everyday", methods=["GET"])
 def list_email_everyday():
     """
     查询 email_everyday 表（已处理的邮件记录）
     - 支持 URL query 参数和 GET JSON body 作为过滤条件
     - 支持按 email_account, email_id, received_time 等字段过滤
+    - 分页：传 limit（最大 EMAIL_EVERYDAY_PAGE_MAX）或 cursor 时分页（只传 cursor 时每页 EMAIL_EVERYDAY_PAGE_SIZE），
+      还有下一页时响应头 X-Next-Cursor 给出游标，下次请求带 cursor 参数继续（按 received_time、id 倒序）；
+      limit、cursor 都不传时与以前一样返回全部
     """
     query_filters = request.args.to_dict()
     body_filters = request.get_json(silent=True) or {}
@@ -2455,10 +5385,30 @@ def list_email_everyday():
             conditions.append(f"`{k}`=%s")
             params.append(v)
 
+    cursor = filters.get("cursor")
+    limit = None
+    if filters.get("limit") not in (None, "") or cursor:
+        limit = _as_int(filters.get("limit"), EMAIL_EVERYDAY_PAGE_SIZE)
+        limit = min(max(limit, 1), EMAIL_EVERYDAY_PAGE_MAX)
+    if cursor:
+        try:
+            received_time, last_id = _email_everyday_decode_cursor(cursor)
+        except ValueError:
+            return jsonify({"error": "cursor 无效"}), 400
+        # keyset 分页：(received_time, id) 严格小于上一页最后一行
+        conditions.append("(`received_time` < %s OR (`received_time` = %s AND `id` < %s))")
+        params.extend([received_time, received_time, last_id])
+
     where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
     sql = f"SELECT * FROM `{EMAIL_EVERYDAY_TABLE}` {where} ORDER BY `received_time` DESC, `id` DESC"
-    rows = execute_query(sql, tuple(params), fetch=True)
-    return jsonify(rows)
+    if limit is None:
+        return jsonify(execute_query(sql, tuple(params), fetch=True))
+    rows = execute_query(f"{sql} LIMIT {limit + 1}", tuple(params), fetch=True)
+    response = jsonify(rows[:limit])
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        response.headers["X-Next-Cursor"] = _email_everyday_encode_cursor(last["received_time"], last["id"])
+    return response
 
 
 @app.route("/email_everyday/check", methods=["POST"])
@@ -2481,53 +5431,134 @@ def check_email_handled():
     except ValueError as e:
         return _json_error(str(e), 400)
 
-    # 处理 UID 列表
-    if isinstance(email_ids, str):
-        uid_list = [uid.strip() for uid in email_ids.split(",")]
-    elif isinstance(email_ids, list):
-        uid_list = [str(uid) for uid in email_ids]
-    else:
-        uid_list = [str(email_ids)]
+    # 处理 UID 列表（与 add_read_ids 相同的归一规则）
+    uid_list = _email_uid_list(email_ids)
 
     try:
-        # 查询这些邮件 ID 是否已处理
-        placeholders = ", ".join(["%s"] * len(uid_list))
-        sql = f"""
-            SELECT `email_id`, `received_time` 
-            FROM `{EMAIL_EVERYDAY_TABLE}` 
-            WHERE `email_account`=%s AND `email_id` IN ({placeholders})
-        """
-        params = [email_account] + uid_list
-        rows = execute_query(sql, tuple(params), fetch=True)
-        
-        # 构建已处理的邮件 ID 集合
-        handled_set = {row["email_id"] for row in rows}
+        # 先查进程内索引：Bloom 判定不存在的直接视为未处理，只有可能命中的 UID 才查库
+        if _handled_index.sync():
+            handled, to_query = _handled_index.classify(email_account, set(uid_list))
+        else:
+            handled, to_query = {}, set(uid_list)
+        if to_query:
+            # IN 列表分批，走 (email_account, email_id) 索引
+            conn = get_conn()
+            try:
+                with conn.cursor() as cur:
+                    handled.update(_email_everyday_lookup(cur, email_account, to_query))
+            finally:
+                conn.close()
         
         # 构建返回结果
         result = []
         for uid in uid_list:
             result.append({
                 "email_id": uid,
-                "handled": uid in handled_set,
-                "received_time": next((r["received_time"] for r in rows if r["email_id"] == uid), None)
+                "handled": uid in handled,
+                "received_time": handled.get(uid)
             })
         
         return jsonify({
             "ok": True,
             "email_account": email_account,
             "results": result,
-            "handled_count": len(handled_set),
+            "handled_count": len(handled),
             "total_count": len(uid_list)
         })
     except Exception as e:
         return _json_error("查询失败", 500, code="check_failed", detail=str(e))
 
 
+# ==========================
+# 服务启动
+# ==========================
+# 直接运行本文件时 __main__ 依次调用下面两步；用 gunicorn 等 WSGI 服务器部署时必须由入口调用它们
+# （见同目录 gunicorn.conf.py：on_starting 调 startup_checks，post_fork 调 start_background_tasks），
+# 否则延迟模块会在多个请求线程里并发首次加载，密钥错误也要等到第一个请求才暴露。
+# 启动时只检查索引/列是否齐全并打印警告，不在生产表上执行 DDL（ALTER TABLE 会阻塞启动且未经评审）；
+# 需要补建时执行 python crud_sql_apiserver.py --migrate，或设置 SCHEMA_AUTO_DDL=1 让启动时自动补建
+SCHEMA_AUTO_DDL = _env_int("SCHEMA_AUTO_DDL") == 1
+_startup_checked = False
+_background_pid = None
+_startup_lock = threading.Lock()
+
+
+def ensure_schema(create: bool) -> list:
+    """
+    检查 email_everyday 索引、jiaodika 修改计数列与全文索引；create=True 时补建缺少的，否则只打印警告。
+    返回缺少（create=True 时为本次补建）的对象名列表
+    """
+    missing = []
+    hint = "；执行 python crud_sql_apiserver.py --migrate 或设置 SCHEMA_AUTO_DDL=1 补建"
+    try:
+        for name in ensure_email_everyday_index(create=create):
+            missing.append(name)
+            print(f"已为 email_everyday 创建索引 {name}" if create
+                  else f"警告：email_everyday 缺少索引 {name}，/email_everyday/check 会变慢{hint}")
+    except Exception as e:
+        print(f"检查 email_everyday 索引失败: {e}")
+    try:
+        if ensure_jiaodika_version_column(create=create):
+            missing.append(JIAODIKA_VERSION_COLUMN)
+            print(f"已为 jiaodika 添加修改计数列 {JIAODIKA_VERSION_COLUMN}" if create
+                  else f"警告：jiaodika 缺少修改计数列 {JIAODIKA_VERSION_COLUMN}，其他进程的快照按 updated_at 发现修改{hint}")
+    except Exception as e:
+        print(f"添加 jiaodika 修改计数列失败，其他进程的快照按 updated_at 发现修改: {e}")
+    try:
+        if ensure_jiaodika_fulltext_index(create=create):
+            missing.append(JIAODIKA_FULLTEXT_INDEX)
+            print(f"已为 jiaodika 创建全文索引 {JIAODIKA_FULLTEXT_INDEX}" if create
+                  else f"警告：jiaodika 缺少全文索引 {JIAODIKA_FULLTEXT_INDEX}，/jiaodika/search 将使用 LIKE 检索{hint}")
+    except Exception as e:
+        print(f"创建 jiaodika 全文索引失败，/jiaodika/search 将使用 LIKE 检索: {e}")
+    return missing
 
 
-
-
+def startup_checks() -> None:
+    """
+    单线程阶段（进程启动、pre-fork master）执行一次：加载延迟模块、创建加密器（密钥有问题时直接启动失败）、
+    检查索引（见 ensure_schema）、预热简繁转换表。不启动线程，fork 出的 worker 以写时复制共享这些结果
+    """
+    global _startup_checked
+    with _startup_lock:
+        if _startup_checked:
+            return
+        preload_lazy_modules()
+        _get_fernet()
+        ensure_schema(create=SCHEMA_AUTO_DDL)
+        started = time.perf_counter()
+        warmup = warm_up_converters()
+        print(f"简繁转换表预热完成，共 {(time.perf_counter() - started) * 1000:.0f}ms："
+              + "，".join(f"{target} {ms}ms" for target, ms in warmup.items()))
+        _startup_checked = True
+
+
+def start_background_tasks() -> None:
+    """每个服务进程（fork 之后的 worker）调用一次：线程不会随 fork 复制，按 pid 幂等"""
+    global _background_pid
+    startup_checks()  # 入口没有在 master 里调用时在这里补上，已执行过则直接返回
+    with _startup_lock:
+        if _background_pid == os.getpid():
+            return
+        try:
+            _schema_registry.refresh()
+        except Exception as e:
+            print(f"加载表结构失败，使用代码中声明的字段列表: {e}")
+        _schema_registry.start()
+        # 后台预热已处理邮件索引，完成前 /email_everyday/check 直接查库
+        threading.Thread(target=_handled_index.warm_up, name="handled-index-warmup", daemon=True).start()
+        # 继续投递上次退出前未发完的邮件
+        _mail_outbox.start()
+        _background_pid = os.getpid()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="C-Smart ePermit API 服务")
+    parser.add_argument("--migrate", action="store_true", help="补建缺少的索引/列后退出，不启动服务")
+    args = parser.parse_args()
+    if args.migrate:
+        ensure_schema(create=True)
+        sys.exit(0)
+    startup_checks()
+    start_background_tasks()
     app.run(host="0.0.0.0", port=5000)
@@ -1,13 +1,27 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, call
+import base64
+import gzip
 import json
+import re
+import runpy
+import subprocess
 import sys
 import os
+import tempfile
+import time
+from datetime import datetime
 
 # 确保能导入 crud_sql_apiserver
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+# 加解密用到的密钥（仅测试用）
+os.environ.setdefault("EMAIL_ENCRYPTION_KEY", "crud-sql-apiserver-test-key")
 
+import crud_sql_apiserver
+import email_everyday_maintenance
+import hk_time
 from crud_sql_apiserver import app, clean_string
+from pymysql.err import DataError
 
 class CrudSqlApiServerTest(unittest.TestCase):
     def setUp(self):
@@ -111,5 +125,1233 @@ class CrudSqlApiServerTest(unittest.TestCase):
         delete_sql = mock_execute_query.call_args[0][0]
         self.assertIn("REGEXP_REPLACE", delete_sql)
 
+
+
+def _mock_imap_conn():
+    """构造一个最小可用的 IMAP 连接 mock：登录/选择/搜索均返回 OK，无邮件"""
+    conn = MagicMock()
+    conn.login.return_value = ("OK", [b"LOGIN completed"])
+    conn.select.return_value = ("OK", [b"1"])
+    conn.noop.return_value = ("OK", [b"NOOP completed"])
+    conn.uid.return_value = ("OK", [b""])
+    return conn
+
+
+class ImapSessionPoolTest(unittest.TestCase):
+    def setUp(self):
+        crud_sql_apiserver._imap_pool.close_all()
+
+    def tearDown(self):
+        crud_sql_apiserver._imap_pool.close_all()
+
+    @patch('crud_sql_apiserver.imaplib.IMAP4_SSL')
+    def test_consecutive_operations_reuse_session(self, mock_imap_ssl):
+        """同账号连续 receive + mark_unread 只握手/登录一次"""
+        conn = _mock_imap_conn()
+        mock_imap_ssl.return_value = conn
+
+        crud_sql_apiserver.receive_emails_imap("a@x.com", "pwd", "imap.x.com", 993)
+        res = crud_sql_apiserver.mark_emails_unread_imap("a@x.com", "pwd", "imap.x.com", 993, ["1", "2"])
+
+        self.assertEqual(res["total"], 2)
+        self.assertEqual(mock_imap_ssl.call_count, 1)
+        self.assertEqual(conn.login.call_count, 1)
+        conn.logout.assert_not_called()
+
+    @patch('crud_sql_apiserver.imaplib.IMAP4_SSL')
+    def test_reconnect_after_aborted_session(self, mock_imap_ssl):
+        """复用的连接被服务器断开时，丢弃并重连一次"""
+        stale, fresh = _mock_imap_conn(), _mock_imap_conn()
+        mock_imap_ssl.side_effect = [stale, fresh]
+
+        crud_sql_apiserver.receive_emails_imap("a@x.com", "pwd", "imap.x.com", 993)
+        stale.uid.side_effect = crud_sql_apiserver.imaplib.IMAP4.abort("socket error: EOF")
+        res = crud_sql_apiserver.receive_emails_imap("a@x.com", "pwd", "imap.x.com", 993)
+
+        self.assertEqual(res, {"result": []})
+        self.assertEqual(mock_imap_ssl.call_count, 2)
+        stale.logout.assert_called_once()
+
+
+class MailCacheTest(unittest.TestCase):
+    def setUp(self):
+        crud_sql_apiserver._credential_cache.invalidate()
+        self.app = app.test_client()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_patch = patch('crud_sql_apiserver.MAIL_CACHE_DB_PATH', os.path.join(self.tmpdir.name, "cache.sqlite3"))
+        self.db_patch.start()
+
+    def tearDown(self):
+        self.db_patch.stop()
+        self.tmpdir.cleanup()
+
+    def _seed(self, heartbeat_at):
+        conn = crud_sql_apiserver._mail_cache_conn(create=True)
+        parsed = {"from": "a@x.com", "subject": "日报", "date": None, "date_iso": None, "body": "正文", "day": None}
+        crud_sql_apiserver._mail_cache_put_messages(conn, "a@x.com", "inbox", 7, [(41, parsed, True), (42, parsed, False)])
+        conn.execute("INSERT INTO mail_sync_state VALUES ('a@x.com', 'inbox', 7, 42, ?)", (heartbeat_at,))
+        conn.commit()
+        conn.close()
+
+    @patch('crud_sql_apiserver.decrypt_password')
+    @patch('crud_sql_apiserver.execute_query')
+    def test_receive_from_db_served_from_cache(self, mock_execute_query, mock_decrypt):
+        """watcher 心跳正常时 /mail/receive_from_db 直接读缓存，不解密、不连 IMAP"""
+        self._seed(time.time())
+        mock_execute_query.return_value = [{"email_account": "a@x.com", "encrypted_password": "enc"}]
+
+        response = self.app.post('/mail/receive_from_db',
+                                 data=json.dumps({"unread_only": True}),
+                                 content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        result = response.get_json()["results"][0]
+        self.assertTrue(result["from_cache"])
+        self.assertEqual([m["id"] for m in result["result"]], ["42"])
+        mock_decrypt.assert_not_called()
+
+    def test_header_only_rows_are_a_miss_when_body_needed(self):
+        """/mail/receive 写入的只有邮件头的行（body 为 NULL）不能当作空正文返回"""
+        self._seed(time.time())
+        self.addCleanup(crud_sql_apiserver._mail_parsed_cache.clear)
+        crud_sql_apiserver._mail_parsed_cache.put_many(("a@x.com", "inbox", 7), [
+            (43, {"from": "a@x.com", "subject": "周报", "date": None, "date_iso": None, "body": None, "day": None}),
+        ])
+        self.assertIsNone(crud_sql_apiserver._mail_cache_receive("a@x.com"))
+        res = crud_sql_apiserver._mail_cache_receive("a@x.com", body_mode="none")
+        self.assertEqual([m["id"] for m in res["result"]], ["43", "42", "41"])
+
+    def test_stale_heartbeat_falls_back(self):
+        """心跳过期视为缓存失效"""
+        self._seed(time.time() - crud_sql_apiserver.MAIL_CACHE_MAX_STALENESS - 1)
+        self.assertIsNone(crud_sql_apiserver._mail_cache_receive("a@x.com"))
+
+
+def _raw_mail(subject, body="hello", date="Mon, 19 Oct 2026 09:00:00 +0800"):
+    return (f"From: a@x.com\r\nSubject: {subject}\r\nDate: {date}\r\n"
+            f"Content-Type: text/plain; charset=utf-8\r\n\r\n{body}\r\n").encode("utf-8")
+
+
+def _mock_imap_mailbox(messages, uidvalidity=b"7", seen=()):
+    """
+    模拟一个带邮件的文件夹：支持 UID SEARCH / 多 UID FETCH，记录每次整封或邮件头 FETCH 的 UID 集合；
+    seen 为已读的 UID。BODYSTRUCTURE 与 BODY.PEEK[1]<偏移.长度> 按单 part 的 text/plain 邮件应答
+    """
+    conn = _mock_imap_conn()
+    conn.response.return_value = ("UIDVALIDITY", [uidvalidity])
+    conn.fetched = []
+
+    def uid(command, *args):
+        if command == "search":
+            return "OK", [" ".join(str(u) for u in sorted(messages)).encode()]
+        if command == "fetch":
+            uids = [int(u) for u in args[0].split(",")]
+            body = {u: messages[u].split(b"\r\n\r\n", 1)[1] for u in uids}
+            if args[1] == "(UID BODYSTRUCTURE)":
+                return "OK", [f'{u} (UID {u} BODYSTRUCTURE ("text" "plain" ("charset" "utf-8") NIL NIL "7bit" '
+                              f'{len(body[u])} 1))'.encode() for u in uids]
+            partial = re.search(r"BODY\.PEEK\[1\]<(\d+)\.(\d+)>", args[1])
+            if partial:
+                start, length = int(partial.group(1)), int(partial.group(2))
+                return "OK", [(f"{u} (UID {u} BODY[1]<{start}> {{{len(body[u][start:start + length])}}}".encode(),
+                               body[u][start:start + length]) for u in uids] + [b")"]
+            conn.fetched.append(uids)
+            data = []
+            for u in uids:
+                flags = "\\Seen" if u in seen else ""
+                data.append((f"{u} (UID {u} BODY[] {{{len(messages[u])}}}".encode(), messages[u]))
+                # FLAGS 放在 literal 之后（部分服务器的顺序）
+                data.append(f" FLAGS ({flags}))".encode())
+            return "OK", data
+        return "OK", [None]
+
+    conn.uid.side_effect = uid
+    return conn
+
+
+class ParsedMailCacheTest(unittest.TestCase):
+    def setUp(self):
+        crud_sql_apiserver._imap_pool.close_all()
+        crud_sql_apiserver._mail_parsed_cache.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_patch = patch('crud_sql_apiserver.MAIL_CACHE_DB_PATH', os.path.join(self.tmpdir.name, "cache.sqlite3"))
+        self.db_patch.start()
+
+    def tearDown(self):
+        crud_sql_apiserver._imap_pool.close_all()
+        crud_sql_apiserver._mail_parsed_cache.clear()
+        self.db_patch.stop()
+        self.tmpdir.cleanup()
+
+    @patch('crud_sql_apiserver.imaplib.IMAP4_SSL')
+    def test_repeat_receive_only_fetches_new_uids(self, mock_imap_ssl):
+        """重复收信复用已解析结果，只 FETCH 新到的 UID"""
+        messages = {1: _raw_mail("第一封"), 2: _raw_mail("第二封")}
+        conn = _mock_imap_mailbox(messages)
+        mock_imap_ssl.return_value = conn
+
+        first = crud_sql_apiserver.receive_emails_imap("a@x.com", "pwd", "imap.x.com", 993)
+        messages[3] = _raw_mail("第三封")
+        second = crud_sql_apiserver.receive_emails_imap("a@x.com", "pwd", "imap.x.com", 993)
+
+        self.assertEqual([m["subject"] for m in first["result"]], ["第二封", "第一封"])
+        self.assertEqual([m["subject"] for m in second["result"]], ["第三封", "第二封", "第一封"])
+        self.assertEqual(conn.fetched, [[2, 1], [3]])
+
+    @patch('crud_sql_apiserver.imaplib.IMAP4_SSL')
+    def test_disk_cache_survives_memory_eviction(self, mock_imap_ssl):
+        """进程内 LRU 被清空后从 SQLite 命中，不重新 FETCH"""
+        conn = _mock_imap_mailbox({5: _raw_mail("周报", body="weekly report")})
+        mock_imap_ssl.return_value = conn
+
+        crud_sql_apiserver.receive_emails_imap("a@x.com", "pwd", "imap.x.com", 993)
+        crud_sql_apiserver._mail_parsed_cache.clear()
+        res = crud_sql_apiserver.receive_emails_imap("a@x.com", "pwd", "imap.x.com", 993)
+
+        self.assertEqual(res["result"][0]["body"].strip(), "weekly report")
+        self.assertEqual(conn.fetched, [[5]])
+
+    @patch('crud_sql_apiserver.imaplib.IMAP4_SSL')
+    def test_body_mode_none_fetches_headers_only(self, mock_imap_ssl):
+        """body_mode=none 只 FETCH 邮件头，返回结果不含正文；之后要正文时再补拉"""
+        conn = _mock_imap_mailbox({1: _raw_mail("周报", body="weekly report")})
+        mock_imap_ssl.return_value = conn
+
+        res = crud_sql_apiserver.receive_emails_imap("a@x.com", "pwd", "imap.x.com", 993, body_mode="none",
+                                                     fields=crud_sql_apiserver._mail_fields("subject,from"))
+        self.assertEqual(res["result"], [{"id": "1", "from": "a@x.com", "subject": "周报"}])
+        fetch_items = [c.args[2] for c in conn.uid.call_args_list if c.args[0] == "fetch"]
+        self.assertEqual(fetch_items, ["(UID FLAGS BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)])"])
+
+        conn.uid.reset_mock()
+        res = crud_sql_apiserver.receive_emails_imap("a@x.com", "pwd", "imap.x.com", 993, body_mode="snippet:6")
+        self.assertEqual(res["result"][0]["body"], "weekly")
+        self.assertTrue(res["result"][0]["body_truncated"])
+        # 摘要不拉整封邮件：邮件头走缓存，正文只部分 FETCH 文本 part
+        fetch_items = [c.args[2] for c in conn.uid.call_args_list if c.args[0] == "fetch"]
+        self.assertEqual(fetch_items, ["(UID BODYSTRUCTURE)", "(UID BODY.PEEK[1]<0.24>)"])
+        self.assertEqual(conn.fetched, [[1]])
+
+    @patch('crud_sql_apiserver.imaplib.IMAP4_SSL')
+    def test_disk_cache_stores_real_seen_flag(self, mock_imap_ssl):
+        """unread_only=False 收取的未读邮件在共用缓存表中仍记为未读"""
+        mock_imap_ssl.return_value = _mock_imap_mailbox({1: _raw_mail("已读"), 2: _raw_mail("未读")}, seen={1})
+        crud_sql_apiserver.receive_emails_imap("a@x.com", "pwd", "imap.x.com", 993)
+
+        conn = crud_sql_apiserver._mail_cache_conn()
+        rows = dict(conn.execute("SELECT uid, seen FROM mail_messages").fetchall())
+        conn.close()
+        self.assertEqual(rows, {1: 1, 2: 0})
+
+    def test_receive_options_validation(self):
+        """body_mode / fields 非法时返回 400；只给不含 body 的 fields 时不取正文"""
+        client = app.test_client()
+        for payload in ({"body_mode": "short"}, {"body_mode": "snippet:0"}, {"fields": ["subject", "cc"]}):
+            response = client.post('/mail/receive', data=json.dumps(dict(payload, email_account="a@x.com",
+                                                                          email_password="pwd")),
+                                    content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+        options = crud_sql_apiserver._mail_receive_options({"fields": "subject"})
+        self.assertEqual(options["body_mode"], "none")
+        self.assertEqual(options["fields"], ("id", "subject"))
+
+
+class ImapBulkStoreTest(unittest.TestCase):
+    def setUp(self):
+        crud_sql_apiserver._imap_pool.close_all()
+
+    def tearDown(self):
+        crud_sql_apiserver._imap_pool.close_all()
+
+    def test_uid_sets_compress_ranges_and_split(self):
+        """UID 列表压缩为 sequence-set，超长时切段"""
+        self.assertEqual(crud_sql_apiserver._imap_uid_sets(["3", 1, 2, 7, 9, 10, 2]),
+                         [("1:3,7,9:10", [1, 2, 3, 7, 9, 10])])
+        chunks = crud_sql_apiserver._imap_uid_sets(range(1, 400, 2), max_chars=100)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(set_str) <= 100 for set_str, _ in chunks))
+        self.assertEqual(sum(len(members) for _, members in chunks), 200)
+
+    @patch('crud_sql_apiserver.imaplib.IMAP4_SSL')
+    def test_mark_unread_single_search_and_store(self, mock_imap_ssl):
+        """数百个 UID 只发一条 SEARCH + 一条 STORE，并返回每个 UID 的结果"""
+        conn = _mock_imap_conn()
+        existing = " ".join(str(u) for u in range(1, 300)).encode()
+        conn.uid.side_effect = lambda command, *args: ("OK", [existing]) if command == "search" else ("OK", [None])
+        mock_imap_ssl.return_value = conn
+
+        uids = [str(u) for u in range(1, 301)] + ["abc"]
+        res = crud_sql_apiserver.mark_emails_unread_imap("a@x.com", "pwd", "imap.x.com", 993, uids)
+
+        self.assertEqual(conn.uid.call_args_list, [
+            call("search", None, "UID", "1:300"),
+            call("store", "1:299", "-FLAGS.SILENT", "(\\Seen)"),
+        ])
+        self.assertEqual(res["marked_count"], 299)
+        self.assertEqual(res["results"][299], {"uid": "300", "ok": False, "error": "not_found"})
+        self.assertEqual(res["results"][300], {"uid": "abc", "ok": False, "error": "invalid_uid"})
+
+
+class MailCharsetDecodeTest(unittest.TestCase):
+    TRAD = "各位同事：請於本週五前提交安全施工報告，謝謝。"
+    SIMP = "各位同事：请于本周五前提交安全施工报告，谢谢。"
+
+    def test_declared_and_sniffed_charsets(self):
+        """声明编码有效时直接使用；未声明/误标时按 utf-8 → 样本判别选择中文编码"""
+        decode = crud_sql_apiserver._decode_payload_smart
+        self.assertEqual(decode(self.TRAD.encode("utf-8"), "utf-8"), self.TRAD)
+        self.assertEqual(decode(self.TRAD.encode("utf-8"), None), self.TRAD)
+        self.assertEqual(decode(self.SIMP.encode("gbk"), "gb2312"), self.SIMP)
+        self.assertEqual(decode(self.SIMP.encode("gbk"), None), self.SIMP)
+        self.assertEqual(decode(self.TRAD.encode("big5"), None), self.TRAD)
+        # 误标为 latin-1 / gbk 的中文邮件
+        self.assertEqual(decode(self.SIMP.encode("gbk"), "iso-8859-1"), self.SIMP)
+        self.assertEqual(decode(self.TRAD.encode("utf-8"), "gbk"), self.TRAD)
+        self.assertEqual(decode("café".encode("latin-1"), "iso-8859-1"), "café")
+
+    def test_sender_hint_and_header_fast_path(self):
+        """发件人编码提示被记录；纯 ASCII 邮件头不进入解码流程"""
+        crud_sql_apiserver._decode_payload_smart(self.TRAD.encode("big5"), "big5", sender="hk@x.com")
+        self.assertEqual(crud_sql_apiserver._charset_hint("hk@x.com"), "big5hkscs")
+        with patch('crud_sql_apiserver._decode_payload_smart') as mock_decode:
+            self.assertEqual(crud_sql_apiserver._decode_mime_header("Re: weekly report"), "Re: weekly report")
+            mock_decode.assert_not_called()
+
+
+
+class MailBodyExtractTest(unittest.TestCase):
+    def test_html_skips_script_style_and_head(self):
+        """script/style/head 内容不进入正文，块级标签换行、空行去除"""
+        html = ("<html><head><title>Newsletter</title><style>p {color: red}</style></head>"
+                "<body><script>var x = 1;</script><p> 第一段 &amp; 说明 </p><div>第二段<br>第三行</div></body></html>")
+        text, truncated = crud_sql_apiserver._html_to_text(html)
+        self.assertEqual(text, "第一段 & 说明\n第二段\n第三行")
+        self.assertFalse(truncated)
+
+    def test_html_stops_at_budget(self):
+        """超过 max_chars 立即停止解析并标记截断"""
+        html = "<p>" + "</p><p>".join(f"第{i}行内容" for i in range(100000)) + "</p>"
+        with patch.object(crud_sql_apiserver._HTMLToTextParser, 'feed',
+                          autospec=True, side_effect=crud_sql_apiserver._HTMLToTextParser.feed) as mock_feed:
+            text, truncated = crud_sql_apiserver._html_to_text(html, max_chars=100)
+        self.assertTrue(truncated)
+        self.assertLessEqual(len(text), 100)
+        self.assertTrue(text.startswith("第0行内容\n第1行内容"))
+        self.assertEqual(mock_feed.call_count, 1)
+
+    def test_max_body_chars_applies_to_cached_body(self):
+        """请求的 max_body_chars 小于缓存正文时在返回前截断"""
+        parsed = {"from": "a@x.com", "subject": "s", "date": None, "date_iso": None,
+                  "body": "x" * 50, "body_truncated": False, "day": None}
+        item = crud_sql_apiserver._mail_result_item(1, parsed, crud_sql_apiserver._mail_body_chars(10))
+        self.assertEqual((item["body"], item["body_truncated"]), ("x" * 10, True))
+        item = crud_sql_apiserver._mail_result_item(1, parsed, crud_sql_apiserver._mail_body_chars(None))
+        self.assertEqual((item["body"], item["body_truncated"]), ("x" * 50, False))
+
+
+
+class CredentialCacheTest(unittest.TestCase):
+    def setUp(self):
+        crud_sql_apiserver._credential_cache.invalidate()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        crud_sql_apiserver._credential_cache.invalidate()
+
+    @patch('crud_sql_apiserver.receive_emails_imap', return_value={"result": []})
+    @patch('crud_sql_apiserver.decrypt_password', return_value="pwd")
+    @patch('crud_sql_apiserver.execute_query')
+    def test_repeat_calls_skip_db_and_decrypt(self, mock_execute_query, mock_decrypt, mock_receive):
+        """TTL 内重复调用 /mail/receive_from_db 不再查库、不再解密；修改账号后失效"""
+        mock_execute_query.return_value = [{"email_account": "a@x.com", "encrypted_password": "enc"}]
+        for _ in range(3):
+            response = self.app.post('/mail/receive_from_db', data=json.dumps({}), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(mock_execute_query.call_count, 1)
+        mock_decrypt.assert_called_once_with("enc")
+        self.assertEqual(mock_receive.call_args.kwargs["email_password"], "pwd")
+
+        mock_execute_query.return_value = 1
+        self.app.delete('/email_accounts/1')
+        mock_execute_query.return_value = [{"email_account": "a@x.com", "encrypted_password": "enc2"}]
+        self.app.post('/mail/receive_from_db', data=json.dumps({}), content_type='application/json')
+        self.assertEqual(mock_execute_query.call_count, 3)
+        mock_decrypt.assert_called_with("enc2")
+
+    @patch('crud_sql_apiserver.decrypt_password', side_effect=lambda enc: "secret-" + enc)
+    def test_eviction_zeroizes_secret(self, mock_decrypt):
+        cache = crud_sql_apiserver._CredentialCache(ttl=60, max_size=1)
+        self.assertEqual(cache.password("a@x.com", "1"), "secret-1")
+        secret = cache._secrets["a@x.com"][1]
+
+        cache.password("b@x.com", "2")  # 超出 max_size，淘汰最久未用的 a@x.com
+        self.assertEqual(secret, bytearray(len("secret-1")))
+        self.assertNotIn("a@x.com", cache._secrets)
+
+        secret = cache._secrets["b@x.com"][1]
+        self.assertEqual(cache.password("b@x.com", "3"), "secret-3")  # 密文变化视为未命中
+        self.assertEqual(secret, bytearray(len("secret-2")))
+
+        cache.invalidate()
+        self.assertEqual(cache._secrets, {})
+
+
+class MailPartsTest(unittest.TestCase):
+    PDF = bytes(range(256)) * 40
+    BODYSTRUCTURE = (b'1 (UID 9 BODYSTRUCTURE (("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 5 1 NIL NIL NIL NIL)'
+                     b'("application" "pdf" ("name" "=?utf-8?B?5pa95bel5Zu+LnBkZg==?=") NIL NIL "base64" 13840 NIL '
+                     b'("attachment" ("filename*" "utf-8\'\'%E6%96%BD%E5%B7%A5%E5%9C%96.pdf")) NIL NIL) "mixed" '
+                     b'("boundary" "b1") NIL NIL NIL))')
+
+    def setUp(self):
+        crud_sql_apiserver._imap_pool.close_all()
+        crud_sql_apiserver._credential_cache.invalidate()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        crud_sql_apiserver._imap_pool.close_all()
+
+    def _mailbox(self):
+        encoded = base64.encodebytes(self.PDF)
+        conn = _mock_imap_conn()
+        conn.partial_fetches = []
+
+        def uid(command, uid_set, item):
+            if item == "(UID BODYSTRUCTURE)":
+                return "OK", [self.BODYSTRUCTURE]
+            m = re.match(r"\(UID BODY\.PEEK\[2\]<(\d+)\.(\d+)>\)", item)
+            offset, size = int(m.group(1)), int(m.group(2))
+            conn.partial_fetches.append(offset)
+            chunk = encoded[offset:offset + size]
+            return "OK", [(f"1 (UID 9 BODY[2]<{offset}> {{{len(chunk)}}}".encode(), chunk), b")"]
+
+        conn.uid.side_effect = uid
+        return conn
+
+    def test_bodystructure_tree(self):
+        """BODYSTRUCTURE 解析为带 part 编号的结构树，文件名按 RFC 2231 解码"""
+        tree = crud_sql_apiserver._bodystructure_node(
+            crud_sql_apiserver._imap_parse_sexp(self.BODYSTRUCTURE[self.BODYSTRUCTURE.index(b"((") + 1:]), None)
+        self.assertEqual(tree["type"], "multipart/mixed")
+        self.assertEqual([(p["part"], p["type"]) for p in tree["parts"]], [("1", "text/plain"), ("2", "application/pdf")])
+        self.assertEqual(tree["parts"][1]["filename"], "施工圖.pdf")
+        self.assertEqual(tree["parts"][1]["disposition"], "attachment")
+        self.assertEqual(tree["parts"][0]["charset"], "utf-8")
+
+    @patch('crud_sql_apiserver.MAIL_PART_CHUNK_BYTES', 4096)
+    @patch('crud_sql_apiserver.decrypt_password', return_value="pwd")
+    @patch('crud_sql_apiserver.execute_query', return_value=[{"encrypted_password": "enc"}])
+    @patch('crud_sql_apiserver.imaplib.IMAP4_SSL')
+    def test_fetch_part_streams_decoded_chunks(self, mock_imap_ssl, mock_execute_query, mock_decrypt):
+        """未传密码时从数据库读取；附件分段 FETCH 并增量 base64 解码"""
+        conn = self._mailbox()
+        mock_imap_ssl.return_value = conn
+
+        response = self.app.post('/mail/parts/fetch',
+                                 data=json.dumps({"email_account": "a@x.com", "uid": 9, "part": "2",
+                                                  "IMAP_SERVER": "imap.x.com", "IMAP_PORT": 993}),
+                                 content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.PDF)
+        self.assertEqual(response.mimetype, "application/pdf")
+        self.assertIn("filename*=UTF-8''%E6%96%BD", response.headers["Content-Disposition"])
+        self.assertEqual(conn.partial_fetches, [0, 4096, 8192, 12288])
+        mock_decrypt.assert_called_once_with("enc")
+
+        response = self.app.post('/mail/parts/fetch',
+                                 data=json.dumps({"email_account": "a@x.com", "email_password": "pwd", "uid": 9,
+                                                  "part": "3", "IMAP_SERVER": "imap.x.com", "IMAP_PORT": 993}),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+
+
+class MailOutboxTest(unittest.TestCase):
+    ACCOUNT = {"email_account": "a@x.com", "email_password": "pwd", "SMTP_SERVER": "smtp.x.com", "SMTP_PORT": 587}
+
+    def setUp(self):
+        crud_sql_apiserver._smtp_pool.close_all()
+        self.app = app.test_client()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.patches = [
+            patch('crud_sql_apiserver.MAIL_OUTBOX_DB_PATH', os.path.join(self.tmpdir.name, "outbox.sqlite3")),
+            patch('crud_sql_apiserver.MAIL_OUTBOX_RETRY_BASE', 0),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        crud_sql_apiserver._mail_outbox.stop()
+        crud_sql_apiserver._smtp_pool.close_all()
+        for p in self.patches:
+            p.stop()
+        self.tmpdir.cleanup()
+
+    def _post(self, path, payload):
+        return self.app.post(path, data=json.dumps(payload), content_type='application/json')
+
+    def _wait_done(self, batch_id):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            body = self._post('/mail/send_batch/status', {"batch_id": batch_id}).get_json()
+            if body["status"] == "done":
+                return body
+            time.sleep(0.01)
+        self.fail("批次未在 5 秒内完成")
+
+    @patch('crud_sql_apiserver.smtplib.SMTP')
+    def test_batch_reuses_session_and_retries_transient(self, mock_smtp):
+        """整批只登录一次；4xx 限流重试后成功，5xx 拒收直接失败，均不丢弃会话"""
+        throttled = []
+
+        def sendmail(from_addr, to_addrs, raw):
+            if to_addrs == ["c@x.com"] and not throttled:
+                throttled.append(1)
+                raise crud_sql_apiserver.smtplib.SMTPDataError(451, b"throttled")
+            if to_addrs == ["bad@x.com"]:
+                raise crud_sql_apiserver.smtplib.SMTPRecipientsRefused({"bad@x.com": (550, b"no such user")})
+            return {}
+
+        server = MagicMock()
+        server.sendmail.side_effect = sendmail
+        mock_smtp.return_value = server
+
+        response = self._post('/mail/send_batch', dict(self.ACCOUNT, subject="日报", content="内容", messages=[
+            {"to": "b@x.com"}, {"to": "c@x.com", "subject": "单独主题"}, {"to": "bad@x.com"},
+        ]))
+        self.assertEqual(response.status_code, 202)
+
+        status = self._wait_done(response.get_json()["batch_id"])
+        self.assertEqual([(m["to"], m["status"], m["attempts"]) for m in status["messages"]],
+                         [("b@x.com", "sent", 1), ("c@x.com", "sent", 2), ("bad@x.com", "failed", 1)])
+        self.assertEqual((status["sent_count"], status["failed_count"]), (2, 1))
+        mock_smtp.assert_called_once()
+        server.login.assert_called_once_with("a@x.com", "pwd")
+
+    @patch('crud_sql_apiserver.smtplib.SMTP')
+    def test_queued_send_returns_immediately(self, mock_smtp):
+        """queued=true 时 /mail/send 入队即返回；密码加密存储，投递后清除"""
+        mock_smtp.return_value = MagicMock()
+        response = self._post('/mail/send', dict(self.ACCOUNT, to="b@x.com", subject="s", queued=True))
+        self.assertEqual(response.status_code, 202)
+        message_id = response.get_json()["message_id"]
+
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            body = self._post('/mail/outbox/status', {"message_ids": [message_id, "missing"]}).get_json()
+            if body["messages"][0]["status"] == "sent":
+                break
+            time.sleep(0.01)
+        self.assertEqual(body["messages"][0]["status"], "sent")
+        self.assertEqual(body["not_found"], ["missing"])
+        conn = crud_sql_apiserver._mail_outbox_conn()
+        self.assertIsNone(conn.execute("SELECT encrypted_password FROM mail_outbox").fetchone()[0])
+        conn.close()
+
+    def test_rate_limiter(self):
+        limiter = crud_sql_apiserver._AccountRateLimiter(2)
+        self.assertEqual([limiter.try_acquire("a", 0) for _ in range(3)], [True, True, False])
+        self.assertTrue(limiter.try_acquire("b", 0))
+        self.assertTrue(limiter.try_acquire("a", 30))
+
+    def test_batch_validation(self):
+        response = self._post('/mail/send_batch', dict(self.ACCOUNT, messages=[{"subject": "无收件人"}]))
+        self.assertEqual(response.status_code, 400)
+
+    def _insert_rows(self, rows):
+        """rows: [(message_id, email_account, status, owner_pid, claimed_at, next_attempt_at)]"""
+        conn = crud_sql_apiserver._mail_outbox_conn()
+        conn.executemany(
+            "INSERT INTO mail_outbox (message_id, email_account, smtp_server, smtp_port, to_addr, status, owner_pid, "
+            "claimed_at, next_attempt_at, created_at, updated_at) VALUES (?, ?, 's', 25, 't@x.com', ?, ?, ?, ?, ?, ?)",
+            [r + (r[5], r[5]) for r in rows],
+        )
+        return conn
+
+    def test_start_requeues_only_stale_or_own_leases(self):
+        """启动时只收回本 pid 遗留的与超时的租约，其他存活进程正在发送的邮件不动"""
+        now = time.time()
+        conn = self._insert_rows([
+            ("own", "a@x.com", "sending", os.getpid(), now, now),
+            ("other", "a@x.com", "sending", os.getpid() + 1, now, now),
+            ("stale", "a@x.com", "sending", os.getpid() + 1, now - 3600, now),
+        ])
+        outbox = crud_sql_apiserver._MailOutbox()
+        with patch.object(outbox, "_ensure_workers"):
+            outbox.start()
+        status = dict(conn.execute("SELECT message_id, status FROM mail_outbox").fetchall())
+        conn.close()
+        self.assertEqual(status, {"own": "queued", "other": "sending", "stale": "queued"})
+
+    def test_claim_is_fair_across_accounts(self):
+        """大批量账号被限速时，其他账号的到期邮件仍能领取"""
+        now = time.time()
+        conn = self._insert_rows(
+            [(f"big{i}", "big@x.com", "queued", None, None, now - 100 + i * 0.001) for i in range(200)]
+            + [("small", "small@x.com", "queued", None, None, now)]
+        )
+        outbox = crud_sql_apiserver._MailOutbox()
+        outbox._limiter = crud_sql_apiserver._AccountRateLimiter(1)
+        claimed = [outbox._claim(conn) for _ in range(3)]
+        conn.close()
+        self.assertEqual([r["message_id"] if r else None for r in claimed], ["big0", "small", None])
+
+
+
+class EmailEverydayTest(unittest.TestCase):
+    def _mock_conn(self, mock_get_conn, existing_ids):
+        mock_conn = MagicMock()
+        mock_cur = MagicMock()
+        mock_get_conn.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        mock_cur.fetchall.return_value = [{"email_id": uid, "received_time": "2026-10-19 09:00:00"} for uid in existing_ids]
+        mock_cur.rowcount = 0
+        return mock_cur
+
+    @patch('crud_sql_apiserver.get_conn')
+    def test_add_read_ids_bulk_insert(self, mock_get_conn):
+        """500 个 UID：一条 IN 查询 + 一条多行 INSERT IGNORE，区分新写入与已存在"""
+        mock_cur = self._mock_conn(mock_get_conn, ["2", "4"])
+        uids = [str(u) for u in range(1, 501)] + ["3", " "]
+
+        res = crud_sql_apiserver.add_read_ids("a@x.com", uids)
+
+        self.assertEqual(mock_cur.execute.call_count, 2)
+        select_sql, select_params = mock_cur.execute.call_args_list[0].args
+        insert_sql, insert_params = mock_cur.execute.call_args_list[1].args
+        self.assertIn("IN (", select_sql)
+        self.assertEqual(len(select_params), 501)
+        self.assertEqual(insert_sql.count("(%s, %s, %s)"), 498)
+        self.assertEqual(insert_params[:2], ("a@x.com", "1"))
+        self.assertEqual(res["existing_uids"], ["2", "4"])
+        self.assertEqual(len(res["added_uids"]), 498)
+
+
+    @patch('crud_sql_apiserver.get_conn')
+    def test_check_handled_chunks_in_list(self, mock_get_conn):
+        """1200 个 UID 分 3 批 IN 查询，结果按请求顺序返回"""
+        mock_cur = self._mock_conn(mock_get_conn, ["7"])
+        uids = [str(u) for u in range(1, 1201)]
+
+        response = app.test_client().post('/email_everyday/check',
+                                          data=json.dumps({"email_account": "a@x.com", "email_ids": uids}),
+                                          content_type='application/json')
+
+        body = response.get_json()
+        self.assertEqual(mock_cur.execute.call_count, 3)
+        self.assertTrue(all(len(c.args[1]) <= 501 for c in mock_cur.execute.call_args_list))
+        self.assertEqual(body["handled_count"], 1)
+        self.assertEqual(body["results"][6], {"email_id": "7", "handled": True, "received_time": "2026-10-19 09:00:00"})
+        self.assertEqual([r["email_id"] for r in body["results"]], uids)
+
+    @patch('crud_sql_apiserver.execute_query')
+    def test_ensure_index(self, mock_execute_query):
+        mock_execute_query.return_value = [{"INDEX_NAME": "PRIMARY", "SEQ_IN_INDEX": 1, "COLUMN_NAME": "id"}]
+        self.assertEqual(crud_sql_apiserver.ensure_email_everyday_index(),
+                         ["idx_email_everyday_account_email", "idx_email_everyday_received"])
+        self.assertIn("ADD INDEX", mock_execute_query.call_args.args[0])
+
+        mock_execute_query.reset_mock()
+        mock_execute_query.return_value = [
+            {"INDEX_NAME": "uniq_account_email", "SEQ_IN_INDEX": 1, "COLUMN_NAME": "email_account"},
+            {"INDEX_NAME": "uniq_account_email", "SEQ_IN_INDEX": 2, "COLUMN_NAME": "email_id"},
+            {"INDEX_NAME": "idx_received", "SEQ_IN_INDEX": 1, "COLUMN_NAME": "received_time"},
+        ]
+        self.assertEqual(crud_sql_apiserver.ensure_email_everyday_index(), [])
+        mock_execute_query.assert_called_once()
+
+    @patch('crud_sql_apiserver.execute_query')
+    def test_ensure_index_check_only(self, mock_execute_query):
+        """create=False 只报告缺少的索引，不执行 ALTER TABLE"""
+        mock_execute_query.return_value = [{"INDEX_NAME": "PRIMARY", "SEQ_IN_INDEX": 1, "COLUMN_NAME": "id"}]
+        self.assertEqual(crud_sql_apiserver.ensure_email_everyday_index(create=False),
+                         ["idx_email_everyday_account_email", "idx_email_everyday_received"])
+        mock_execute_query.assert_called_once()
+
+    @patch('crud_sql_apiserver.execute_query')
+    def test_list_keyset_pagination(self, mock_execute_query):
+        """多取一行判断是否还有下一页，X-Next-Cursor 指向本页最后一行"""
+        mock_execute_query.return_value = [
+            {"id": 30 - i, "email_account": "a@x.com", "email_id": str(i), "received_time": "2026-10-19 09:00:00"}
+            for i in range(3)
+        ]
+        client = app.test_client()
+        response = client.get('/email_everyday?email_account=a@x.com&limit=2')
+
+        self.assertEqual(len(response.get_json()), 2)
+        self.assertIn("LIMIT 3", mock_execute_query.call_args.args[0])
+        cursor = response.headers["X-Next-Cursor"]
+        self.assertEqual(crud_sql_apiserver._email_everyday_decode_cursor(cursor), ("2026-10-19 09:00:00", 29))
+
+        mock_execute_query.return_value = []
+        response = client.get(f'/email_everyday?email_account=a@x.com&limit=2&cursor={cursor}')
+        sql, params = mock_execute_query.call_args.args[:2]
+        self.assertIn("`received_time` < %s OR (`received_time` = %s AND `id` < %s)", sql)
+        self.assertEqual(params, ("a@x.com", "2026-10-19 09:00:00", "2026-10-19 09:00:00", 29))
+        self.assertNotIn("X-Next-Cursor", response.headers)
+
+        self.assertEqual(client.get('/email_everyday?cursor=!!').status_code, 400)
+
+        # 不传 limit / cursor 时与以前一样返回全部
+        mock_execute_query.return_value = [{"id": i} for i in range(300)]
+        response = client.get('/email_everyday?email_account=a@x.com')
+        self.assertEqual(len(response.get_json()), 300)
+        self.assertNotIn("LIMIT", mock_execute_query.call_args.args[0])
+
+    @patch('email_everyday_maintenance.get_conn')
+    @patch('email_everyday_maintenance.email_everyday_partitions')
+    def test_maintain_partitions_reports_only_created(self, mock_partitions, mock_get_conn):
+        """没有 pmax 时不会拆分出新分区，added 为空并给出警告"""
+        mock_partitions.return_value = [("p200001", "'2000-02-01'")]
+        res = email_everyday_maintenance.maintain_partitions(months_ahead=1, drop_expired=False)
+        self.assertEqual(res["added"], [])
+        self.assertIn("pmax", res["warning"])
+        mock_get_conn.return_value.cursor.return_value.__enter__.return_value.execute.assert_not_called()
+
+        mock_partitions.return_value.append(("pmax", "MAXVALUE"))
+        res = email_everyday_maintenance.maintain_partitions(months_ahead=1, drop_expired=False)
+        self.assertEqual(len(res["added"]), 2)
+        self.assertIsNone(res["warning"])
+
+    @patch('email_everyday_maintenance.hk_now', return_value=datetime(2026, 10, 19, 9, 0))
+    @patch('email_everyday_maintenance.execute_query')
+    @patch('email_everyday_maintenance.email_everyday_partitions', return_value=[])
+    def test_partition_ddl_extends_unique_key(self, mock_partitions, mock_execute_query, mock_now):
+        """未分区时给出的 DDL 同时改主键和唯一键（否则 MySQL 报 1503），并提示先开启写入串行化"""
+        mock_execute_query.return_value = [{"first": datetime(2026, 9, 3, 8, 0)}]
+        res = email_everyday_maintenance.maintain_partitions(months_ahead=1)
+        self.assertFalse(res["partitioned"])
+        self.assertIn("EMAIL_EVERYDAY_SERIALIZE_WRITES=1", res["notice"])
+        self.assertEqual(res["ddl"], [
+            "ALTER TABLE `email_everyday` DROP PRIMARY KEY, ADD PRIMARY KEY (`id`, `received_time`), "
+            "DROP INDEX `uniq_account_email`, "
+            "ADD UNIQUE KEY `uniq_account_email` (`email_account`, `email_id`, `received_time`)",
+            "ALTER TABLE `email_everyday` PARTITION BY RANGE COLUMNS(`received_time`) (\n"
+            "    PARTITION p202609 VALUES LESS THAN ('2026-10-01'),\n"
+            "    PARTITION p202610 VALUES LESS THAN ('2026-11-01'),\n"
+            "    PARTITION p202611 VALUES LESS THAN ('2026-12-01'),\n"
+            "    PARTITION pmax VALUES LESS THAN (MAXVALUE)\n)",
+        ])
+
+    @patch('crud_sql_apiserver.EMAIL_EVERYDAY_SERIALIZE_WRITES', True)
+    @patch('crud_sql_apiserver.get_conn')
+    def test_add_read_ids_serializes_per_account(self, mock_get_conn):
+        """分区后没有唯一键：同账号写入先取 GET_LOCK，取不到锁时报错"""
+        mock_cur = MagicMock()
+        mock_get_conn.return_value.cursor.return_value.__enter__.return_value = mock_cur
+        mock_cur.fetchone.return_value = {"locked": 1}
+        mock_cur.fetchall.return_value = []
+        mock_cur.rowcount = 1
+        crud_sql_apiserver.add_read_ids("A@x.com ", ["1"])
+        sql, params = mock_cur.execute.call_args_list[0].args
+        self.assertIn("GET_LOCK", sql)
+        self.assertEqual(params[0], crud_sql_apiserver._email_everyday_lock_name("a@x.com"))
+
+        mock_cur.fetchone.return_value = {"locked": 0}
+        with self.assertRaises(RuntimeError):
+            crud_sql_apiserver.add_read_ids("a@x.com", ["2"])
+
+    @patch('email_everyday_maintenance.execute_query')
+    def test_prune_archives_then_deletes_in_batches(self, mock_execute_query):
+        batches = [
+            [{"id": 1, "email_id": "u1", "received_time": datetime(2026, 1, 1)},
+             {"id": 2, "email_id": "u2", "received_time": datetime(2026, 1, 2)}],
+            [{"id": 5, "email_id": "u5", "received_time": datetime(2026, 1, 3)}],
+        ]
+
+        def fake_query(sql, params=(), fetch=False, **kwargs):
+            if sql.startswith("SELECT"):
+                return batches.pop(0) if batches else []
+            return len(params)
+
+        mock_execute_query.side_effect = fake_query
+        with tempfile.TemporaryDirectory() as tmp:
+            res = email_everyday_maintenance.prune_email_everyday(90, archive_dir=tmp, batch_size=2)
+            with gzip.open(res["archive_file"], "rt", encoding="utf-8") as f:
+                archived = [json.loads(line) for line in f]
+
+        self.assertEqual(res["deleted"], 3)
+        self.assertEqual([r["email_id"] for r in archived], ["u1", "u2", "u5"])
+        self.assertEqual(archived[0]["received_time"], "2026-01-01 00:00:00")
+        deletes = [c.args for c in mock_execute_query.call_args_list if c.args[0].startswith("DELETE")]
+        self.assertEqual([d[1] for d in deletes], [(1, 2), (5,)])
+        # 第二批从上一批最后的 id 之后继续
+        selects = [c.args for c in mock_execute_query.call_args_list if c.args[0].startswith("SELECT")]
+        self.assertEqual(selects[1][1][1], 2)
+
+
+
+class HandledMailIndexTest(unittest.TestCase):
+    def _warm_index(self, rows):
+        index = crud_sql_apiserver._HandledMailIndex()
+        with patch('crud_sql_apiserver.execute_query', side_effect=[rows, []]):
+            index.warm_up()
+        return index
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = crud_sql_apiserver._BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(str(i))
+        self.assertTrue(all(str(i) in bloom for i in range(1000)))
+        false_positives = sum(1 for i in range(1000, 11000) if str(i) in bloom)
+        self.assertLess(false_positives, 300)
+
+    @patch('crud_sql_apiserver.get_conn')
+    def test_check_answers_from_index(self, mock_get_conn):
+        """预热后未处理的 UID 不查库；精确表命中直接返回；只有 Bloom 可能命中的才查库"""
+        rows = [{"id": i, "email_account": "a@x.com", "email_id": str(i), "received_time": "t"} for i in range(1, 11)]
+        with patch('crud_sql_apiserver.HANDLED_RECENT_SIZE', 5):
+            index = self._warm_index(rows)
+        client = app.test_client()
+
+        with patch('crud_sql_apiserver._handled_index', index):
+            body = client.post('/email_everyday/check',
+                               data=json.dumps({"email_account": "a@x.com", "email_ids": ["9", "100", "101"]}),
+                               content_type='application/json').get_json()
+            mock_get_conn.assert_not_called()
+            self.assertEqual([r["handled"] for r in body["results"]], [True, False, False])
+
+            mock_cur = MagicMock()
+            mock_get_conn.return_value.cursor.return_value.__enter__.return_value = mock_cur
+            mock_cur.fetchall.return_value = [{"email_id": "2", "received_time": "t"}]
+            body = client.post('/email_everyday/check',
+                               data=json.dumps({"email_account": "a@x.com", "email_ids": ["2"]}),
+                               content_type='application/json').get_json()
+            self.assertEqual(mock_cur.execute.call_args.args[1], ("a@x.com", "2"))
+            self.assertTrue(body["results"][0]["handled"])
+
+    @patch('crud_sql_apiserver.get_conn')
+    def test_check_list_input_strips_uids(self, mock_get_conn):
+        """列表形式的 email_ids 与 add_read_ids 一样去掉首尾空格：" 9" 命中索引中的 9"""
+        rows = [{"id": 1, "email_account": "a@x.com", "email_id": "9", "received_time": "t"}]
+        index = self._warm_index(rows)
+        with patch('crud_sql_apiserver._handled_index', index):
+            body = app.test_client().post('/email_everyday/check',
+                                          data=json.dumps({"email_account": "a@x.com", "email_ids": [" 9", 10]}),
+                                          content_type='application/json').get_json()
+        mock_get_conn.assert_not_called()
+        self.assertEqual([(r["email_id"], r["handled"]) for r in body["results"]], [("9", True), ("10", False)])
+
+    def test_add_read_ids_updates_index_and_sync_picks_up_other_writers(self):
+        index = self._warm_index([])
+        index.add("a@x.com", ["42"], "t")
+        self.assertEqual(index.classify("a@x.com", ["42", "43"]), ({"42": "t"}, []))
+
+        index._last_sync = 0
+        other = [{"id": 7, "email_account": "a@x.com", "email_id": "43", "received_time": "t2"}]
+        with patch('crud_sql_apiserver.execute_query', return_value=other) as mock_execute_query:
+            self.assertTrue(index.sync())
+        self.assertEqual(mock_execute_query.call_args.args[1], (0,))
+        self.assertEqual(index.classify("a@x.com", ["43"]), ({"43": "t2"}, []))
+
+    def test_sync_rereads_overlap_window(self):
+        """晚提交的较小 id：下一次同步从回看窗口起点重读，不会永久漏掉"""
+        index = self._warm_index([{"id": 10, "email_account": "a@x.com", "email_id": "10", "received_time": "t"}])
+        index._last_sync = 0
+        with patch('crud_sql_apiserver.execute_query', return_value=[]) as mock_execute_query:
+            index.sync()
+            index._last_sync = 0
+            late = [{"id": 9, "email_account": "a@x.com", "email_id": "9", "received_time": "t"}]
+            mock_execute_query.return_value = late
+            index.sync()
+        self.assertEqual(mock_execute_query.call_args.args[1], (10,))
+        index._checkpoints.clear()
+        index._checkpoints.append((0, 8))
+        index._last_sync = 0
+        with patch('crud_sql_apiserver.execute_query', return_value=late) as mock_execute_query:
+            index.sync()
+        self.assertEqual(mock_execute_query.call_args.args[1], (8,))
+        self.assertEqual(index.classify("a@x.com", ["9"]), ({"9": "t"}, []))
+
+    def test_classify_normalizes_account_and_falls_back_to_db(self):
+        index = self._warm_index([{"id": 1, "email_account": "A@x.com ", "email_id": "1", "received_time": "t"}])
+        self.assertEqual(index.classify("a@X.com", ["1", "2"]), ({"1": "t"}, []))
+        # 索引里没有的账号不能断定未处理
+        self.assertEqual(index.classify("b@x.com", ["1"]), ({}, ["1"]))
+        # 早于保留期的记录可能已被清理，查库确认
+        index.add("a@x.com", ["old"], datetime(2000, 1, 1))
+        self.assertEqual(index.classify("a@x.com", ["old"]), ({}, ["old"]))
+
+
+class ConvertTest(unittest.TestCase):
+    def setUp(self):
+        crud_sql_apiserver._convert_cached.cache_clear()
+        self.app = app.test_client()
+
+    def test_batch_uses_cache(self):
+        """重复的短字符串只转换一次，其余命中缓存"""
+        texts = ["拆板", "3楼", "拆板", "拆板"]
+        with patch('crud_sql_apiserver.convert', side_effect=lambda text, target: f"{target}:{text}") as mock_convert:
+            response = self.app.post('/convert/batch', data=json.dumps({"texts": texts, "target": "zh-hk"}),
+                                     content_type='application/json')
+            self.assertEqual(response.get_json()["results"], ["zh-hk:拆板", "zh-hk:3楼", "zh-hk:拆板", "zh-hk:拆板"])
+            self.assertEqual(mock_convert.call_count, 2)
+
+            self.app.post('/convert?target=zh-hk', data="拆板".encode("utf-8"))
+            self.assertEqual(mock_convert.call_count, 2)
+
+        stats = self.app.get('/convert/stats').get_json()
+        self.assertEqual((stats["hits"], stats["misses"], stats["hit_rate"]), (3, 2, 0.6))
+
+    def test_batch_validation(self):
+        post = lambda body: self.app.post('/convert/batch', data=json.dumps(body), content_type='application/json')
+        self.assertEqual(post({"texts": []}).status_code, 400)
+        self.assertEqual(post({"texts": ["a", 1]}).status_code, 400)
+        self.assertEqual(post({"texts": ["a"], "target": "zh-xx"}).get_json()["code"], "invalid_target")
+        self.assertEqual(post({"texts": ["后"]}).get_json()["results"], ["後"])
+
+    def test_stream_matches_whole_document(self):
+        """流式转换按行切分，多字节字符跨块也能正确拼接，结果与整篇转换一致"""
+        doc = "".join(f"# 第{i}节 后面的发展\n软件与硬件，头发和发财。\n" for i in range(2000)).encode("utf-8")
+        chunks = [doc[i:i + 1000] for i in range(0, len(doc), 1000)]
+        pieces = list(crud_sql_apiserver._iter_converted_chunks(iter(chunks), "zh-hk"))
+        self.assertGreater(len(pieces), 1)
+        self.assertEqual("".join(pieces), crud_sql_apiserver.convert(doc.decode("utf-8"), "zh-hk"))
+
+        # 单行超长时在标点处切分
+        self.assertEqual(crud_sql_apiserver._convert_split_point("头发，后来" * 3, 10), 13)
+        self.assertEqual(crud_sql_apiserver._convert_split_point("头发后来", 10), 0)
+
+        response = self.app.post('/convert?stream=true&target=zh-hk', data=doc)
+        self.assertEqual(response.mimetype, "text/plain")
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.get_data(as_text=True), "".join(pieces))
+        self.assertEqual(self.app.post('/convert?stream=1', data=b"").status_code, 400)
+
+    def test_warm_up_builds_every_target(self):
+        report = crud_sql_apiserver.warm_up_converters()
+        self.assertEqual(set(report), set(crud_sql_apiserver.CONVERT_TARGETS))
+        self.assertEqual(self.app.get('/convert/stats').get_json()["warmup_ms"], report)
+        # 预热不占用转换缓存
+        self.assertEqual(crud_sql_apiserver._convert_cached.cache_info().currsize, 0)
+
+
+class JiaodikaSearchTest(unittest.TestCase):
+    ROW = {"id": 3, "gongchengfenlei": "模板工程", "gongxu": "拆板", "caozuogongyi": "先拆侧模，后拆底模。" * 20,
+           "anquanshixiang": "拆除时设警戒区，严禁上下同时作业。"}
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.fulltext_patch = patch('crud_sql_apiserver._jiaodika_fulltext_available', True)
+        self.fulltext_patch.start()
+
+    def tearDown(self):
+        self.fulltext_patch.stop()
+
+    @patch('crud_sql_apiserver.execute_query')
+    def test_fulltext_ranked_with_snippets(self, mock_execute_query):
+        mock_execute_query.return_value = [{**self.ROW, "score": 1.5}]
+        body = self.app.get('/jiaodika/search?q=警戒区 拆底模&k=5').get_json()
+
+        sql, params = mock_execute_query.call_args.args[:2]
+        self.assertIn("AGAINST (%s IN NATURAL LANGUAGE MODE)", sql)
+        self.assertIn("LIMIT 5", sql)
+        self.assertEqual(params, ("警戒区 拆底模", "警戒区 拆底模"))
+        self.assertEqual(body["mode"], "fulltext")
+        result = body["results"][0]
+        self.assertEqual((result["id"], result["score"]), (3, 1.5))
+        self.assertEqual(set(result["snippets"]), {"caozuogongyi", "anquanshixiang"})
+        self.assertTrue(result["snippets"]["caozuogongyi"].endswith("…"))
+        self.assertLessEqual(len(result["snippets"]["caozuogongyi"]), crud_sql_apiserver.JIAODIKA_SNIPPET_CHARS + 2)
+
+    @patch('crud_sql_apiserver.execute_query')
+    def test_short_terms_fall_back_to_like(self, mock_execute_query):
+        other = {"id": 1, "gongxu": "扎铁", "anquanshixiang": "戴安全帽"}
+        mock_execute_query.return_value = [other, self.ROW]
+        body = self.app.get('/jiaodika/search?q=拆 %').get_json()
+
+        sql, params = mock_execute_query.call_args.args[:2]
+        self.assertNotIn("MATCH", sql)
+        self.assertIn("%\\%%", params)
+        self.assertEqual(body["mode"], "like")
+        self.assertEqual([r["id"] for r in body["results"]], [3, 1])
+        self.assertEqual(self.app.get('/jiaodika/search').status_code, 400)
+
+    @patch('crud_sql_apiserver._jiaodika_fulltext_checked_at', 0.0)
+    @patch('crud_sql_apiserver.execute_query')
+    def test_only_missing_index_disables_fulltext(self, mock_execute_query):
+        """临时错误只让本次回退 LIKE；索引不存在（1191）才停用，过了重检间隔再检查"""
+        lost = crud_sql_apiserver.pymysql.err.OperationalError(2013, "Lost connection")
+        mock_execute_query.side_effect = [lost, [self.ROW]]
+        self.assertEqual(self.app.get('/jiaodika/search?q=警戒区').get_json()["mode"], "like")
+        self.assertTrue(crud_sql_apiserver._jiaodika_fulltext_available)
+
+        missing = crud_sql_apiserver.pymysql.err.OperationalError(1191, "Can't find FULLTEXT index")
+        mock_execute_query.side_effect = [missing, [self.ROW], [self.ROW]]
+        self.app.get('/jiaodika/search?q=警戒区')
+        self.assertFalse(crud_sql_apiserver._jiaodika_fulltext_available)
+        self.assertEqual(self.app.get('/jiaodika/search?q=警戒区').get_json()["mode"], "like")
+
+        with patch('crud_sql_apiserver.JIAODIKA_FULLTEXT_RECHECK', 0), \
+                patch('crud_sql_apiserver._jiaodika_has_fulltext_index', return_value=True):
+            mock_execute_query.side_effect = [[{**self.ROW, "score": 1}]]
+            self.assertEqual(self.app.get('/jiaodika/search?q=警戒区').get_json()["mode"], "fulltext")
+
+
+class JiaodikaSnapshotTest(unittest.TestCase):
+    ROWS = [
+        {"id": i, "gongchengfenlei": "模板工程" if i % 2 else "钢筋工程", "gongxu": f"工序{i}",
+         "caozuogongyi": "长文本" * 100, "updated_at": "2026-10-19 09:00:00"}
+        for i in range(1, 8)
+    ]
+
+    def setUp(self):
+        crud_sql_apiserver._jiaodika_snapshot.invalidate()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        crud_sql_apiserver._jiaodika_snapshot.invalidate()
+
+    def _fake_db(self, fingerprint=(7, 7, "2026-10-19 09:00:00")):
+        def fake_query(sql, params=(), fetch=False, **kwargs):
+            if "COUNT(*)" in sql:
+                return [{"n": fingerprint[0], "max_id": fingerprint[1], "version": fingerprint[2]}]
+            if sql.startswith("SELECT *"):
+                return [dict(row) for row in self.ROWS]
+            return 1
+        return fake_query
+
+    @patch('crud_sql_apiserver.execute_query')
+    def test_served_from_snapshot_with_projection_and_pages(self, mock_execute_query):
+        mock_execute_query.side_effect = self._fake_db()
+        url = '/jiaodika?gongchengfenlei=模板工程&fields=gongxu&limit=2'
+        response = self.app.get(url)
+        self.assertEqual(response.get_json(), [{"id": 1, "gongxu": "工序1"}, {"id": 3, "gongxu": "工序3"}])
+        self.assertEqual(response.headers["X-Next-Cursor"], "3")
+
+        response = self.app.get(url + '&cursor=3')
+        self.assertEqual([r["id"] for r in response.get_json()], [5, 7])
+        self.assertNotIn("X-Next-Cursor", response.headers)
+        # 第二次请求在校验间隔内，不再查库
+        self.assertEqual(mock_execute_query.call_count, 2)
+
+        self.assertEqual(self.app.get('/jiaodika?fields=nope').status_code, 400)
+        self.assertEqual(len(self.app.get('/jiaodika').get_json()), 7)
+
+    @patch('crud_sql_apiserver.execute_query')
+    def test_filters_follow_mysql_collation(self, mock_execute_query):
+        """与原先的 SQL `=` 一致：字符串忽略大小写与尾部空格，数值列按数字比较"""
+        self.ROWS = [{"id": 1, "gongchengfenlei": "Formwork", "gongxu": "Step A", "updated_at": None}]
+        mock_execute_query.side_effect = self._fake_db()
+        for query in ('gongchengfenlei=formwork%20%20', 'gongxu=STEP%20a', 'id=01', 'id=1.0'):
+            self.assertEqual([r["id"] for r in self.app.get(f'/jiaodika?{query}').get_json()], [1], query)
+        self.assertEqual(self.app.get('/jiaodika?gongxu=%20Step%20A').get_json(), [])
+
+    @patch('crud_sql_apiserver.execute_query')
+    def test_etag_and_invalidation(self, mock_execute_query):
+        mock_execute_query.side_effect = self._fake_db()
+        etag = self.app.get('/jiaodika?gongxu=工序2').headers["ETag"]
+        response = self.app.get('/jiaodika?gongxu=工序2', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+
+        # 其他进程修改后指纹变化：过了校验间隔重新加载，ETag 改变
+        mock_execute_query.side_effect = self._fake_db((7, 7, "2026-10-19 10:00:00"))
+        crud_sql_apiserver._jiaodika_snapshot.checked_at = 0
+        response = self.app.get('/jiaodika?gongxu=工序2', headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+
+        # 本进程更新：服务端写 updated_at（忽略 body 中的值）并立即失效
+        self.app.put('/jiaodika/2', data=json.dumps({"gongxu": "新工序", "updated_at": "2000-01-01 00:00:00"}),
+                     content_type='application/json')
+        update = [c.args for c in mock_execute_query.call_args_list if c.args[0].startswith("UPDATE")][0]
+        self.assertIn("`updated_at`=NOW(6)", update[0])
+        self.assertEqual(update[1], ("新工序", 2))
+        self.assertIsNone(crud_sql_apiserver._jiaodika_snapshot.rows)
+
+    @patch('crud_sql_apiserver.execute_query')
+    def test_row_version_detects_same_second_updates(self, mock_execute_query):
+        """有 row_version 列时指纹用 SUM(row_version)：同一秒内的修改也能被其他进程发现"""
+        mock_execute_query.side_effect = self._fake_db()
+        with patch.object(crud_sql_apiserver.JIAODIKA_FIELDS, "_state",
+                          (("id", "gongxu", "updated_at", "row_version"),
+                           frozenset(("id", "gongxu", "updated_at", "row_version")))):
+            self.app.get('/jiaodika')
+            self.app.put('/jiaodika/2', data=json.dumps({"gongxu": "新工序", "row_version": 0}),
+                         content_type='application/json')
+        fingerprint_sql = [c.args[0] for c in mock_execute_query.call_args_list if "COUNT(*)" in c.args[0]][0]
+        self.assertIn("SUM(`row_version`)", fingerprint_sql)
+        update = [c.args for c in mock_execute_query.call_args_list if c.args[0].startswith("UPDATE")][0]
+        self.assertIn("`row_version`=`row_version`+1", update[0])
+        self.assertEqual(update[1], ("新工序", 2))
+
+
+class JiaodikaBulkInsertTest(unittest.TestCase):
+    def _mock_conn(self, mock_get_conn):
+        mock_conn = MagicMock()
+        mock_cur = MagicMock()
+        mock_get_conn.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cur
+        return mock_conn, mock_cur
+
+    @patch('crud_sql_apiserver.execute_query')
+    @patch('crud_sql_apiserver.get_conn')
+    def test_grouped_executemany_in_one_transaction(self, mock_get_conn, mock_execute_query):
+        mock_conn, mock_cur = self._mock_conn(mock_get_conn)
+        records = [{"gongxu": f"工序{i}", "caozuogongyi": "..."} for i in range(1000)]
+        records += [{"gongxu": "只有工序"}, "bad", {"gongxu": "只有工序2"}]
+
+        response = app.test_client().post('/jiaodika', data=json.dumps(records), content_type='application/json')
+
+        self.assertEqual(response.status_code, 207)
+        results = response.get_json()
+        self.assertEqual(mock_cur.executemany.call_count, 2)
+        sql, rows = mock_cur.executemany.call_args_list[0].args
+        self.assertIn("`gongxu`, `caozuogongyi`", sql)
+        self.assertEqual(len(rows), 1000)
+        self.assertEqual(len(mock_cur.executemany.call_args_list[1].args[1]), 2)
+        mock_conn.commit.assert_called_once()
+        mock_execute_query.assert_not_called()
+        self.assertEqual(results[1001], {"error": "每条记录必须是 JSON 对象"})
+        self.assertEqual(results[1002], {"status": "ok", "affected_rows": 1})
+
+    @patch('crud_sql_apiserver.execute_query')
+    @patch('crud_sql_apiserver.get_conn')
+    def test_failed_batch_falls_back_to_per_row(self, mock_get_conn, mock_execute_query):
+        mock_conn, mock_cur = self._mock_conn(mock_get_conn)
+        mock_cur.executemany.side_effect = DataError(1406, "Data too long for column 'gongxu'")
+        mock_execute_query.side_effect = [1, DataError(1406, "Data too long"), 1]
+
+        results = crud_sql_apiserver._insert_many_jiaodika([{"gongxu": "a"}, {"gongxu": "b" * 9999}, {"gongxu": "c"}])
+
+        mock_conn.rollback.assert_called_once()
+        self.assertEqual([r.get("status") for r in results], ["ok", None, "ok"])
+        self.assertEqual(results[1]["error"], "插入失败")
+
+
+class SchemaRegistryTest(unittest.TestCase):
+    COLUMNS = [
+        {"TABLE_NAME": "jiaodika", "COLUMN_NAME": c}
+        for c in ["id", "gongchengfenlei", "gongxu", "remark", "updated_at"]
+    ] + [{"TABLE_NAME": "e_permit3", "COLUMN_NAME": c} for c in ["id", "group_id", "floor", "created_by"]]
+
+    def setUp(self):
+        self.saved = {f.table: list(f) for f in crud_sql_apiserver._schema_registry._fields.values()}
+        self.app = app.test_client()
+
+    def tearDown(self):
+        for f in crud_sql_apiserver._schema_registry._fields.values():
+            f.update(self.saved[f.table])
+        crud_sql_apiserver._schema_registry._tables = {}
+        crud_sql_apiserver._schema_registry.loaded_at = None
+
+    @patch('crud_sql_apiserver.execute_query')
+    def test_columns_served_from_registry(self, mock_execute_query):
+        mock_execute_query.return_value = self.COLUMNS
+        self.assertEqual(self.app.get('/columns?table=jiaodika').get_json(),
+                         {"columns": ["id", "gongchengfenlei", "gongxu", "remark", "updated_at"]})
+        self.assertEqual(self.app.get('/columns?table=nope').status_code, 404)
+        self.assertEqual(mock_execute_query.call_count, 1)
+        self.app.get('/columns?table=jiaodika&refresh=true')
+        self.assertEqual(mock_execute_query.call_count, 2)
+
+    @patch('crud_sql_apiserver.execute_query')
+    def test_whitelists_follow_real_schema(self, mock_execute_query):
+        mock_execute_query.return_value = self.COLUMNS
+        crud_sql_apiserver._schema_registry.refresh()
+
+        self.assertIn("remark", crud_sql_apiserver.JIAODIKA_FIELDS)
+        self.assertNotIn("caozuogongyi", crud_sql_apiserver.JIAODIKA_FIELDS)
+        # 没有出现在 information_schema 里的表保留声明的列
+        self.assertIn("encrypted_password", crud_sql_apiserver.EMAIL_ACCOUNT_FIELDS)
+
+        mock_execute_query.reset_mock()
+        mock_execute_query.return_value = 1
+        self.app.put('/jiaodika/1', data=json.dumps({"remark": "x", "caozuogongyi": "y"}),
+                     content_type='application/json')
+        sql = mock_execute_query.call_args.args[0]
+        self.assertIn("`remark`=%s", sql)
+        self.assertNotIn("caozuogongyi", sql)
+
+
+class ImportTimeTest(unittest.TestCase):
+    """import crud_sql_apiserver 不应加载邮件/加密/简繁转换等重依赖，总耗时不超过预算"""
+    LAZY_MODULES = ("zhconv", "imaplib", "smtplib", "sqlite3", "cryptography.fernet", "dateutil.parser",
+                    "email.mime.multipart", "email.mime.text")
+    BUDGET_MS = int(os.getenv("IMPORT_TIME_BUDGET_MS", "1500"))
+
+    def test_import_is_lazy_and_within_budget(self):
+        code = ("import sys, crud_sql_apiserver\n"
+                f"print(','.join(m for m in {self.LAZY_MODULES!r} if type(sys.modules.get(m)).__name__ == 'module'))")
+        env = {k: v for k, v in os.environ.items() if k != "EMAIL_ENCRYPTION_KEY"}
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+
+        self.assertEqual(proc.returncode, 0, proc.stderr[-2000:])
+        self.assertEqual(proc.stdout.strip(), "", "以下模块在 import 时被提前加载")
+        cumulative_us = [int(line.split("|")[1]) for line in proc.stderr.splitlines()
+                         if line.rstrip().endswith("| crud_sql_apiserver")]
+        self.assertEqual(len(cumulative_us), 1)
+        self.assertLess(cumulative_us[0] / 1000, self.BUDGET_MS)
+
+    def test_lazy_modules_load_on_first_use(self):
+        crud_sql_apiserver.preload_lazy_modules()
+        self.assertTrue(all(type(m).__name__ == "module" for m in crud_sql_apiserver.LAZY_MODULES))
+        encrypted = crud_sql_apiserver.encrypt_password("pwd")
+        self.assertEqual(crud_sql_apiserver.decrypt_password(encrypted), "pwd")
+
+
+class StartupTest(unittest.TestCase):
+    """WSGI 部署通过 gunicorn.conf.py 的钩子执行启动步骤：密钥错误在启动时失败，后台任务每个进程只启动一次"""
+
+    def setUp(self):
+        patches = [patch('crud_sql_apiserver._startup_checked', False), patch('crud_sql_apiserver._background_pid', None),
+                   patch('crud_sql_apiserver.ensure_email_everyday_index', return_value=[]),
+                   patch('crud_sql_apiserver.ensure_jiaodika_fulltext_index', return_value=False),
+                   patch('crud_sql_apiserver.ensure_jiaodika_version_column', return_value=False),
+                   patch('crud_sql_apiserver.warm_up_converters', return_value={}),
+                   patch('crud_sql_apiserver._schema_registry'), patch('crud_sql_apiserver._handled_index'),
+                   patch('crud_sql_apiserver._mail_outbox')]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.hooks = runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "gunicorn.conf.py"))
+
+    def test_on_starting_fails_on_bad_key(self):
+        with patch('crud_sql_apiserver._fernet', None), patch('crud_sql_apiserver.ENCRYPTION_KEY_RAW', None):
+            with self.assertRaises(RuntimeError):
+                self.hooks["on_starting"](None)
+
+    def test_startup_runs_no_ddl_by_default(self):
+        """启动时默认只检查索引/列；SCHEMA_AUTO_DDL=1 时才补建"""
+        self.hooks["on_starting"](None)
+        crud_sql_apiserver.ensure_email_everyday_index.assert_called_once_with(create=False)
+        crud_sql_apiserver.ensure_jiaodika_version_column.assert_called_once_with(create=False)
+        crud_sql_apiserver.ensure_jiaodika_fulltext_index.assert_called_once_with(create=False)
+
+        crud_sql_apiserver._startup_checked = False
+        with patch('crud_sql_apiserver.SCHEMA_AUTO_DDL', True):
+            self.hooks["on_starting"](None)
+        crud_sql_apiserver.ensure_email_everyday_index.assert_called_with(create=True)
+
+    def test_post_fork_starts_background_tasks_once_per_process(self):
+        self.hooks["on_starting"](None)
+        self.hooks["post_fork"](None, None)
+        self.hooks["post_fork"](None, None)
+        crud_sql_apiserver._mail_outbox.start.assert_called_once_with()
+        crud_sql_apiserver._schema_registry.start.assert_called_once_with()
+        crud_sql_apiserver.warm_up_converters.assert_called_once_with()
+
+
+class HkTimeTest(unittest.TestCase):
+    def test_day_window_rolls_over_at_hk_midnight(self):
+        # 2026-10-19 15:59:59 UTC = 香港 23:59:59
+        before = datetime(2026, 10, 19, 15, 59, 59, tzinfo=hk_time.UTC).timestamp()
+        self.assertEqual(hk_time.hk_day_window(before),
+                         ("2026-10-19", "2026-10-19 00:00:00", "2026-10-19 23:59:59"))
+        cached = hk_time._day_window
+        self.assertEqual(hk_time.hk_day_window(before - 3600)[0], "2026-10-19")
+        self.assertIs(hk_time._day_window, cached)
+        self.assertEqual(hk_time.hk_day_window(before + 1)[0], "2026-10-20")
+
+    @patch('crud_sql_apiserver.execute_query', return_value=[])
+    def test_today_records_use_hk_day(self, mock_execute_query):
+        with patch('hk_time.time.time', return_value=datetime(2026, 10, 19, 17, 0, tzinfo=crud_sql_apiserver.UTC).timestamp()):
+            app.test_client().get('/records/today')
+        self.assertEqual(mock_execute_query.call_args.args[1][:2], ("2026-10-20 00:00:00", "2026-10-20 23:59:59"))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,226 @@
+"""
+email_everyday 保留期清理与分区维护
+
+email_everyday 只增不减，/email_everyday/check 与 /email_everyday 会随表增长变慢。本脚本定期运行（如每天 cron）：
+- 清理：删除 received_time 早于保留期的记录，可先归档为 gzip 压缩的 JSON Lines 文件；按 id 分批删除，避免长事务
+- 分区：表已按 received_time 做 RANGE 分区时，提前创建未来月份的分区；未设置归档时整月过期的分区直接 DROP
+  （比逐行 DELETE 快得多）。表尚未分区时只打印转换 DDL，由 DBA 评估后执行（需调整主键/唯一键，见 partition_ddl）
+
+清理后的 UID 不再被视为已处理，保留期应大于邮件轮询会回看的时间范围。
+API 进程的已处理邮件索引按 EMAIL_EVERYDAY_RETENTION_DAYS 判断哪些记录可能已被清理（这些记录改为查库确认），
+--retention-days 小于该环境变量时，被清理的记录在索引淘汰前仍可能被报告为已处理，应通过环境变量统一配置保留期。
+
+用法：
+    cd c-smart-epermit
+    python email_everyday_maintenance.py --retention-days 90 --archive-dir /data/archive/email_everyday
+    python email_everyday_maintenance.py --retention-days 90 --months-ahead 3   # 同时维护分区
+"""
+import argparse
+import gzip
+import json
+import os
+from datetime import date, datetime, timedelta
+
+from crud_sql_apiserver import (
+    EMAIL_EVERYDAY_RETENTION_DAYS, EMAIL_EVERYDAY_SERIALIZE_WRITES, EMAIL_EVERYDAY_TABLE, _env_int, execute_query,
+    get_conn,
+)
+from hk_time import hk_now
+
+EMAIL_EVERYDAY_PRUNE_BATCH = _env_int("EMAIL_EVERYDAY_PRUNE_BATCH") or 5000  # 每批删除的行数
+PARTITION_MAX = "pmax"
+UNIQUE_KEY = "uniq_account_email"  # (email_account, email_id) 唯一键
+SERIALIZE_WRITES_NOTICE = (
+    "执行分区 DDL 前，必须先在所有 API 进程上设置 EMAIL_EVERYDAY_SERIALIZE_WRITES=1 并重启："
+    "分区后唯一键不再能防止同一 UID 重复写入，改由该开关串行化写入"
+)
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat(sep=" ") if isinstance(value, datetime) else value.isoformat()
+    return str(value)
+
+
+def prune_email_everyday(retention_days=EMAIL_EVERYDAY_RETENTION_DAYS, archive_dir=None,
+                         batch_size=EMAIL_EVERYDAY_PRUNE_BATCH) -> dict:
+    """
+    删除 received_time 早于 retention_days 天前的记录；archive_dir 不为空时先写入
+    archive_dir/email_everyday-<截止日期>-<时间戳>.jsonl.gz。返回 {deleted, cutoff, archive_file}
+    """
+    # received_time 按北京/香港时间（UTC+8）写入，截止时间同样按 UTC+8 计算
+    cutoff = (hk_now() - timedelta(days=retention_days)).strftime("%Y-%m-%d 00:00:00")
+    archive_file = None
+    archive = None
+    if archive_dir:
+        os.makedirs(archive_dir, exist_ok=True)
+        archive_file = os.path.join(
+            archive_dir, f"{EMAIL_EVERYDAY_TABLE}-{cutoff[:10]}-{hk_now():%Y%m%d%H%M%S}.jsonl.gz"
+        )
+        archive = gzip.open(archive_file, "wt", encoding="utf-8")
+
+    deleted = 0
+    last_id = 0
+    try:
+        while True:
+            rows = execute_query(
+                f"SELECT * FROM `{EMAIL_EVERYDAY_TABLE}` WHERE `received_time` < %s AND `id` > %s "
+                f"ORDER BY `id` LIMIT {int(batch_size)}",
+                (cutoff, last_id),
+                fetch=True,
+            )
+            if not rows:
+                break
+            if archive is not None:
+                for row in rows:
+                    archive.write(json.dumps(row, ensure_ascii=False, default=_json_default) + "\n")
+                # 先落盘再删除，删除失败时归档里最多多出一批
+                archive.flush()
+            ids = [row["id"] for row in rows]
+            placeholders = ", ".join(["%s"] * len(ids))
+            deleted += execute_query(
+                f"DELETE FROM `{EMAIL_EVERYDAY_TABLE}` WHERE `id` IN ({placeholders})", tuple(ids)
+            )
+            last_id = ids[-1]
+            if len(rows) < batch_size:
+                break
+    finally:
+        if archive is not None:
+            archive.close()
+    return {"deleted": deleted, "cutoff": cutoff, "archive_file": archive_file}
+
+
+def _month_start(d: date, offset: int = 0) -> date:
+    month = d.month - 1 + offset
+    return date(d.year + month // 12, month % 12 + 1, 1)
+
+
+def _partition_name(month: date) -> str:
+    return f"p{month:%Y%m}"
+
+
+def _partition_clause(month: date) -> str:
+    """p202610 存放 2026-10 的数据（received_time < 2026-11-01）"""
+    return f"PARTITION {_partition_name(month)} VALUES LESS THAN ('{_month_start(month, 1):%Y-%m-%d}')"
+
+
+def email_everyday_partitions() -> list:
+    """返回现有分区 [(name, less_than)]，表未分区时为空列表"""
+    rows = execute_query(
+        "SELECT `PARTITION_NAME`, `PARTITION_DESCRIPTION` FROM `information_schema`.`PARTITIONS` "
+        "WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=%s AND `PARTITION_NAME` IS NOT NULL "
+        "ORDER BY `PARTITION_ORDINAL_POSITION`",
+        (EMAIL_EVERYDAY_TABLE,),
+        fetch=True,
+    )
+    return [(row["PARTITION_NAME"], row["PARTITION_DESCRIPTION"]) for row in rows]
+
+
+def partition_ddl(first_month: date, months_ahead: int = 3) -> list:
+    """
+    把 email_everyday 转为按月 RANGE COLUMNS(received_time) 分区的 DDL。
+    MySQL 要求分区列出现在每个主键/唯一键中（否则报 ERROR 1503），因此主键改为 (id, received_time)，
+    (email_account, email_id) 唯一键在同一条 ALTER 中扩展为 (email_account, email_id, received_time)：
+    保留按账号 + UID 查询用的索引，但同一 UID 的两次写入 received_time 不同，唯一键不再能防止重复。
+    add_read_ids 靠这个唯一键 + INSERT IGNORE 处理并发请求写入同一 UID 的竞争，分区后改由
+    EMAIL_EVERYDAY_SERIALIZE_WRITES=1 保证：同一账号的写入用 GET_LOCK 串行化，“先查询再写入”之间不会插入别的写入。
+    必须先在所有 API 进程上设置该变量，再执行本 DDL。
+    """
+    this_month = _month_start(hk_now().date())
+    months = []
+    month = _month_start(first_month)
+    while month <= _month_start(this_month, months_ahead):
+        months.append(month)
+        month = _month_start(month, 1)
+    clauses = [_partition_clause(m) for m in months] + [f"PARTITION {PARTITION_MAX} VALUES LESS THAN (MAXVALUE)"]
+    return [
+        f"ALTER TABLE `{EMAIL_EVERYDAY_TABLE}` DROP PRIMARY KEY, ADD PRIMARY KEY (`id`, `received_time`), "
+        f"DROP INDEX `{UNIQUE_KEY}`, ADD UNIQUE KEY `{UNIQUE_KEY}` (`email_account`, `email_id`, `received_time`)",
+        f"ALTER TABLE `{EMAIL_EVERYDAY_TABLE}` PARTITION BY RANGE COLUMNS(`received_time`) (\n    "
+        + ",\n    ".join(clauses) + "\n)",
+    ]
+
+
+def maintain_partitions(months_ahead: int = 3, retention_days=EMAIL_EVERYDAY_RETENTION_DAYS,
+                        drop_expired: bool = True) -> dict:
+    """
+    表已分区时：拆分 pmax 补齐未来 months_ahead 个月的分区，drop_expired 时删除整月早于保留期的分区。
+    added 只包含实际创建的分区；没有 pmax 时不创建，warning 说明原因。
+    表未分区时不做修改，返回建议执行的 DDL 及执行前提 notice。
+    """
+    partitions = email_everyday_partitions()
+    if not partitions:
+        first = execute_query(f"SELECT MIN(`received_time`) AS first FROM `{EMAIL_EVERYDAY_TABLE}`", fetch=True)
+        first_time = first[0]["first"] if first and first[0]["first"] else hk_now()
+        return {"partitioned": False, "ddl": partition_ddl(first_time.date(), months_ahead),
+                "notice": SERIALIZE_WRITES_NOTICE}
+
+    existing = {name for name, _ in partitions}
+    missing = []
+    target = _month_start(hk_now().date(), months_ahead)
+    month = _month_start(hk_now().date())
+    while month <= target:
+        if _partition_name(month) not in existing:
+            missing.append(month)
+        month = _month_start(month, 1)
+    added = []
+    warning = None
+    if missing and PARTITION_MAX not in existing:
+        # 没有 pmax 无法拆分出新分区；超出最后一个分区上界的写入会失败，需要 DBA 处理
+        warning = (f"缺少 {PARTITION_MAX} 分区，未能创建 {', '.join(_partition_name(m) for m in missing)}；"
+                   f"请执行 ALTER TABLE `{EMAIL_EVERYDAY_TABLE}` ADD PARTITION 补齐")
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            if missing and PARTITION_MAX in existing:
+                clauses = [_partition_clause(m) for m in missing]
+                clauses.append(f"PARTITION {PARTITION_MAX} VALUES LESS THAN (MAXVALUE)")
+                cur.execute(
+                    f"ALTER TABLE `{EMAIL_EVERYDAY_TABLE}` REORGANIZE PARTITION {PARTITION_MAX} INTO ("
+                    + ", ".join(clauses) + ")"
+                )
+                added = missing
+            dropped = []
+            if drop_expired:
+                cutoff_month = _month_start(hk_now().date() - timedelta(days=retention_days))
+                dropped = [name for name, _ in partitions
+                           if name != PARTITION_MAX and name < _partition_name(cutoff_month)]
+                if dropped:
+                    cur.execute(f"ALTER TABLE `{EMAIL_EVERYDAY_TABLE}` DROP PARTITION {', '.join(dropped)}")
+        conn.commit()
+    finally:
+        conn.close()
+    return {"partitioned": True, "added": [_partition_name(m) for m in added], "dropped": dropped, "warning": warning}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="email_everyday 保留期清理与分区维护")
+    parser.add_argument("--retention-days", type=int, default=EMAIL_EVERYDAY_RETENTION_DAYS)
+    parser.add_argument("--archive-dir", help="归档目录；不指定则直接删除")
+    parser.add_argument("--months-ahead", type=int, default=0, help="维护分区：提前创建的月份数（0 表示不维护分区）")
+    args = parser.parse_args()
+
+    if args.months_ahead:
+        # 需要归档时不能整区 DROP，交给下面逐行归档删除
+        res = maintain_partitions(args.months_ahead, args.retention_days, drop_expired=not args.archive_dir)
+        if res["partitioned"]:
+            print(f"分区维护完成：新增 {res['added'] or '无'}，删除 {res['dropped'] or '无'}")
+            if res["warning"]:
+                print(f"警告：{res['warning']}")
+        else:
+            print("=" * 80)
+            print(f"注意：{res['notice']}")
+            if not EMAIL_EVERYDAY_SERIALIZE_WRITES:
+                print("（当前环境未设置 EMAIL_EVERYDAY_SERIALIZE_WRITES=1）")
+            print("=" * 80)
+            print("email_everyday 尚未分区，建议评估后执行：")
+            for ddl in res["ddl"]:
+                print(ddl + ";")
+
+    res = prune_email_everyday(args.retention_days, archive_dir=args.archive_dir)
+    print(f"清理完成：删除 {res['deleted']} 行（received_time < {res['cutoff']}）"
+          + (f"，归档到 {res['archive_file']}" if res["archive_file"] else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+# gunicorn 部署配置：在本目录执行 gunicorn -c gunicorn.conf.py
+# crud_sql_apiserver 的启动步骤只在直接运行时由 __main__ 调用，WSGI 部署靠下面两个钩子完成：
+#   on_starting：master 进程单线程阶段加载延迟模块、校验密钥（出错时 gunicorn 直接启动失败）、检查索引、预热转换表
+#   （缺少索引时只打印警告；补建用 python crud_sql_apiserver.py --migrate）
+#   post_fork：每个 worker 启动自己的后台线程（表结构刷新、已处理邮件索引预热、邮件发件箱投递）
+import os
+
+wsgi_app = "crud_sql_apiserver:app"
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+
+def on_starting(server):
+    import crud_sql_apiserver
+    crud_sql_apiserver.startup_checks()
+
+
+def post_fork(server, worker):
+    import crud_sql_apiserver
+    crud_sql_apiserver.start_background_tasks()
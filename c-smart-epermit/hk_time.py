@@ -0,0 +1,47 @@
+"""
+香港 / 北京时间工具
+
+时区对象在模块加载时创建一次，各处不再逐次调用 pytz.timezone()（收信时每封邮件都要换算时区）。
+hk_day_window() 缓存当天（香港时区）的起止时间字符串，香港午夜后第一次调用时切换到新的一天；
+/records/today 等按“今天”查询的接口都以香港时区为准，不受服务器本地时区影响。
+
+香港与北京同为 UTC+8 且无夏令时，因此两地的“今天”相同。
+"""
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+UTC = pytz.UTC
+HK_TZ = pytz.timezone("Asia/Hong_Kong")
+CST_TZ = pytz.timezone("Asia/Shanghai")
+
+_day_window = None  # (day, start, end, 当天开始的时间戳, 次日开始的时间戳)
+
+
+def hk_now() -> datetime:
+    return datetime.now(HK_TZ)
+
+
+def cst_now() -> datetime:
+    return datetime.now(CST_TZ)
+
+
+def hk_day_window(now_ts: float = None) -> tuple:
+    """返回香港时区当天 (YYYY-MM-DD, 'YYYY-MM-DD 00:00:00', 'YYYY-MM-DD 23:59:59')"""
+    global _day_window
+    ts = time.time() if now_ts is None else now_ts
+    window = _day_window
+    if window is None or not (window[3] <= ts < window[4]):
+        day = datetime.fromtimestamp(ts, HK_TZ).date()
+        next_day = day + timedelta(days=1)
+        start = HK_TZ.localize(datetime(day.year, day.month, day.day))
+        next_start = HK_TZ.localize(datetime(next_day.year, next_day.month, next_day.day))
+        day_str = day.strftime("%Y-%m-%d")
+        window = (day_str, f"{day_str} 00:00:00", f"{day_str} 23:59:59", start.timestamp(), next_start.timestamp())
+        _day_window = window
+    return window[:3]
+
+
+def hk_today() -> str:
+    return hk_day_window()[0]
@@ -0,0 +1,283 @@
+"""
+IMAP IDLE 邮件监听服务
+
+为 email_accounts 表中的每个账号保持一条 IMAP IDLE 长连接，新邮件到达时立即拉取、解析并写入
+本地 SQLite 缓存（见 crud_sql_apiserver.py 的「本地邮件缓存」）。/mail/receive_from_db 检测到
+watcher 心跳正常时直接读缓存，FastGPT 轮询不再触发 IMAP 拉取，IMAP 负载只与新邮件数量相关。
+
+用法（与 API 服务部署在同一台机器，共享 MAIL_CACHE_DB_PATH）：
+    cd c-smart-epermit
+    python mail_idle_watcher.py
+"""
+import imaplib
+import re
+import select
+import ssl
+import threading
+import time
+
+from crud_sql_apiserver import (
+    DEFAULT_IMAP_PORT,
+    DEFAULT_IMAP_SERVER,
+    EMAIL_ACCOUNT_TABLE,
+    _credential_cache,
+    _env_int,
+    _env_str,
+    _imap_logout_quietly,
+    _imap_uid_fetch,
+    _mail_cache_conn,
+    _mail_cache_put_messages,
+    _parse_mail_bytes,
+    execute_query,
+)
+
+MAIL_WATCH_MAILBOX = _env_str("MAIL_WATCH_MAILBOX") or "inbox"
+MAIL_WATCH_IDLE_SECONDS = _env_int("MAIL_WATCH_IDLE_SECONDS") or 60  # 每轮 IDLE 最长等待，到点 DONE 并刷新心跳
+MAIL_WATCH_INITIAL_SYNC = _env_int("MAIL_WATCH_INITIAL_SYNC") or 200  # 首次同步拉取最新 N 封（及最新 N 封未读）
+MAIL_WATCH_FETCH_BATCH = _env_int("MAIL_WATCH_FETCH_BATCH") or 50  # 单条 UID FETCH 携带的 UID 数
+MAIL_WATCH_ACCOUNT_REFRESH = _env_int("MAIL_WATCH_ACCOUNT_REFRESH") or 300  # 重新读取 email_accounts 的间隔
+MAIL_WATCH_RETRY_MAX = _env_int("MAIL_WATCH_RETRY_MAX") or 300  # 断线重连的最大退避秒数
+
+_UNTAGGED_EVENT_RE = re.compile(rb"^\* \d+ (EXISTS|EXPUNGE|FETCH)\b", re.IGNORECASE)
+
+
+def _has_buffered_data(mail) -> bool:
+    """imaplib 的读缓冲里是否已有未处理数据（这部分 select 看不到）"""
+    sock = mail.sock
+    old_timeout = sock.gettimeout()
+    sock.settimeout(0.0)
+    try:
+        return bool(mail.file.peek(1))
+    except (ssl.SSLWantReadError, BlockingIOError):
+        return False
+    finally:
+        sock.settimeout(old_timeout)
+
+
+def _idle_wait(mail, timeout: float) -> set:
+    """
+    发送 IDLE 并等待服务器推送，最多 timeout 秒；收到 EXISTS/EXPUNGE/FETCH 即结束。
+    返回收到的事件名集合（超时无事件则为空集合）。
+    imaplib 在 Python 3.14 之前没有 IDLE 支持，这里直接按 RFC 2177 收发。
+    """
+    tag = mail._new_tag()
+    mail.send(tag + b" IDLE\r\n")
+    events = set()
+
+    line = mail.readline()
+    while line.startswith(b"* "):
+        m = _UNTAGGED_EVENT_RE.match(line)
+        if m:
+            events.add(m.group(1).upper().decode())
+        line = mail.readline()
+    if not line.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"服务器不支持 IDLE: {line!r}")
+
+    deadline = time.monotonic() + timeout
+    while not events:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not _has_buffered_data(mail) and not select.select([mail.sock], [], [], remaining)[0]:
+            break
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("IDLE 期间连接被关闭")
+        m = _UNTAGGED_EVENT_RE.match(line)
+        if m:
+            events.add(m.group(1).upper().decode())
+
+    mail.send(b"DONE\r\n")
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("IDLE 结束时连接被关闭")
+        if line.startswith(tag + b" "):
+            mail.tagged_commands.pop(tag, None)
+            if not line[len(tag) + 1:].upper().startswith(b"OK"):
+                raise imaplib.IMAP4.error(f"IDLE 结束异常: {line!r}")
+            return events
+        m = _UNTAGGED_EVENT_RE.match(line)
+        if m:
+            events.add(m.group(1).upper().decode())
+
+
+def _uid_search(mail, criteria: str) -> list:
+    status, data = mail.uid("search", None, criteria)
+    if status != "OK":
+        raise RuntimeError(f"IMAP UID SEARCH {criteria} 返回非 OK: {status}")
+    return [int(x) for x in (data[0] or b"").split()]
+
+
+class MailboxWatcher(threading.Thread):
+    """单个账号 + 文件夹的 IDLE 监听线程，断线后指数退避重连"""
+
+    def __init__(self, email_account, email_password, imap_server, imap_port, mailbox):
+        super().__init__(name=f"mail-idle-{email_account}", daemon=True)
+        self.email_account = email_account
+        self.email_password = email_password
+        self.imap_server = imap_server
+        self.imap_port = int(imap_port)
+        self.mailbox = mailbox
+        self.uidvalidity = None
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _connect(self):
+        mail = imaplib.IMAP4_SSL(self.imap_server, self.imap_port)
+        mail.login(self.email_account, self.email_password)
+        # 只读 EXAMINE：watcher 永远不改变邮件的已读状态
+        status, _ = mail.select(self.mailbox, readonly=True)
+        if status != "OK":
+            raise RuntimeError(f"IMAP SELECT {self.mailbox} 返回非 OK: {status}")
+        _, data = mail.response("UIDVALIDITY")
+        if not data or data[0] is None:
+            _, data = mail.status(self.mailbox, "(UIDVALIDITY)")
+            data = re.findall(rb"UIDVALIDITY (\d+)", data[0] or b"")
+        self.uidvalidity = int(data[0])
+        return mail
+
+    def _sync(self, mail, fetch_new: bool, expunged: bool = False):
+        conn = _mail_cache_conn(create=True)
+        try:
+            acc, box, validity = self.email_account, self.mailbox, self.uidvalidity
+            state = conn.execute(
+                "SELECT uidvalidity, last_uid FROM mail_sync_state WHERE email_account=? AND mailbox=?",
+                (acc, box),
+            ).fetchone()
+            last_uid = 0
+            if state is not None:
+                if state["uidvalidity"] == validity:
+                    last_uid = state["last_uid"]
+                else:
+                    # UIDVALIDITY 变化后旧 UID 全部失效
+                    conn.execute(
+                        "DELETE FROM mail_messages WHERE email_account=? AND mailbox=? AND uidvalidity<>?",
+                        (acc, box, validity),
+                    )
+                    fetch_new = True
+
+            unseen = set(_uid_search(mail, "UNSEEN"))
+
+            if fetch_new:
+                if last_uid:
+                    # "UID n:*" 在没有更大 UID 时仍会返回当前最大 UID，需要再过滤一次
+                    new_uids = [u for u in _uid_search(mail, f"UID {last_uid + 1}:*") if u > last_uid]
+                else:
+                    all_uids = sorted(_uid_search(mail, "ALL"), reverse=True)
+                    latest_unseen = sorted(unseen, reverse=True)[:MAIL_WATCH_INITIAL_SYNC]
+                    new_uids = set(all_uids[:MAIL_WATCH_INITIAL_SYNC]) | set(latest_unseen)
+                    last_uid = all_uids[0] if all_uids else 0
+                items = [
+                    (uid, _parse_mail_bytes(raw), uid not in unseen)
+                    for uid, raw in _imap_uid_fetch(mail, sorted(new_uids), batch_size=MAIL_WATCH_FETCH_BATCH)
+                ]
+                _mail_cache_put_messages(conn, acc, box, validity, items)
+                last_uid = max([last_uid] + [uid for uid, _, _ in items])
+
+            if expunged:
+                row = conn.execute(
+                    "SELECT MIN(uid) AS min_uid FROM mail_messages WHERE email_account=? AND mailbox=? AND uidvalidity=?",
+                    (acc, box, validity),
+                ).fetchone()
+                if row["min_uid"] is not None:
+                    alive = set(_uid_search(mail, f"UID {row['min_uid']}:*"))
+                    cached = conn.execute(
+                        "SELECT uid FROM mail_messages WHERE email_account=? AND mailbox=? AND uidvalidity=?",
+                        (acc, box, validity),
+                    ).fetchall()
+                    conn.executemany(
+                        "DELETE FROM mail_messages WHERE email_account=? AND mailbox=? AND uidvalidity=? AND uid=?",
+                        [(acc, box, validity, r["uid"]) for r in cached if r["uid"] not in alive],
+                    )
+
+            # 已读状态可能被其他客户端改变，每轮按 UNSEEN 结果整体刷新
+            conn.execute(
+                "UPDATE mail_messages SET seen=1 WHERE email_account=? AND mailbox=? AND uidvalidity=?",
+                (acc, box, validity),
+            )
+            conn.executemany(
+                "UPDATE mail_messages SET seen=0 WHERE email_account=? AND mailbox=? AND uidvalidity=? AND uid=?",
+                [(acc, box, validity, uid) for uid in unseen],
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO mail_sync_state (email_account, mailbox, uidvalidity, last_uid, heartbeat_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (acc, box, validity, last_uid, time.time()),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def run(self):
+        backoff = 5
+        while not self._stop_event.is_set():
+            mail = None
+            try:
+                mail = self._connect()
+                self._sync(mail, fetch_new=True)
+                backoff = 5
+                while not self._stop_event.is_set():
+                    events = _idle_wait(mail, MAIL_WATCH_IDLE_SECONDS)
+                    self._sync(mail, fetch_new="EXISTS" in events, expunged="EXPUNGE" in events)
+            except Exception as e:
+                print(f"[mail_idle_watcher] {self.email_account} 监听异常，{backoff}s 后重连: {e}")
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, MAIL_WATCH_RETRY_MAX)
+            finally:
+                if mail is not None:
+                    _imap_logout_quietly(mail)
+
+
+def _load_accounts() -> dict:
+    """
+    读取 email_accounts 并解密密码，返回 {email_account: password}
+    每轮都查库以便发现账号增删和密码变更；密文未变的账号直接用凭据缓存，不重复解密
+    """
+    sql = f"SELECT `email_account`, `encrypted_password` FROM `{EMAIL_ACCOUNT_TABLE}` ORDER BY `id`"
+    accounts = {}
+    for row in execute_query(sql, (), fetch=True):
+        acc = row.get("email_account")
+        encrypted_pwd = row.get("encrypted_password")
+        if not acc or not encrypted_pwd:
+            continue
+        try:
+            accounts[acc] = _credential_cache.password(acc, encrypted_pwd)
+        except Exception as e:
+            print(f"[mail_idle_watcher] {acc} 密码解密失败，跳过: {e}")
+    return accounts
+
+
+def run_watchers(imap_server=DEFAULT_IMAP_SERVER, imap_port=DEFAULT_IMAP_PORT, mailbox=MAIL_WATCH_MAILBOX):
+    """
+    常驻运行：定期读取 email_accounts，为新增账号启动 watcher，
+    对已删除或密码已变更的账号停止旧 watcher（密码变更会用新密码重新启动）。
+    """
+    _mail_cache_conn(create=True).close()
+    watchers = {}
+    while True:
+        try:
+            accounts = _load_accounts()
+        except Exception as e:
+            print(f"[mail_idle_watcher] 读取 email_accounts 失败: {e}")
+            accounts = None
+
+        if accounts is not None:
+            for acc, watcher in list(watchers.items()):
+                if accounts.get(acc) != watcher.email_password or not watcher.is_alive():
+                    watcher.stop()
+                    del watchers[acc]
+            for acc, password in accounts.items():
+                if acc not in watchers:
+                    watcher = MailboxWatcher(acc, password, imap_server, imap_port, mailbox)
+                    watcher.start()
+                    watchers[acc] = watcher
+            print(f"[mail_idle_watcher] 正在监听 {len(watchers)} 个账号")
+
+        time.sleep(MAIL_WATCH_ACCOUNT_REFRESH)
+
+
+if __name__ == "__main__":
+    run_watchers()